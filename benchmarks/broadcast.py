@@ -0,0 +1,52 @@
+#!/bin/env python3
+"""
+Fan-out of one message to many clients, a send_frame loop against
+Websocket.broadcast. The clients write to a socket stand-in that accepts
+everything so only the framing and dispatch cost is measured.
+Run with: python3 -m benchmarks.broadcast
+"""
+import time
+import ewebsockets
+from ewebsockets.ClientSocket import Client
+
+
+class NullSocket:
+    def fileno(self):
+        return -1
+
+    def send(self, data):
+        return len(data)
+
+    def sendmsg(self, buffers):
+        return sum(len(buffer) for buffer in buffers)
+
+
+def per_client_loop(clients, payload):
+    frame = ewebsockets.Frame(payload=payload, opcode=ewebsockets.OpCode.TEXT)
+    for client in clients:
+        client.send_frame(frame)
+
+
+def best_of(function, repeat=5):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(recipients=10000, sizes=(16, 1024, 65536)):
+    server = ewebsockets.Websocket()
+    clients = [Client(NullSocket(), ('127.0.0.1', i), state=Client.OPEN) for i in range(recipients)]
+    print('{} recipients'.format(recipients))
+    print('{:>8} {:>18} {:>18}'.format('size', 'send_frame loop', 'broadcast'))
+    for size in sizes:
+        payload = b'x' * size
+        loop = best_of(lambda: per_client_loop(clients, payload))
+        broadcast = best_of(lambda: server.broadcast(payload, clients=clients))
+        print('{:>8} {:>11.0f} msg/s {:>11.0f} msg/s'.format(size, recipients / loop, recipients / broadcast))
+
+
+if __name__ == '__main__':
+    main()
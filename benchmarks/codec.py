@@ -0,0 +1,105 @@
+#!/bin/env python3
+"""
+Micro benchmarks of the RFC6455 codec over payload sizes seen in practice,
+from chat sized messages to megabyte blobs: packing server and client
+frames, parsing with Frame.recv_frame and FrameParser, masking and
+answering an opening handshake.
+Run with: python3 -m benchmarks.codec [--json results.json]
+"""
+import argparse
+import io
+import os
+import timeit
+import ewebsockets
+from ewebsockets import masking
+from ewebsockets.handshake import HandshakeParser, pack_response
+from .handshake import REQUEST
+from .results import write
+
+SIZES = (16, 125, 1024, 16384, 65536, 1048576)
+
+
+def rate(function, min_time=0.2):
+    """
+    :return: Calls per second
+    """
+    number, elapsed = timeit.Timer(function).autorange()
+    while elapsed < min_time:
+        number *= 2
+        elapsed = timeit.Timer(function).timeit(number)
+    return number / elapsed
+
+
+def frame_benchmarks(size):
+    payload = os.urandom(size)
+    server_frame = ewebsockets.Frame(payload=payload, opcode=ewebsockets.OpCode.BINARY)
+    client_frame = ewebsockets.Frame(payload=payload, opcode=ewebsockets.OpCode.BINARY, mask=1)
+    client_frame.update_masking()
+    data = client_frame.pack()
+
+    def pack_masked():
+        client_frame.update_masking()
+        return client_frame.pack()
+
+    def recv_frame():
+        return ewebsockets.Frame().recv_frame(io.BytesIO(data).read)
+
+    parser = ewebsockets.FrameParser()
+
+    def frame_parser():
+        parser.feed(data)
+        return parser.next_frame()
+
+    zero_copy_parser = ewebsockets.FrameParser(zero_copy=True)
+
+    def zero_copy():
+        zero_copy_parser.feed(data)
+        return zero_copy_parser.next_frame()
+
+    key = client_frame.masking_key
+    assert recv_frame().payload == frame_parser().payload == bytes(zero_copy().payload) == payload
+    return {'Frame.pack': rate(server_frame.pack),
+            'Frame.pack masked': rate(pack_masked),
+            'Frame.recv_frame': rate(recv_frame),
+            'FrameParser': rate(frame_parser),
+            'FrameParser zero_copy': rate(zero_copy),
+            'masking_algorithm': rate(lambda: masking.masking_algorithm(payload, key))}
+
+
+def handshake_benchmarks():
+    def parser():
+        request = HandshakeParser().feed(REQUEST)
+        return pack_response(request.key)
+
+    return {'pack_handshake': rate(lambda: ewebsockets.pack_handshake(REQUEST)),
+            'HandshakeParser/pack_response': rate(parser)}
+
+
+def main():
+    arguments = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arguments.add_argument('--json', metavar='PATH', help='Write the results as JSON, - for stdout')
+    arguments.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    options = arguments.parse_args()
+
+    results = {'frames': {}, 'handshake': handshake_benchmarks()}
+    for size in options.sizes:
+        results['frames'][str(size)] = frame_benchmarks(size)
+
+    if options.json == '-':
+        write('codec', results)
+        return
+    names = list(results['frames'][str(options.sizes[0])])
+    print('calls/s, MB/s below')
+    print('{:>8} '.format('size') + ' '.join('{:>22}'.format(name) for name in names))
+    for size in options.sizes:
+        row = results['frames'][str(size)]
+        print('{:>8} '.format(size) + ' '.join('{:>13.0f} {:>8.1f}'.format(row[name], row[name] * size / 2**20)
+                                               for name in names))
+    for name, value in results['handshake'].items():
+        print('{:<30} {:>10.0f} handshakes/s'.format(name, value))
+    if options.json:
+        write('codec', results, options.json)
+
+
+if __name__ == '__main__':
+    main()
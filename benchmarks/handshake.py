@@ -0,0 +1,96 @@
+#!/bin/env python3
+"""
+Opening handshakes per second. Parsing and answering a request in process,
+the original line scanning against the incremental parser with the response
+template, then complete handshakes over loopback against a running Websocket.
+Run with: python3 -m benchmarks.handshake
+"""
+import base64
+import os
+import socket
+import threading
+import time
+import ewebsockets
+from ewebsockets.handshake import HandshakeParser, pack_response
+
+REQUEST = (b'GET /chat HTTP/1.1\r\n'
+           b'Host: 127.0.0.1:1234\r\n'
+           b'User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:109.0) Gecko/20100101 Firefox/115.0\r\n'
+           b'Accept: */*\r\n'
+           b'Accept-Language: en-US,en;q=0.5\r\n'
+           b'Accept-Encoding: gzip, deflate\r\n'
+           b'Sec-WebSocket-Version: 13\r\n'
+           b'Origin: http://127.0.0.1:1234\r\n'
+           b'Sec-WebSocket-Extensions: permessage-deflate\r\n'
+           b'Sec-WebSocket-Key: ' + base64.b64encode(os.urandom(16)) + b'\r\n'
+           b'Connection: keep-alive, Upgrade\r\n'
+           b'Pragma: no-cache\r\n'
+           b'Cache-Control: no-cache\r\n'
+           b'Upgrade: websocket\r\n'
+           b'\r\n')
+
+
+def legacy(request):
+    ewebsockets.get_header(request, b'Sec-WebSocket-Extensions')
+    return ewebsockets.pack_handshake(request)
+
+
+def incremental(request):
+    request = HandshakeParser().feed(request)
+    return pack_response(request.key)
+
+
+def rates(functions, rounds=20, min_time=0.05):
+    """Alternates between the functions so load on the machine affects all of them alike
+    :return: The best rate of each over rounds runs of at least min_time seconds
+    """
+    best = [0] * len(functions)
+    for _ in range(rounds):
+        for i, function in enumerate(functions):
+            count = 0
+            start = time.perf_counter()
+            while time.perf_counter() - start < min_time:
+                for _ in range(1000):
+                    function(REQUEST)
+                count += 1000
+            best[i] = max(best[i], count / (time.perf_counter() - start))
+    return best
+
+
+def loopback(port, connections=4, duration=3):
+    server = ewebsockets.Websocket(esockets_kwargs={'host': '127.0.0.1', 'port': port, 'block_time': 0.5})
+    server.start()
+    counts = [0] * connections
+    deadline = time.monotonic() + duration
+
+    def connect(index):
+        while time.monotonic() < deadline:
+            sock = socket.create_connection(('127.0.0.1', port))
+            sock.sendall(REQUEST)
+            response = b''
+            while b'\r\n\r\n' not in response:
+                response += sock.recv(4096)
+            sock.close()
+            counts[index] += 1
+
+    threads = [threading.Thread(target=connect, args=(i,)) for i in range(connections)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    server.stop()
+    return sum(counts) / duration
+
+
+def main(port=9399):
+    assert legacy(REQUEST) == incremental(REQUEST)
+    legacy_rate, incremental_rate = rates((legacy, incremental))
+    print('{:<28} {:>10.0f} handshakes/s'.format('get_header/pack_handshake', legacy_rate))
+    print('{:<28} {:>10.0f} handshakes/s'.format('HandshakeParser/template', incremental_rate))
+    print('{:<28} {:>10.0f} handshakes/s'.format('loopback, 4 connections', loopback(port)))
+    # esockets threads are not daemonic
+    os._exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,344 @@
+#!/bin/env python3
+"""
+Load generator. A Websocket runs in its own process and several client
+processes open thousands of loopback connections against it, then report
+messages per second and the p50/p99/p999 latency of a scenario:
+
+echo       every connection sends a message, waits for it to come back and
+           sends the next one
+broadcast  one connection sends --rate messages per second which the
+           server broadcasts to all connections
+handshake  every connection does opening handshakes back to back, so
+           --connections handshakes are always in flight
+
+Latencies are measured from a monotonic timestamp carried in the payload,
+which is comparable between the processes.
+Run with: python3 -m benchmarks.load [--scenario echo] [--connections 2000] [--json results.json]
+"""
+import argparse
+import base64
+import errno
+import multiprocessing
+import os
+import resource
+import selectors
+import socket
+import struct
+import time
+import ewebsockets
+from ewebsockets import Frame, FrameParser, OpCode
+from .results import write
+
+_timestamp = struct.Struct('!d')
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+def serve(scenario, port, ready):
+    def echo(client, frame):
+        if frame.opcode == OpCode.BINARY:
+            client.send_binary(bytes(frame.payload))
+        return True
+
+    def broadcast(client, frame):
+        if frame.opcode == OpCode.BINARY:
+            server.broadcast(bytes(frame.payload), OpCode.BINARY)
+        return True
+
+    raise_fd_limit()
+    server = ewebsockets.Websocket(handle_websocket_frame=broadcast if scenario == 'broadcast' else echo,
+                                   ping_interval=None,
+                                   esockets_kwargs={'host': '127.0.0.1', 'port': port, 'queue_size': 4096})
+    server.start()
+    ready.set()
+    while True:
+        time.sleep(3600)
+
+
+class Connection:
+    """Non-blocking client connection, connecting as soon as it is created"""
+    def __init__(self, address, selector):
+        self.selector = selector
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.setblocking(False)
+        self.started = time.monotonic()
+        self.response = b''
+        self.parser = FrameParser()
+        self.requested = False
+        self.is_open = False
+        self.pending = b''
+        error = self.sock.connect_ex(address)
+        if error not in (0, errno.EINPROGRESS):
+            self.sock.close()
+            raise OSError(error, os.strerror(error))
+        selector.register(self.sock, selectors.EVENT_WRITE, self)
+
+    def writable(self):
+        if not self.requested:
+            # Connected, the request is small enough for one send
+            key = base64.b64encode(os.urandom(16))
+            self.sock.send(b'GET / HTTP/1.1\r\nHost: 127.0.0.1\r\nUpgrade: websocket\r\n'
+                           b'Connection: Upgrade\r\nSec-WebSocket-Version: 13\r\n'
+                           b'Sec-WebSocket-Key: ' + key + b'\r\n\r\n')
+            self.requested = True
+            self.selector.modify(self.sock, selectors.EVENT_READ, self)
+            return
+        sent = self.sock.send(self.pending)
+        self.pending = self.pending[sent:]
+        if not self.pending:
+            self.selector.modify(self.sock, selectors.EVENT_READ, self)
+
+    def readable(self):
+        """
+        :return: Frames received, empty until the handshake response is complete
+        """
+        data = self.sock.recv(65536)
+        if not data:
+            raise ConnectionResetError('Closed by the server')
+        if not self.is_open:
+            self.response += data
+            head, separator, data = self.response.partition(b'\r\n\r\n')
+            if not separator:
+                return []
+            if not head.startswith(b'HTTP/1.1 101'):
+                raise ConnectionRefusedError(head.split(b'\r\n')[0].decode().strip())
+            self.is_open = True
+        self.parser.feed(data)
+        return list(self.parser)
+
+    def send(self, payload):
+        frame = Frame(payload=payload, opcode=OpCode.BINARY, mask=1)
+        frame.update_masking()
+        data = frame.pack()
+        if self.pending:
+            self.pending += data
+            return
+        try:
+            sent = self.sock.send(data)
+        except BlockingIOError:
+            sent = 0
+        if sent < len(data):
+            self.pending = data[sent:]
+            self.selector.modify(self.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, self)
+
+    def close(self):
+        self.selector.unregister(self.sock)
+        self.sock.close()
+
+
+def message(size):
+    return _timestamp.pack(time.monotonic()) + b'x' * max(0, size - _timestamp.size)
+
+
+def latency(payload):
+    return time.monotonic() - _timestamp.unpack_from(payload)[0]
+
+
+def open_connections(address, selector, count, batch=256):
+    """Opens count connections, at most batch handshakes in flight
+    :return: (open connections, errors)
+    """
+    connections = []
+    connecting = 0
+    errors = 0
+    while len(connections) + connecting < count or connecting:
+        while connecting < batch and len(connections) + connecting < count:
+            Connection(address, selector)
+            connecting += 1
+        for key, events in selector.select(timeout=5):
+            connection = key.data
+            try:
+                if events & selectors.EVENT_WRITE:
+                    connection.writable()
+                else:
+                    connection.readable()
+                    if connection.is_open:
+                        connecting -= 1
+                        connections.append(connection)
+            except OSError:
+                connection.close()
+                connecting -= 1
+                errors += 1
+    return connections, errors
+
+
+def run_echo(connections, selector, deadline, size, **_):
+    latencies = []
+    errors = 0
+    for connection in connections:
+        connection.send(message(size))
+    while time.monotonic() < deadline:
+        for key, events in selector.select(timeout=0.1):
+            connection = key.data
+            try:
+                if events & selectors.EVENT_WRITE:
+                    connection.writable()
+                if events & selectors.EVENT_READ:
+                    for frame in connection.readable():
+                        latencies.append(latency(frame.payload))
+                        connection.send(message(size))
+            except OSError:
+                connection.close()
+                errors += 1
+    return latencies, errors
+
+
+def run_broadcast(connections, selector, deadline, size, rate, sender, **_):
+    latencies = []
+    errors = 0
+    next_send = time.monotonic()
+    while time.monotonic() < deadline:
+        if sender:
+            now = time.monotonic()
+            while next_send <= now:
+                connections[0].send(message(size))
+                next_send += 1 / rate
+            timeout = min(0.1, max(0, next_send - now))
+        else:
+            timeout = 0.1
+        for key, events in selector.select(timeout=timeout):
+            connection = key.data
+            try:
+                if events & selectors.EVENT_WRITE:
+                    connection.writable()
+                if events & selectors.EVENT_READ:
+                    for frame in connection.readable():
+                        latencies.append(latency(frame.payload))
+            except OSError:
+                connection.close()
+                errors += 1
+    return latencies, errors
+
+
+def run_handshake(connections, selector, deadline, address, **_):
+    latencies = []
+    errors = 0
+    count = len(connections)
+    for connection in connections:
+        connection.close()
+    for _ in range(count):
+        Connection(address, selector)
+    while time.monotonic() < deadline:
+        for key, events in selector.select(timeout=0.1):
+            connection = key.data
+            try:
+                if events & selectors.EVENT_WRITE:
+                    connection.writable()
+                    continue
+                connection.readable()
+                if not connection.is_open:
+                    continue
+                latencies.append(time.monotonic() - connection.started)
+            except OSError:
+                errors += 1
+            connection.close()
+            Connection(address, selector)
+    return latencies, errors
+
+
+scenarios = {'echo': run_echo, 'broadcast': run_broadcast, 'handshake': run_handshake}
+
+
+def load_worker(scenario, address, count, options, sender, barrier, results):
+    raise_fd_limit()
+    selector = selectors.DefaultSelector()
+    connections, connect_errors = open_connections(address, selector, count)
+    barrier.wait()
+    deadline = time.monotonic() + options['duration']
+    latencies, errors = scenarios[scenario](connections, selector, deadline, address=address,
+                                            sender=sender, **options)
+    results.put({'connections': len(connections), 'latencies': latencies,
+                 'errors': connect_errors + errors})
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))]
+
+
+def run(scenario, connections=2000, processes=None, duration=10, size=64, rate=10, port=9400):
+    """Runs one scenario against a fresh server
+    :return: Dictionary of the results
+    """
+    if processes is None:
+        processes = max(1, min(8, (os.cpu_count() or 2) - 1))
+    processes = min(processes, connections)
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(target=serve, args=(scenario, port, ready), daemon=True)
+    server.start()
+    if not ready.wait(10):
+        server.terminate()
+        raise RuntimeError('The server did not start')
+
+    options = {'duration': duration, 'size': size, 'rate': rate}
+    barrier = multiprocessing.Barrier(processes + 1)
+    results = multiprocessing.Queue()
+    workers = []
+    for i in range(processes):
+        count = connections // processes + (i < connections % processes)
+        worker = multiprocessing.Process(target=load_worker,
+                                         args=(scenario, ('127.0.0.1', port), count, options, i == 0,
+                                               barrier, results),
+                                         daemon=True)
+        worker.start()
+        workers.append(worker)
+    try:
+        barrier.wait(timeout=60 + connections / 100)
+        start = time.monotonic()
+        reports = [results.get(timeout=duration + 60) for _ in workers]
+        elapsed = time.monotonic() - start
+    finally:
+        for process in workers + [server]:
+            process.terminate()
+
+    latencies = sorted(latency for report in reports for latency in report['latencies'])
+    return {'connections': sum(report['connections'] for report in reports),
+            'processes': processes,
+            'duration': elapsed,
+            'payload_size': size,
+            'messages': len(latencies),
+            'messages_per_second': len(latencies) / elapsed,
+            'errors': sum(report['errors'] for report in reports),
+            'latency_ms': {name: None if value is None else value * 1000
+                           for name, value in (('p50', percentile(latencies, 0.5)),
+                                               ('p99', percentile(latencies, 0.99)),
+                                               ('p999', percentile(latencies, 0.999)),
+                                               ('max', latencies[-1] if latencies else None))}}
+
+
+def main():
+    arguments = argparse.ArgumentParser(description='Loopback load generator for ewebsockets.Websocket')
+    arguments.add_argument('--scenario', choices=sorted(scenarios) + ['all'], default='all')
+    arguments.add_argument('--connections', type=int, default=2000)
+    arguments.add_argument('--processes', type=int, help='Client processes, defaults to the cores but one')
+    arguments.add_argument('--duration', type=float, default=10, help='Seconds per scenario')
+    arguments.add_argument('--size', type=int, default=64, help='Payload bytes, at least 8')
+    arguments.add_argument('--rate', type=float, default=10, help='Broadcasts per second')
+    arguments.add_argument('--port', type=int, default=9400)
+    arguments.add_argument('--json', metavar='PATH', help='Write the results as JSON, - for stdout')
+    options = arguments.parse_args()
+
+    results = {}
+    for scenario in sorted(scenarios) if options.scenario == 'all' else [options.scenario]:
+        result = results[scenario] = run(scenario, options.connections, options.processes, options.duration,
+                                         options.size, options.rate, options.port)
+        options.port += 1  # The previous server socket may linger in TIME_WAIT
+        if options.json != '-':
+            latencies = result['latency_ms']
+            print('{:<10} {:>6} connections {:>10.0f} msg/s  p50 {} p99 {} p999 {} ms  {} errors'.format(
+                scenario, result['connections'], result['messages_per_second'],
+                *['{:.2f}'.format(latencies[name]) if latencies[name] is not None else '-'
+                  for name in ('p50', 'p99', 'p999')], result['errors']))
+    if options.json:
+        write('load', results, None if options.json == '-' else options.json)
+
+
+if __name__ == '__main__':
+    main()
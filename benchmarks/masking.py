@@ -0,0 +1,44 @@
+#!/bin/env python3
+"""
+Masking throughput in MB/s, the original per byte loop against
+ewebsockets.masking. Run with: python3 -m benchmarks.masking
+"""
+import os
+import timeit
+from ewebsockets import masking
+
+
+def per_byte_masking(data, key):
+    length = len(data)
+    result = bytearray(length)
+    for i in range(length):
+        result[i] = data[i] ^ key[i % 4]
+    return bytes(result)
+
+
+def throughput(function, size, min_time=0.2):
+    number, elapsed = timeit.Timer(function).autorange()
+    while elapsed < min_time:
+        number *= 2
+        elapsed = timeit.Timer(function).timeit(number)
+    return size * number / elapsed / 2**20
+
+
+def main(sizes=(125, 1024, 16384, 65536, 1048576)):
+    key = os.urandom(4)
+    print('numpy: {}'.format('available' if masking.numpy is not None else 'not installed'))
+    print('{:>10} {:>14} {:>14} {:>14}'.format('size', 'per byte', 'masking_alg', 'unmask_inplace'))
+    for size in sizes:
+        data = os.urandom(size)
+        buffer = bytearray(data)
+        assert masking.masking_algorithm(data, key) == per_byte_masking(data, key)
+        results = [
+            throughput(lambda: per_byte_masking(data, key), size) if size <= 65536 else float('nan'),
+            throughput(lambda: masking.masking_algorithm(data, key), size),
+            throughput(lambda: masking.unmask_inplace(buffer, key), size),
+        ]
+        print('{:>10} {:>11.1f} MB/s {:>9.1f} MB/s {:>9.1f} MB/s'.format(size, *results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+#!/bin/env python3
+"""
+Memory per idle connection. Clients are accepted by a Websocket, complete
+the opening handshake and then stay connected without sending anything,
+as most connections of a large server do. Traced with tracemalloc, the
+sockets themselves are stand-ins so only what the server keeps per
+connection is counted.
+Run with: python3 -m benchmarks.memory [--json results.json]
+"""
+import argparse
+import gc
+import sys
+import tracemalloc
+import ewebsockets
+from .broadcast import NullSocket
+from .handshake import REQUEST
+from .results import write
+
+
+class IdleSocket(NullSocket):
+    """Socket stand-in that delivers the upgrade request once"""
+    __slots__ = ('fd', 'data')
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.data = REQUEST
+
+    def fileno(self):
+        return self.fd
+
+    def recv(self, size):
+        data, self.data = self.data, b''
+        if not data:
+            raise BlockingIOError()
+        return data
+
+
+def per_connection(count, **kwargs):
+    """
+    :return: Bytes allocated per open idle connection
+    """
+    server = ewebsockets.Websocket(**kwargs)
+    sockets = [IdleSocket(fd) for fd in range(count)]
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for sock in sockets:
+        server._handle_incoming(sock, ('127.0.0.1', sock.fd))
+        server._handle_readable(sock)
+    gc.collect()
+    allocated = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    assert all(client.state == client.OPEN for client in server.clients_list())
+    return allocated / count
+
+
+def object_sizes():
+    client = ewebsockets.ClientSocket.Client(NullSocket(), ('127.0.0.1', 0))
+    frame = ewebsockets.Frame(payload=b'x', opcode=ewebsockets.OpCode.TEXT)
+    sizes = {}
+    for name, obj in (('Client', client), ('Frame', frame)):
+        size = sys.getsizeof(obj)
+        if hasattr(obj, '__dict__'):
+            size += sys.getsizeof(obj.__dict__)
+        sizes[name] = size
+    return sizes
+
+
+def main():
+    arguments = argparse.ArgumentParser(description='Memory per idle connection')
+    arguments.add_argument('--connections', type=int, default=20000)
+    arguments.add_argument('--json', metavar='PATH', help='Write the results as JSON, - for stdout')
+    options = arguments.parse_args()
+
+    results = {'bytes_per_connection': per_connection(options.connections),
+               'bytes_per_connection_no_heartbeat': per_connection(options.connections, ping_interval=None),
+               'object_bytes': object_sizes()}
+    if options.json != '-':
+        print('{:<40} {:>8.0f} bytes'.format('idle connection', results['bytes_per_connection']))
+        print('{:<40} {:>8.0f} bytes'.format('idle connection, no heartbeat',
+                                            results['bytes_per_connection_no_heartbeat']))
+        for name, size in results['object_bytes'].items():
+            print('{:<40} {:>8} bytes'.format(name + ' instance', size))
+    if options.json:
+        write('memory', results, None if options.json == '-' else options.json)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+#!/bin/env python3
+"""
+Sending an object to many clients, encoding it for every recipient with
+send_json against encoding it once with broadcast_message, and what
+decoding received messages costs when handlers do or do not look at
+frame.message, and parsing received frames with and without zero_copy.
+Run with: python3 -m benchmarks.messages
+"""
+import os
+import ewebsockets
+from ewebsockets.ClientSocket import Client
+from .broadcast import NullSocket, best_of
+
+OBJECT = {'type': 'update', 'id': 1234, 'values': list(range(20)), 'text': 'x' * 100}
+
+
+def receive(frames, touch):
+    total = 0
+    for frame in frames:
+        frame.codec = ewebsockets.codecs.JSON  # As done by Client._handle_frame
+        total += len(frame.message['values']) if touch else len(frame.payload)
+    return total
+
+
+def parse(data, count, zero_copy):
+    parser = ewebsockets.FrameParser(zero_copy=zero_copy)
+    for _ in range(count):
+        parser.feed(data)
+        parser.next_frame()
+
+
+def main(recipients=10000, messages=10000, sizes=(125, 1024, 16384, 65536, 1048576)):
+    server = ewebsockets.Websocket()
+    clients = [Client(NullSocket(), ('127.0.0.1', i), state=Client.OPEN) for i in range(recipients)]
+
+    def per_client():
+        for client in clients:
+            client.send_json(OBJECT)
+
+    loop = best_of(per_client)
+    once = best_of(lambda: server.broadcast_message(OBJECT, clients=clients))
+    print('{} recipients'.format(recipients))
+    print('{:<32} {:>10.0f} msg/s'.format('send_json loop', recipients / loop))
+    print('{:<32} {:>10.0f} msg/s'.format('broadcast_message', recipients / once))
+
+    payload = ewebsockets.codecs.JSON.encode(OBJECT)
+    for touch in (False, True):
+        frames = [ewebsockets.Frame(payload=payload, opcode=ewebsockets.OpCode.TEXT) for _ in range(messages)]
+        elapsed = best_of(lambda: receive(frames, touch), repeat=1)
+        print('{:<32} {:>10.0f} msg/s'.format('frame.message' if touch else 'routing by len(payload)',
+                                             messages / elapsed))
+
+    print('{:>8} {:>18} {:>18}'.format('size', 'FrameParser', 'zero_copy'))
+    for size in sizes:
+        frame = ewebsockets.Frame(payload=os.urandom(size), opcode=ewebsockets.OpCode.BINARY, mask=1)
+        frame.update_masking()
+        data = frame.pack()
+        count = max(10, 2**24 // size)
+        copy, zero_copy = (best_of(lambda: parse(data, count, zero_copy)) for zero_copy in (False, True))
+        print('{:>8} {:>12.0f} msg/s {:>12.0f} msg/s'.format(size, count / copy, count / zero_copy))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+#!/bin/env python3
+"""
+Cost of the metrics. Frames per second through Websocket._handle_readable
+with the handler latency histogram on and off, and the time to collect and
+render the stats of many clients.
+Run with: python3 -m benchmarks.metrics
+"""
+import time
+import ewebsockets
+from ewebsockets.ClientSocket import Client
+from ewebsockets.metrics import exposition
+from .broadcast import NullSocket
+
+
+class ReplaySocket(NullSocket):
+    """Returns the same received data on every recv_into"""
+    def __init__(self, data):
+        self.data = data
+
+    def recv_into(self, buffer):
+        buffer[:len(self.data)] = self.data
+        return len(self.data)
+
+
+def frames_per_second(metrics, frames=256, rounds=400):
+    data = ewebsockets.Frame(payload=b'x' * 32, opcode=ewebsockets.OpCode.TEXT, mask=1).pack() * frames
+    server = ewebsockets.Websocket(metrics=metrics)
+    sock = ReplaySocket(data)
+    server.clients[sock.fileno()] = Client(sock, ('127.0.0.1', 0), state=Client.OPEN)
+    best = float('inf')
+    for _ in range(5):
+        start = time.perf_counter()
+        for _ in range(rounds):
+            server._handle_readable(sock)
+        best = min(best, time.perf_counter() - start)
+    return frames * rounds / best
+
+
+def collect_time(clients=10000):
+    server = ewebsockets.Websocket()
+    for i in range(clients):
+        client = Client(NullSocket(), ('127.0.0.1', i), state=Client.OPEN)
+        client.frames_in[1] = 10
+        client.frames_in[9] = 1
+        client.bytes_in[1] = 1000
+        client.bytes_in[9] = 8
+        server.clients[i] = client
+    start = time.perf_counter()
+    stats = server.stats()
+    collected = time.perf_counter() - start
+    start = time.perf_counter()
+    exposition(stats)
+    return collected, time.perf_counter() - start
+
+
+def main():
+    off = frames_per_second(False)
+    on = frames_per_second(True)
+    print('{:<32} {:>10.0f} frames/s'.format('handler histogram off', off))
+    print('{:<32} {:>10.0f} frames/s ({:+.1f}%)'.format('handler histogram on', on, (on / off - 1) * 100))
+    collected, rendered = collect_time()
+    print('{:<32} {:>10.2f} ms'.format('stats() with 10000 clients', collected * 1000))
+    print('{:<32} {:>10.2f} ms'.format('exposition', rendered * 1000))
+
+
+if __name__ == '__main__':
+    main()
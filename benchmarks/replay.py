@@ -0,0 +1,57 @@
+#!/bin/env python3
+"""
+Replays a traffic capture (ewebsockets.capture) against a fresh Websocket
+in its own process, at the recorded pace or as fast as possible, and
+reports the frames per second and the time it took. Record one with
+Websocket(recorder=capture.Recorder(path)).
+Run with: python3 -m benchmarks.replay capture.log [capture.log.1 ...] [--speed max] [--json results.json]
+"""
+import argparse
+import multiprocessing
+from ewebsockets.capture import Replayer
+from .load import raise_fd_limit, serve
+from .results import write
+
+
+def run(paths, speed=None, port=9500):
+    """
+    :param speed: Multiple of the recorded pace, None for as fast as possible
+    :return: Dictionary of the results
+    """
+    raise_fd_limit()
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(target=serve, args=('echo', port, ready), daemon=True)
+    server.start()
+    if not ready.wait(10):
+        server.terminate()
+        raise RuntimeError('The server did not start')
+    replayer = Replayer(paths)
+    try:
+        stats = replayer.replay('ws://127.0.0.1:{}/'.format(port), speed)
+    finally:
+        replayer.close()
+        server.terminate()
+    stats['speed'] = 'max' if speed is None else speed
+    stats['frames_per_second'] = stats['frames'] / stats['seconds'] if stats['seconds'] else None
+    return stats
+
+
+def main():
+    arguments = argparse.ArgumentParser(description='Replays a capture against ewebsockets.Websocket')
+    arguments.add_argument('paths', nargs='+', help='Files of one recording, oldest first')
+    arguments.add_argument('--speed', default='1', help='Multiple of the recorded pace or max')
+    arguments.add_argument('--port', type=int, default=9500)
+    arguments.add_argument('--json', metavar='PATH', help='Write the results as JSON, - for stdout')
+    options = arguments.parse_args()
+
+    result = run(options.paths, None if options.speed == 'max' else float(options.speed), options.port)
+    if options.json != '-':
+        print('{} connections {} frames {} bytes in {:.2f} s, {:.0f} frames/s, {} responses, {} errors'.format(
+            result['connections'], result['frames'], result['bytes'], result['seconds'],
+            result['frames_per_second'] or 0, result['responses'], result['errors']))
+    if options.json:
+        write('replay', result, None if options.json == '-' else options.json)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+#!/bin/env python3
+"""
+JSON results of the benchmarks. Each result file records the environment
+it was measured in next to the numbers, so runs of two commits can be
+compared with: python3 -m benchmarks.results before.json after.json
+"""
+import json
+import platform
+import subprocess
+import sys
+import time
+import ewebsockets
+from ewebsockets import masking
+
+
+def environment():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'commit': commit,
+            'version': ewebsockets.__version__.strip(),
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'numpy': masking.numpy is not None}
+
+
+def write(benchmark, results, path=None):
+    """Writes {'benchmark', 'environment', 'results'} as JSON to path, stdout if None"""
+    document = {'benchmark': benchmark, 'environment': environment(), 'results': results}
+    if path is None:
+        json.dump(document, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        with open(path, 'w') as w:
+            json.dump(document, w, indent=2, sort_keys=True)
+
+
+def _flatten(value, prefix=''):
+    if isinstance(value, dict):
+        for key, item in value.items():
+            yield from _flatten(item, '{}{}{}'.format(prefix, '/' if prefix else '', key))
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        yield prefix, value
+
+
+def compare(before, after):
+    """
+    :return: [(name, before, after, relative change)] for every number present in both
+    """
+    old = dict(_flatten(before['results']))
+    rows = []
+    for name, value in _flatten(after['results']):
+        if name in old:
+            change = value / old[name] - 1 if old[name] else float('nan')
+            rows.append((name, old[name], value, change))
+    return sorted(rows)
+
+
+def main():
+    if len(sys.argv) != 3:
+        sys.exit('Usage: python3 -m benchmarks.results before.json after.json')
+    documents = []
+    for path in sys.argv[1:]:
+        with open(path) as r:
+            documents.append(json.load(r))
+    for document in documents:
+        environment = document['environment']
+        print('{}: {} at {} ({} {})'.format(document['benchmark'], environment['commit'], environment['time'],
+                                           environment['implementation'], environment['python']))
+    for name, old, new, change in compare(*documents):
+        print('{:<60} {:>14.6g} {:>14.6g} {:>+8.1%}'.format(name, old, new, change))
+
+
+if __name__ == '__main__':
+    main()
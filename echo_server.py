@@ -1,7 +1,6 @@
 #!/bin/env python3
 import ewebsockets
 import logging, sys
-from websocket import create_connection
 
 root = logging.getLogger()
 root.setLevel(logging.DEBUG)
@@ -14,17 +13,14 @@ root.addHandler(ch)
 
 
 def handle_websocket_frame(client, frame):
-    frame.mask = 0
     print(client.address, ': ', frame.payload, ' Opcode: ', ewebsockets.OpCode.opcodes[frame.opcode])
-    frame.payload = b'SERVER: ' + frame.payload
     if frame.opcode == ewebsockets.OpCode.TEXT:
-        for i in server.clients_list():
-            i.send_frame(frame)
+        server.broadcast(b'SERVER: ' + frame.payload, ewebsockets.OpCode.TEXT)
     return True
 
 
 def handle_new_connection(client):
-    print('Client connected')
+    print('Client connected: ', client.request.path, client.request.origin)
     return True
 
 def on_client_open(client):
@@ -43,6 +39,6 @@ server = ewebsockets.Websocket(
 
 server.start()
 print(server.server.host + ':' + str(server.server.port))
-client = create_connection('ws://' + server.server.host + ':' + str(server.server.port))
-client.send('hello\n', 1)
+client = ewebsockets.connect('ws://' + server.server.host + ':' + str(server.server.port))
+client.send_text('hello\n')
 
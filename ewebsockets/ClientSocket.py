@@ -1,12 +1,111 @@
 #!/bin/env python3
 
 from threading import Lock, Event
+from collections import deque
+from itertools import islice
+from time import monotonic
 from .exceptions import *
 from .RFC6455 import *
 import logging
-from json import JSONEncoder
+import mmap
+import socket
+import struct
+import os
+from .codecs import JSON
+from .permessage_deflate import compress_shared
+from .handshake import HandshakeParser, pack_response, FORBIDDEN
+from . import tracing
+from .tracing import monotonic_ns
+
+_sendfile = hasattr(os, 'sendfile')
+
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+# Guards the lazy creation of the send locks
+_create_lock = Lock()
+
+
+class _OpenFile:
+    """A file descriptor of send_file, closed once the last region sending from it is gone"""
+    __slots__ = ('fd', 'size')
+
+    def __init__(self, file):
+        """
+        :param file: Path, file descriptor or object with a fileno method. Descriptors
+        are duplicated, the caller may close its own once send_file returns.
+        """
+        self.fd = None
+        if type(file) == int:
+            self.fd = os.dup(file)
+        elif hasattr(file, 'fileno'):
+            self.fd = os.dup(file.fileno())
+        else:
+            self.fd = os.open(file, os.O_RDONLY)
+        self.size = os.fstat(self.fd).st_size
+
+    def __del__(self):
+        if self.fd is not None:
+            os.close(self.fd)
+
+    def span(self, offset, length):
+        """
+        :return: The end of the span of length bytes (up to the end of the file if None) at offset
+        """
+        end = self.size if length is None else offset + length
+        if offset < 0 or end < offset or end > self.size:
+            raise ValueError('{} bytes at offset {} are not within the file of {} bytes'.format(
+                end - offset, offset, self.size))
+        return end
+
+    def map(self, offset, end):
+        """
+        :return: A memoryview of the bytes from offset to end, read from a memory mapping
+        """
+        if end == offset:
+            return b''
+        start = offset - offset % mmap.ALLOCATIONGRANULARITY
+        data = mmap.mmap(self.fd, end - start, access=mmap.ACCESS_READ, offset=start)
+        # The mapping is closed once the view and its slices are gone
+        return memoryview(data)[offset-start:]
+
+
+class _FileRegion:
+    """Part of a file in the send queue, sent with os.sendfile"""
+    __slots__ = ('file', 'offset', 'end')
+
+    def __init__(self, file, offset, end):
+        self.file = file
+        self.offset = offset
+        self.end = end
+
+    def __len__(self):
+        return self.end - self.offset
+
+    def send(self, sock):
+        sent = os.sendfile(sock.fileno(), self.file.fd, self.offset, self.end - self.offset)
+        if sent == 0:
+            raise ClientDisconnect('File truncated while being sent')
+        self.offset += sent
+        return sent
+
 
 class Client:
+    # No __dict__ per connection, subclasses should declare __slots__ too
+    __slots__ = ('socket', 'fd', 'state', 'address', 'close_frame_sent', 'close_frame_recd',
+                 '_send_lock', '_close_event', 'handshake_parser', 'request', 'subprotocol',
+                 'connected_at', 'last_seen', 'last_message', 'ping_sent', 'rtt', '_ping_payload',
+                 'close_code', 'frames_in', 'bytes_in', 'frames_out', 'bytes_out',
+                 'stream_messages', 'max_message_size', '_assembler', 'parser',
+                 'permessage_deflate', 'deflate', 'codec', 'send_queue', 'send_queue_bytes',
+                 'high_watermark', 'low_watermark', 'max_send_queue', 'overflow_timeout',
+                 'overflow_policy', 'backpressure_since', '_pending_write', '_sendmsg', '_regions',
+                 'on_open', 'on_close', 'on_request', 'on_backpressure', 'on_drain',
+                 'on_pending_write', 'on_closing', 'rate_buckets', 'recorder', 'sessions', 'session',
+                 '__weakref__')
+
     CONNECTING = 0
     OPEN = 1
     CLOSING = 2
@@ -17,64 +116,412 @@ class Client:
                CLOSING: 'Closing',
                CLOSED: 'Closed'}
 
+    # Send queue overflow policies
+    DROP = 'drop'
+    DISCONNECT = 'disconnect'
+
     def __init__(self, sock, address,
                  on_open=lambda client: True,
                  on_close=lambda client: True,
-                 state=0):
+                 on_request=lambda client: True,
+                 state=0,
+                 zero_copy=False,
+                 permessage_deflate=None,
+                 max_message_size=16777216,
+                 stream_messages=False,
+                 max_handshake_size=8192,
+                 codec=JSON,
+                 high_watermark=1048576,
+                 low_watermark=262144,
+                 max_send_queue=None,
+                 overflow_timeout=None,
+                 overflow_policy=DISCONNECT,
+                 on_backpressure=lambda client: True,
+                 on_drain=lambda client: True,
+                 on_pending_write=lambda client: True,
+                 on_closing=lambda client, timeout: True,
+                 sessions=None):
+        """
+        :param on_request: Called once the upgrade request is parsed into client.request,
+        return False to refuse it. client.subprotocol may be set to one of
+        client.request.subprotocols to accept it.
+        :param permessage_deflate: PerMessageDeflate settings, None to decline compression
+        :param max_message_size: Largest message (and frame) in bytes a client may send,
+        larger ones raise MessageTooBig. None for no limit
+        :param stream_messages: Return every fragment of a fragmented message from
+        recv_frames, with the opcode of the message and fin set on the last one,
+        instead of assembling the message
+        :param max_handshake_size: Largest upgrade request in bytes
+        :param codec: codecs.Codec of send_message and of frame.message for received frames
+        :param high_watermark: Queued bytes above which on_backpressure is called
+        :param low_watermark: Queued bytes below which on_drain is called after backpressure
+        :param max_send_queue: Queued bytes the client may never exceed (None for no limit)
+        :param overflow_timeout: Seconds the client may stay above high_watermark (None for no limit)
+        :param overflow_policy: Client.DROP drops messages that would exceed the limits,
+        Client.DISCONNECT disconnects the client
+        :param on_pending_write: Called when data is left in the send queue and the
+        socket has to be watched for writability, the server then calls flush
+        :param on_closing: Called as on_closing(client, timeout) when close sent a close frame
+        and waits for the answer, the server then disconnects the client if it has not
+        answered within timeout seconds
+        :param sessions: sessions.SessionTable to give the client a session, resumed if the
+        upgrade request names one
+        """
 
         self.socket = sock
+        self.fd = None if sock is None else sock.fileno()
 
         self.state = state
         self.address = address
         self.close_frame_sent = False
         self.close_frame_recd = False
-        self.send_lock = Lock()
-        self.close_lock = Event()
-        self.unfinished_frame = None
+        # Created on first use, an Event alone is over a kilobyte
+        self._send_lock = None
+        self._close_event = None
+        self.handshake_parser = HandshakeParser(max_handshake_size)
+        self.request = None  # handshake.Request once the upgrade request is parsed
+        self.subprotocol = None
+        self.connected_at = monotonic()
+        self.last_seen = self.last_message = self.connected_at  # Last frame and last text/binary frame
+        self.ping_sent = None  # Time of the ping waiting for its pong
+        self.rtt = None  # Seconds between the last answered ping and its pong
+        self._ping_payload = None
+        self.close_code = None  # First close code sent or received
+
+        # Counts indexed by opcode for metrics, bytes_in counts payloads and bytes_out whole
+        # frames. One slot per opcode, so collecting them never races with a key being added.
+        self.frames_in = [0] * 16
+        self.bytes_in = [0] * 16
+        self.frames_out = [0] * 16
+        self.bytes_out = [0] * 16
+
+        self.stream_messages = stream_messages
+        self.max_message_size = max_message_size
+        self._assembler = None
+        self.parser = FrameParser(zero_copy, max_message_size)
+        self.permessage_deflate = permessage_deflate
+        self.deflate = None  # DeflateContext once negotiated
+        self.codec = codec
+
+        self.send_queue = None  # deque, only while something is queued
+        self.send_queue_bytes = 0
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.max_send_queue = max_send_queue
+        self.overflow_timeout = overflow_timeout
+        self.overflow_policy = overflow_policy
+        self.backpressure_since = None
+        self._pending_write = False
+        self._sendmsg = True
+        self._regions = 0  # _FileRegions in the send queue
+        self.rate_buckets = None  # (messages, bytes) ratelimit.TokenBuckets, set by the server
+        self.recorder = None  # Records the frames sent and received, see capture.Recorder.tap
+        self.sessions = sessions
+        self.session = None  # sessions.Session once the upgrade request is accepted
 
         self.on_open = on_open
         self.on_close = on_close
+        self.on_request = on_request
+        self.on_backpressure = on_backpressure
+        self.on_drain = on_drain
+        self.on_pending_write = on_pending_write
+        self.on_closing = on_closing
+
+    @property
+    def send_lock(self):
+        lock = self._send_lock
+        if lock is None:
+            with _create_lock:
+                if self._send_lock is None:
+                    self._send_lock = Lock()
+                lock = self._send_lock
+        return lock
+
+    @property
+    def assembler(self):
+        """MessageAssembler, created once a fragmented message arrives"""
+        if self._assembler is None:
+            self._assembler = MessageAssembler(self.max_message_size)
+        return self._assembler
 
     def send_raw(self, msg, timeout=-1):
-        total_sent = 0
-        msg_len = len(msg)
-        if self.send_lock.acquire(timeout=timeout):
+        """Puts msg in the send queue and sends as much of the queue as the socket
+        accepts without blocking, the rest is sent by flush once the socket is writable.
+        :return: Number of bytes queued, 0 if the send lock was not acquired, the message was
+        dropped or msg is empty
+        """
+        return self.send_buffers((msg,), timeout)
+
+    def send_buffers(self, buffers, timeout=-1):
+        """Like send_raw but for a message split over several buffers, e.g. the
+        (header, payload) of Frame.pack_parts. The buffers are queued as they
+        are and written with a single sendmsg call, never joined.
+        """
+        if not all(buffers):
+            # The first buffer queued is taken to start a frame
+            buffers = [buffer for buffer in buffers if buffer]
+            if not buffers:
+                return 0
+        return self._send(timeout, buffers)
+
+    def _send(self, timeout, buffers=None, frame=None, regions=0, busy=0):
+        """
+        :param regions: Number of _FileRegions among the buffers
+        :param busy: Returned if the send lock was not acquired within timeout,
+        e.g. None to tell it apart from a dropped message
+        """
+        active = tracing.tracer
+        sending = monotonic_ns() if active is not None and active.sample_sent() else None
+        if not self.send_lock.acquire(timeout=timeout):
+            return busy
+        try:
+            queued = self._queue(buffers, frame, regions, sending is not None)
+        except (ClientDisconnect, OSError) as e:
+            # Tells a handler sending to other clients which connection failed
+            e.client = self
+            raise
+        finally:
+            self.send_lock.release()
+        if queued is None:
+            return 0
+
+        msg_len, pending_write, event = queued
+        self._notify(pending_write, event)
+        if sending is not None:
+            tracing.add('send_raw', sending, None, {'bytes': msg_len})
+        return msg_len
+
+    def _queue(self, buffers=None, frame=None, regions=0, traced=False, record=True):
+        """Must be called with the send lock held
+        :param record: False for frames the session already holds, e.g. when they are replayed
+        :return: (bytes queued, pending_write, event) as _flush, None if the message was dropped
+        """
+        if frame is not None:
+            # Packed with the lock held so the compressor sees messages in wire order
+            if not traced:
+                buffers = self._pack(frame)
+            else:
+                packing = monotonic_ns()
+                buffers = self._pack(frame)
+                tracing.add('Frame.pack', packing)
+        msg_len = sum(map(len, buffers))
+        if self._overflows(msg_len):
+            if self.overflow_policy == Client.DROP:
+                logging.debug('{}: Send queue full, message dropped'.format(self.address))
+                return None
+            self.abort()
+            raise ClientDisconnect('Send queue limit exceeded')
+        if self.recorder is not None and self.state != Client.CONNECTING:
+            if frame is not None:
+                self.recorder.sent(frame.opcode[0], frame.payload)
+            else:
+                self.recorder.sent_packed(buffers)
+        if record and self.session is not None and self.state == Client.OPEN:
+            if frame is not None:
+                self.session.sent(frame)
+            else:
+                self.session.sent_packed(buffers)
+
+        if self.send_queue is None:
+            self.send_queue = deque(buffers)
+        else:
+            self.send_queue.extend(buffers)
+        self._regions += regions
+        self.send_queue_bytes += msg_len
+        self._count_sent(buffers, msg_len)
+        return (msg_len,) + self._flush()
+
+    def _count_sent(self, buffers, msg_len):
+        if self.state != Client.CONNECTING:
+            # Everything sent once open is a frame, its opcode is in the first byte
+            opcode = buffers[0][0] & 0b00001111
+            self.frames_out[opcode] += 1
+            self.bytes_out[opcode] += msg_len
+
+    def _pack(self, frame):
+        if self.deflate is not None and frame.fin and not frame.rsv[0] \
+                and (frame.opcode == OpCode.TEXT or frame.opcode == OpCode.BINARY) \
+                and self.deflate.should_compress(frame.payload):
+            frame = Frame(fin=frame.fin,
+                          rsv=(1, frame.rsv[1], frame.rsv[2]),
+                          opcode=frame.opcode,
+                          mask=frame.mask,
+                          payload=self.deflate.compress(frame.payload))
+        return frame.pack_parts()
+
+    def flush(self):
+        """Sends as much of the send queue as the socket accepts without blocking
+        :return: True if the send queue is empty
+        """
+        with self.send_lock:
+            self._pending_write = False
+            pending_write, event = self._flush()
+        self._notify(pending_write, event)
+        return not pending_write
+
+    def _overflows(self, msg_len):
+        if self.max_send_queue is not None and self.send_queue_bytes + msg_len > self.max_send_queue:
+            return True
+        if self.overflow_timeout is not None and self.backpressure_since is not None:
+            return monotonic() - self.backpressure_since > self.overflow_timeout
+        return False
+
+    def _flush(self):
+        """Must be called with the send lock held
+        :return: (pending_write, event) where event is the watermark callback to call
+        once the lock is released
+        """
+        queue = self.send_queue
+        # While a write is pending the socket is known to be full and is left
+        # to the flush thread
+        while queue and not self._pending_write:
+            head = queue[0]
+            if type(head) == _FileRegion:
+                try:
+                    sent = head.send(self.socket)
+                except BlockingIOError:
+                    break
+                self.send_queue_bytes -= sent
+                if head.offset < head.end:
+                    # The socket is full
+                    break
+                queue.popleft()
+                self._regions -= 1
+                continue
             try:
-                while total_sent < msg_len:
-                    sent = self.socket.send(msg[total_sent:])
-                    if sent == 0:
-                        raise ClientDisconnect("Socket connection broken")
-                    total_sent = total_sent + sent
-            finally:
-                self.send_lock.release()
-        return total_sent
+                if self._sendmsg and len(queue) > 1 and not self._regions:
+                    # Everything queued, up to IOV_MAX buffers, goes out in one call
+                    sent = self.socket.sendmsg(queue if len(queue) <= IOV_MAX else islice(queue, IOV_MAX))
+                else:
+                    sent = self.socket.send(head)
+            except BlockingIOError:
+                break
+            except (AttributeError, NotImplementedError):
+                # e.g. SSL sockets, fall back to one send call per buffer
+                self._sendmsg = False
+                continue
+            if sent == 0:
+                raise ClientDisconnect("Socket connection broken")
+            self.send_queue_bytes -= sent
 
-    def do_handshake(self):
+            while queue and sent >= len(queue[0]):
+                sent -= len(queue.popleft())
+            if sent:
+                # Partially sent buffer, continue from an offset without copying
+                queue[0] = memoryview(queue[0])[sent:]
+                break
+
+        if queue is not None and not queue:
+            # Most connections have nothing queued most of the time
+            self.send_queue = queue = None
+
+        event = None
+        if self.backpressure_since is None:
+            if self.send_queue_bytes > self.high_watermark:
+                self.backpressure_since = monotonic()
+                event = self.on_backpressure
+        elif self.send_queue_bytes <= self.low_watermark:
+            self.backpressure_since = None
+            event = self.on_drain
+
+        pending_write = False
+        if queue and not self._pending_write:
+            self._pending_write = pending_write = True
+        return pending_write, event
+
+    def _notify(self, pending_write, event):
+        if pending_write:
+            self.on_pending_write(self)
+        if event is not None:
+            event(self)
+
+    def abort(self):
+        """Shuts down the socket without a closing handshake, the server then
+        finds the client disconnected on its next read
         """
-        :return:True/False (Success/Failed handshake)
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def do_handshake(self):
+        """Reads the part of the opening handshake that has arrived and answers
+        it once complete. Frames sent right behind it are left in the parser.
+        :return: False if the connection should be closed, True otherwise
         """
-        client_handshake = self.recv(4096)
-        logging.debug('{}: Received handshake'.format(self.address))
         try:
-            response = pack_handshake(client_handshake)
-        except DataMissing:
-            logging.warning('{}: Received unaccepted handshake'.format(self.address))
+            data = self.socket.recv(4096)
+        except BlockingIOError:
+            return True
+        except OSError:
             return False
-        else:
-            total_sent = self.send_raw(response, timeout=10)
-            if total_sent == len(response):
+        if not data:
+            return False
+
+        try:
+            response = self.feed_handshake(data)
+        except HandshakeError as e:
+            logging.warning('{}: Handshake refused, {}'.format(self.address, e))
+            self.send_raw(e.response, timeout=10)
+            return False
+        if response is None:
+            return True
+
+        total_sent = self.send_raw(response, timeout=10)
+        if total_sent == len(response):
+            if self.sessions is None:
                 self.state = Client.OPEN
-                self.on_open(self)
-                logging.debug('{}: Handshake complete, client now in open state'.format(self.address))
-                return True
-            else:
-                logging.warning('{}: Handshake failed, {}/{} bytes of the response sent'.format(self.address,
-                                                                                                total_sent,
-                                                                                                len(response)))
+            elif not self.sessions.open(self):
                 return False
+            self.on_open(self)
+            logging.debug('{}: Handshake complete, client now in open state'.format(self.address))
+            return True
+        else:
+            logging.warning('{}: Handshake failed, {}/{} bytes of the response sent'.format(self.address,
+                                                                                            total_sent,
+                                                                                            len(response)))
+            return False
+
+    def feed_handshake(self, data):
+        """Feeds received data of the opening handshake to the handshake parser
+        :return: The response to send once the request is complete and accepted,
+        None while more data is needed
+        :raise HandshakeError: If the request is refused, with the response to send
+        """
+        request = self.handshake_parser.feed(data)
+        if request is None:
+            return None
+        logging.debug('{}: Received handshake'.format(self.address))
+        self.request = request
+        if not self.on_request(self):
+            raise HandshakeError('Connection refused', FORBIDDEN)
+        self.parser.feed(self.handshake_parser.remainder)
+        self.handshake_parser = None
+        return self.handshake_response(request)
+
+    def handshake_response(self, request):
+        """Negotiates extensions and packs the response to an upgrade request
+        :param request: handshake.Request
+        """
+        extensions = None
+        if self.permessage_deflate is not None and request.extensions:
+            negotiated = self.permessage_deflate.negotiate(request.extensions)
+            if negotiated:
+                extensions, self.deflate = negotiated
+        headers = None
+        if self.sessions is not None:
+            self.session = self.sessions.claim(self, request)
+            headers = {self.sessions.token_header: self.session.token}
+        return pack_response(request.key, extensions, self.subprotocol, headers)
 
     def send_frame(self, frame, timeout=-1):
-        return self.send_raw(frame.pack(), timeout)
+        return self._send(timeout, frame=frame)
+
+    def send_ping(self):
+        """Sends a ping, rtt is updated when the matching pong arrives"""
+        self.ping_sent = monotonic()
+        self._ping_payload = struct.pack('!d', self.ping_sent)
+        return self.send_frame(Frame(opcode=OpCode.PING, payload=self._ping_payload))
 
     def send_text(self, text, timeout=-1, mask=0):
         if type(text) == str:
@@ -93,8 +540,40 @@ class Client:
                       mask=mask)
         self.send_frame(frame, timeout)
 
+    def send_file(self, file, offset=0, length=None, timeout=-1, mask=0):
+        """Sends length bytes of file from offset as one binary frame without reading
+        the file into memory. Unmasked, uncompressed frames are streamed from the file
+        with os.sendfile, others are packed from a memory mapping of it. The frame is
+        queued with the send lock held, so no other frame is written in the middle of it.
+        :param file: Path, file descriptor or object with a fileno method
+        :param length: Bytes to send, None for up to the end of the file
+        :return: Number of bytes queued, 0 if the send lock was not acquired or the message was dropped
+        """
+        opened = _OpenFile(file)
+        end = opened.span(offset, length)
+        if not mask and self._can_sendfile(end - offset):
+            return self._send(timeout, (pack_header(OpCode.BINARY, end - offset),
+                                        _FileRegion(opened, offset, end)), regions=1)
+        return self.send_frame(Frame(payload=opened.map(offset, end),
+                                     opcode=OpCode.BINARY,
+                                     mask=mask), timeout)
+
+    def _can_sendfile(self, length):
+        """
+        :return: True if a binary frame of length bytes can be streamed with os.sendfile
+        """
+        return _sendfile and length > 0 and type(self.socket) == socket.socket \
+            and self.recorder is None \
+            and (self.deflate is None or length < self.deflate.min_size)
+
     def send_json(self, json_obj, timeout=-1, mask=0):
-        self.send_text(JSONEncoder().encode(json_obj), timeout, mask)
+        return self.send_text(JSON.encode(json_obj), timeout, mask)
+
+    def send_message(self, obj, timeout=-1, mask=0):
+        """Sends obj encoded by the codec of the client"""
+        return self.send_frame(Frame(payload=self.codec.encode(obj),
+                                     opcode=_opcode(self.codec),
+                                     mask=mask), timeout)
 
     def recv_all(self, size, chunk_size=2048):
         data = bytearray(size)
@@ -127,69 +606,288 @@ class Client:
         self._handle_frame(frame)
         return frame
 
+    def recv_frames(self, size=16384):
+        """Reads what the socket buffer holds with a single recv_into call
+        straight into the parser buffer and returns the frames that are now
+        complete. Incomplete data stays in the parser until the next call.
+        """
+        return self._recv_frames(size)[0]
+
+    def drain_frames(self, max_frames=None, size=16384):
+        """Reads until the socket buffer is empty, or until max_frames frames
+        have been received, yielding the frames completed by each read. With
+        zero_copy the frames of a read must be handled before the next is
+        requested, the next read may reuse their buffer.
+        """
+        count = 0
+        while True:
+            frames, drained = self._recv_frames(size)
+            count += len(frames)
+            yield frames
+            if drained or (max_frames is not None and count >= max_frames):
+                return
+
+    def _recv_frames(self, size):
+        """
+        :return: (complete frames, True if the socket buffer was emptied)
+        """
+        buffer = self.parser.get_buffer(size)
+        try:
+            nbytes = self.socket.recv_into(buffer)
+        except BlockingIOError:
+            # Frames may still be buffered, e.g. those that followed the handshake
+            nbytes = None
+        if nbytes == 0:
+            raise ClientDisconnect('Client disconnected while receiving message')
+
+        if nbytes:
+            self.parser.buffer_updated(nbytes)
+        frames = []
+        for frame in self.parser:
+            self._handle_frame(frame)
+            frames.append(frame)
+        # A read that did not fill the buffer got everything the socket had
+        return frames, nbytes is None or nbytes < len(buffer)
+
     def _handle_frame(self, frame):
-        if frame.fin == 0:
-            logging.debug('A frame that is not the final frame was received')
-            if frame.opcode != OpCode.CONTINUATION:
-                self.unfinished_frame = frame
-            else:
-                self._continuation_frame(frame)
-        else:
+        frame.codec = self.codec
+        self.last_seen = monotonic()
+        opcode = frame.opcode[0]
+        self.frames_in[opcode] += 1
+        self.bytes_in[opcode] += len(frame.payload)
+        if opcode <= 7:
+            self.last_message = self.last_seen
+
+        if frame.rsv[1] or frame.rsv[2] or (frame.rsv[0] and (
+                self.deflate is None or frame.opcode == OpCode.CONTINUATION or bytes2int(frame.opcode) > 7)):
+            raise FrameError('Reserved bits set without a negotiated extension')
 
-            if frame.opcode == OpCode.CONTINUATION:
-                self._continuation_frame(frame)
+        if frame.opcode == OpCode.CONTINUATION or not frame.fin:
+            if bytes2int(frame.opcode) > 7:
+                raise FrameError('Control frames must not be fragmented')
+            self._fragment(frame)
+        elif self._assembler is not None and self._assembler.opcode is not None \
+                and bytes2int(frame.opcode) <= 7:
+            raise FrameError('A new message was started before the previous one was finished')
 
-                if self.unfinished_frame.opcode != OpCode.CONTINUATION:
-                    self._handle_frame(self.unfinished_frame)
-                self.unfinished_frame = None
+        if frame.fin:
+            if frame.rsv[0]:
+                frame.payload = self.deflate.decompress(frame.payload)
+                frame.rsv = (0, 0, 0)
 
-            elif frame.opcode == OpCode.CLOSE:
-                print(frame.payload)
-                logging.debug(
-                    '{}: Close frame recd {} ({}) {}'.format(
-                        self.address, StatusCode.get_int(frame.payload[0:2]),
-                        StatusCode.status_codes[frame.payload[0:2]], frame.payload[2:].decode('utf-8'))
-                )
+            if self.recorder is not None:
+                self.recorder.received(frame.opcode[0], frame.payload)
+
+            if frame.opcode == OpCode.CLOSE:
+                if self.close_code is None and len(frame.payload) >= 2:
+                    self.close_code = StatusCode.get_int(frame.payload[0:2])
+                if logging.root.isEnabledFor(logging.DEBUG):
+                    logging.debug('{}: Close frame recd {} ({}) {}'.format(
+                        self.address, self.close_code,
+                        StatusCode.status_codes.get(frame.payload[0:2]), frame.payload[2:]))
                 self.close_frame_recd = True
-                self.close_lock.set()
-                self.close(status_code=frame.payload)
+                event = self._close_event
+                if event is not None:
+                    event.set()
+                self.close(status_code=frame.payload[0:2], timeout=0)
 
             elif frame.opcode == OpCode.PING:
                 pong_frame = Frame(opcode=OpCode.PONG,
                                    payload=frame.payload)
                 self.send_frame(pong_frame, 10)
 
-    def _continuation_frame(self, frame):
-        if self.unfinished_frame is not None:
-            self.unfinished_frame.payload += frame.payload
+            elif frame.opcode == OpCode.PONG:
+                if self.ping_sent is not None and frame.payload == self._ping_payload:
+                    self.rtt = self.last_seen - self.ping_sent
+                    self.ping_sent = None
+
+    def _fragment(self, frame):
+        """Adds a fragment to the message being assembled. The final fragment is
+        given the opcode, rsv and payload of the whole message. With
+        stream_messages each fragment keeps its own (inflated) payload instead.
+        """
+        assembler = self.assembler
+        keep = not self.stream_messages
+        if frame.opcode != OpCode.CONTINUATION:
+            assembler.start(frame, keep)
+        elif frame.fin and keep:
+            opcode, rsv = assembler.opcode, assembler.rsv
+            frame.payload = assembler.finish(frame.payload)
+            frame.opcode, frame.rsv = opcode, rsv
         else:
-            logging.warning('{}: A continuation frame was received without getting the first frame.'.format(self.address))
+            assembler.add(frame.payload, keep)
+
+        if not keep:
+            frame.opcode = assembler.opcode
+            if assembler.rsv[0]:
+                frame.payload = self.deflate.decompress(frame.payload, frame.fin)
+            frame.rsv = (0, 0, 0)
+            if frame.fin:
+                assembler.reset()
 
     def close(self, status_code=StatusCode.NORMAL_CLOSE, reason=b'', timeout=3):
+        """Sends a close frame, the client is closed once the peer answers with its
+        own or after timeout seconds (see on_closing). Never blocks, wait_closed
+        waits for the answer.
+        :param timeout: 0 closes the client right away without waiting for the answer
+        """
+        if self.state == Client.CLOSED:
+            return
         if type(reason) == str:
             reason = reason.encode()
         self.state = Client.CLOSING
-        if not self.close_frame_sent:
+        closing = not self.close_frame_sent
+        if closing:
             frame = Frame(opcode=OpCode.CLOSE,
                           payload=status_code + reason)
             self.send_frame(frame)
             self.close_frame_sent = True
-            logging.debug('{}: Close frame sent {} ({}) {}'.format(
-                self.address, StatusCode.get_int(status_code),
-                StatusCode.status_codes[status_code], reason
-            ))
+            if self.close_code is None and len(status_code) == 2:
+                self.close_code = StatusCode.get_int(status_code)
+            if logging.root.isEnabledFor(logging.DEBUG):
+                logging.debug('{}: Close frame sent {} ({}) {}'.format(
+                    self.address, bytes2int(status_code),
+                    StatusCode.status_codes.get(status_code), reason
+                ))
 
-        self.close_lock.wait(timeout=timeout)
-        self.close_lock.clear()
+        if self.close_frame_recd or timeout <= 0:
+            self.set_closed()
+        elif closing:
+            self.on_closing(self, timeout)
 
-        # logging.debug('Closing connection: {}'.format(self.address))
-        # self.socket.shutdown(socket.SHUT_RDWR)
-        # self.socket.close()
-        self.state = Client.CLOSED
-        self.on_close(self)
+    def set_closed(self):
+        """Sets the client closed, on_close is called once unless it never opened
+        :return: False if it was closed already
+        """
+        with self.send_lock:
+            previous_state = self.state
+            self.state = Client.CLOSED
+        if previous_state == Client.CLOSED:
+            return False
+        if previous_state != Client.CONNECTING:
+            self.on_close(self)
+        return True
+
+    def wait_closed(self, timeout=None):
+        """Blocks until the peer answered the close frame
+        :return: True if it has, False after timeout seconds
+        """
+        if not self.close_frame_recd:
+            # close_frame_recd is checked again once the event is in place, the
+            # receiving thread sets the flag before it looks for the event
+            event = self._close_event = Event()
+            if not self.close_frame_recd:
+                event.wait(timeout=timeout)
+            self._close_event = None
+        return self.close_frame_recd
 
     def get_state(self):
         return self._states[self.state]
 
 
+def _opcode(codec):
+    return OpCode.BINARY if codec.binary else OpCode.TEXT
+
+
+def broadcast_message(clients, obj, timeout=-1):
+    """Encodes obj once per codec in use by the clients and broadcasts the
+    result to the clients of that codec
+    :return: Dictionary {client: exception} of the recipients that failed
+    """
+    by_codec = {}
+    for client in clients:
+        by_codec.setdefault(client.codec, []).append(client)
+    failed = {}
+    for codec, recipients in by_codec.items():
+        failed.update(broadcast(recipients, codec.encode(obj), _opcode(codec), timeout))
+    return failed
+
+
+def broadcast(clients, payload, opcode=OpCode.TEXT, timeout=-1):
+    """Packs the frame once and sends the same bytes to every client. Clients
+    that are busy sending are skipped and retried once the rest are served so
+    one slow client does not hold up the others. With permessage-deflate the
+    message is compressed once per set of clients negotiated without context
+    takeover, clients with context takeover have it compressed by their own compressor.
+    :return: Dictionary {client: exception} of the recipients that failed
+    """
+    if type(payload) == str:
+        payload = payload.encode()
+    frame = Frame(payload=payload, opcode=opcode)
+    parts = frame.pack_parts()
+    compressed = {}  # DeflateContext.shared_key: packed compressed frame
+
+    def send(client, timeout):
+        deflate = client.deflate
+        if deflate is None or not deflate.should_compress(payload):
+            return client._send(timeout, parts, busy=None)
+        if deflate.shared_key is None or client.session is not None:
+            # Sessions keep the uncompressed message
+            return client._send(timeout, frame=frame, busy=None)
+        if deflate.shared_key not in compressed:
+            compressed[deflate.shared_key] = Frame(payload=compress_shared(payload, deflate.shared_key),
+                                                   opcode=opcode,
+                                                   rsv=(1, 0, 0)).pack_parts()
+        return client._send(timeout, compressed[deflate.shared_key], busy=None)
+
+    return _send_all(clients, send, timeout)
+
+
+def broadcast_file(clients, file, offset=0, length=None, timeout=-1):
+    """Sends length bytes of file from offset as one binary frame to every client,
+    see Client.send_file. The file is opened and its frame header packed once,
+    clients that cannot stream it with os.sendfile get the frame broadcast from
+    a single memory mapping.
+    :return: Dictionary {client: exception} of the recipients that failed
+    """
+    opened = _OpenFile(file)
+    end = opened.span(offset, length)
+    header = pack_header(OpCode.BINARY, end - offset)
+    streamed = []
+    mapped = []
+    for client in clients:
+        (streamed if client._can_sendfile(end - offset) else mapped).append(client)
+
+    def send(client, timeout):
+        return client._send(timeout, (header, _FileRegion(opened, offset, end)), regions=1, busy=None)
+
+    failed = _send_all(streamed, send, timeout)
+    if mapped:
+        failed.update(broadcast(mapped, opened.map(offset, end), OpCode.BINARY, timeout))
+    return failed
+
+
+def _send_all(clients, send, timeout):
+    """Calls send(client, timeout) for every client, clients busy sending are
+    skipped and retried once the rest are served
+    :param send: Returns the bytes queued as Client._send, 0 if the message was
+    dropped and None if the send lock was not acquired
+    :return: Dictionary {client: exception} of the recipients that failed
+    """
+    failed = {}
+    busy = []
+    for client in clients:
+        try:
+            queued = send(client, 0)
+        except (OSError, ClientDisconnect) as e:
+            failed[client] = e
+            continue
+        if queued is None:
+            busy.append(client)
+        elif not queued:
+            failed[client] = MessageDropped('Send queue full')
+
+    for client in busy:
+        try:
+            queued = send(client, timeout)
+        except (OSError, ClientDisconnect) as e:
+            failed[client] = e
+            continue
+        if queued is None:
+            failed[client] = TimeoutError('Send lock not acquired within {} seconds'.format(timeout))
+        elif not queued:
+            failed[client] = MessageDropped('Send queue full')
 
+    for client, error in failed.items():
+        logging.warning('{}: Broadcast failed: {}'.format(client.address, error))
+    return failed
@@ -1,16 +1,11 @@
 #!/bin/env python3
-from random import randint
-import base64, hashlib
+import base64, hashlib, struct
 from .bytes_convert import *
 from .exceptions import *
-
-
-def masking_algorithm(data, key):
-    length = len(data)
-    result = bytearray(length)
-    for i in range(length):
-        result[i] = data[i] ^ key[i % 4]
-    return bytes(result)
+from .masking import masking_algorithm, mask_into, unmask_inplace, new_masking_key, copies
+from .codecs import JSON
+from . import tracing
+from .tracing import monotonic_ns
 
 
 #opcodes
@@ -106,9 +101,35 @@ class StatusCode:
     def get_int(status_code):
         return int(status_code.hex(), 16)
 
+
+_short_header = struct.Struct('!BB')
+_medium_header = struct.Struct('!BBH')
+_long_header = struct.Struct('!BBQ')
+_undecoded = object()
+
+
+def pack_header(opcode, payload_len, fin=1, rsv=(0, 0, 0), mask=0):
+    """
+    :return: The header of a frame with a payload of payload_len bytes, up to the
+    extended payload length (without the masking key)
+    """
+    first = fin << 7 | rsv[0] << 6 | rsv[1] << 5 | rsv[2] << 4 | opcode[0]
+    mask = mask << 7
+    if payload_len < 126:
+        return _short_header.pack(first, mask | payload_len)
+    elif payload_len < 65536:
+        return _medium_header.pack(first, mask | 126, payload_len)
+    elif payload_len < 18446744073709551616:
+        return _long_header.pack(first, mask | 127, payload_len)
+    raise InvalidFrame('Payload too large')
+
+
 class Frame:
+    __slots__ = ('fin', 'rsv', 'opcode', 'mask', 'payload_len', 'payload_len_ext',
+                 'masking_key', 'payload', 'payload_masked', 'codec', '_message', 'trace')
+
     def __init__(self, fin=1, rsv=(0,0,0), opcode=None, mask=0, payload_masked=None,
-                 payload_len=None, payload_len_ext=None, payload=b'', masking_key=b''):
+                 payload_len=None, payload_len_ext=None, payload=b'', masking_key=b'', codec=JSON):
         self.fin = fin
         self.rsv = rsv
         self.opcode = opcode
@@ -118,45 +139,52 @@ class Frame:
         self.masking_key = masking_key
         self.payload = payload
         self.payload_masked = payload_masked
-
-    def pack(self):
-
-        frame_head = bytearray(2)
-        frame_head[0] = self.fin << 7
-        frame_head[0] |= self.rsv[0] << 6
-        frame_head[0] |= self.rsv[1] << 5
-        frame_head[0] |= self.rsv[2] << 4
-        frame_head[0] |= bytes2int(self.opcode)
-
-        frame_head[1] = self.mask << 7
-
-        payload_len = len(self.payload)
-        if payload_len < 126:
-            payload_len_ext = bytearray(0)
-            frame_head[1] |= payload_len
-        elif payload_len < 65536:
-            payload_len_ext = int2bytes(payload_len, 2)
-            frame_head[1] |= 126
-        elif payload_len < 18446744073709551616:
-            payload_len_ext = int2bytes(payload_len, 8)
-            frame_head[1] |= 127
-        else:
-            raise InvalidFrame('Payload too large')
-
+        self.codec = codec  # Decodes message, received frames get the codec of their client
+        self._message = _undecoded
+        self.trace = None  # monotonic_ns() its header was parsed at if the frame is traced
+
+    @property
+    def message(self):
+        """The payload of a text/binary message decoded by codec, decoded on first access"""
+        if self._message is _undecoded:
+            self._message = self.codec.decode(self.payload)
+        return self._message
+
+    def pack_header(self):
+        """
+        :return: The frame header including the extended payload length and masking key
+        """
+        header = pack_header(self.opcode, len(self.payload), self.fin, self.rsv, self.mask)
         if self.mask:
             if self.payload_masked is None:
                 self.update_masking()
-            return bytes(frame_head + payload_len_ext + self.masking_key or bytearray(0) + self.payload_masked)
+            return header + self.masking_key
+        return header
+
+    def pack_parts(self):
+        """The frame as separate header and payload buffers so the payload can be
+        written to a socket with sendmsg without being copied into the header
+        :return: (header, payload)
+        """
+        header = self.pack_header()
+        if self.mask:
+            return header, self.payload_masked
+        return header, self.payload
 
-        return bytes(frame_head + payload_len_ext + self.payload)
+    def pack(self):
+        return b''.join(self.pack_parts())
 
     def unmask_payload(self):
+        """Unmasks payload_masked into payload and drops the masked copy, it is
+        recreated by pack if the frame is sent masked
+        """
         self.payload = masking_algorithm(self.payload_masked, self.masking_key)
+        self.payload_masked = None
         return self.payload
 
     def update_masking(self, new_key=True):
         if new_key:
-            self.masking_key = int2bytes(randint(0, 2**32-1), 4)
+            self.masking_key = new_masking_key()
         self.payload_masked = masking_algorithm(self.payload, self.masking_key)
 
     def recv_frame(self, recv_function):
@@ -187,10 +215,240 @@ class Frame:
         return self
 
 
+class FrameParser:
+    """Resumable frame parser. Data is fed in as it arrives from the socket,
+    however it happens to be split, and frames are returned once complete.
+
+    The parser owns a reusable receive buffer, the socket can write straight
+    into it with recv_into(parser.get_buffer(size)) followed by
+    parser.buffer_updated(nbytes). With zero_copy=True the payload of
+    complete text/binary frames is a memoryview into that buffer, unmasked in
+    place, and is only valid until the next call to get_buffer or feed. Small
+    masked payloads, which masking.mask_into could not unmask without a
+    temporary copy, are a memoryview of that copy instead.
+
+    A frame declaring a payload larger than max_frame_size raises
+    MessageTooBig as soon as its header is parsed, before anything is
+    buffered for it.
+    """
+    __slots__ = ('zero_copy', 'max_frame_size', '_buffer', '_view', '_start', '_end',
+                 '_frame', '_payload_len')
+
+    # Upper bound on how much room is reserved up front for a large payload
+    max_read_ahead = 1048576
+
+    def __init__(self, zero_copy=False, max_frame_size=None):
+        self.zero_copy = zero_copy
+        self.max_frame_size = max_frame_size
+        self._buffer = bytearray()
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._end = 0
+        self._frame = None  # Frame whose header is parsed but payload is incomplete
+        self._payload_len = 0
+
+    def __len__(self):
+        return self._end - self._start
+
+    def get_buffer(self, size):
+        """
+        :return: A writable memoryview with room for at least size bytes, or
+        for the rest of a partially received payload if that is larger
+        """
+        if self._frame is not None:
+            missing = self._payload_len - (self._end - self._start)
+            size = max(size, min(missing, self.max_read_ahead))
+
+        if self._start == self._end:
+            self._start = self._end = 0
+
+        if len(self._buffer) - self._end < size:
+            unread = self._end - self._start
+            if unread + size <= len(self._buffer):
+                # Move the unread bytes to the front, the buffer is big enough
+                self._buffer[0:unread] = self._view[self._start:self._end]
+            else:
+                # A new buffer is allocated instead of resizing the old one,
+                # frames might still hold memoryviews into it
+                buffer = bytearray(max(2 * len(self._buffer), unread + size))
+                buffer[0:unread] = self._view[self._start:self._end]
+                self._buffer = buffer
+                self._view = memoryview(buffer)
+            self._start = 0
+            self._end = unread
+
+        return self._view[self._end:]
+
+    def buffer_updated(self, nbytes):
+        self._end += nbytes
+
+    def feed(self, data):
+        size = len(data)
+        self.get_buffer(size)[:size] = data
+        self._end += size
+
+    def next_frame(self):
+        """
+        :return: The next complete frame or None if more data is needed
+        """
+        buffer = self._buffer
+        start = self._start
+        available = self._end - start
+        if self._frame is None:
+            if available < 2:
+                return None
+
+            payload_len = buffer[start+1] & 0b01111111
+            head_len = 2
+            if payload_len == 126:
+                head_len += 2
+            elif payload_len == 127:
+                head_len += 8
+            mask = buffer[start+1] >> 7
+            if mask:
+                head_len += 4
+            if available < head_len:
+                return None
+
+            active = tracing.tracer
+            parsing = monotonic_ns() if active is not None and active.sample_received() else None
+            frame = Frame(fin=buffer[start] >> 7,
+                          rsv=(buffer[start] >> 6 & 0b00000001,
+                               buffer[start] >> 5 & 0b00000001,
+                               buffer[start] >> 4 & 0b00000001),
+                          opcode=bytes(int2bytes(buffer[start] & 0b00001111, 1)),
+                          mask=mask,
+                          payload_len=payload_len)
+            if payload_len == 126:
+                payload_len = bytes2int(buffer[start+2:start+4])
+            elif payload_len == 127:
+                payload_len = bytes2int(buffer[start+2:start+10])
+            if self.max_frame_size is not None and payload_len > self.max_frame_size:
+                raise MessageTooBig('Frame payload of {} bytes exceeds {} bytes'.format(payload_len,
+                                                                                        self.max_frame_size))
+            if mask:
+                frame.masking_key = bytes(buffer[start+head_len-4:start+head_len])
+
+            start += head_len
+            available -= head_len
+            self._start = start
+            self._frame = frame
+            self._payload_len = payload_len
+            if parsing is not None:
+                frame.trace = monotonic_ns()
+                tracing.add('header parse', parsing, frame.trace)
+
+        if available < self._payload_len:
+            return None
+
+        frame = self._frame
+        end = start + self._payload_len
+        payload = self._view[start:end]
+        if frame.trace is not None:
+            received = monotonic_ns()
+            tracing.add('payload receive', frame.trace, received, {'bytes': self._payload_len})
+        if self.zero_copy and frame.fin and frame.opcode in (OpCode.TEXT, OpCode.BINARY):
+            # Fragments and control frames are kept by the client after the
+            # next read so they are always copied
+            if frame.mask:
+                if copies(self._payload_len):
+                    # Unmasking allocates anyway, the result is handed out
+                    # instead of being copied back into the buffer
+                    payload = memoryview(masking_algorithm(payload, frame.masking_key))
+                else:
+                    unmask_inplace(payload, frame.masking_key)
+            frame.payload = payload
+        elif frame.mask:
+            frame.payload = masking_algorithm(payload, frame.masking_key)
+        else:
+            frame.payload = bytes(payload)
+        if frame.mask and frame.trace is not None:
+            tracing.add('unmask', received)
+
+        self._start = end
+        self._frame = None
+        return frame
+
+    def __iter__(self):
+        frame = self.next_frame()
+        while frame is not None:
+            yield frame
+            frame = self.next_frame()
+
+
+class MessageAssembler:
+    """Collects the fragments of a message in a list and joins them once the
+    final fragment arrives, so a message split into n fragments is copied
+    once instead of n times.
+    """
+    __slots__ = ('max_message_size', 'opcode', 'rsv', 'size', '_chunks')
+
+    def __init__(self, max_message_size=None):
+        """
+        :param max_message_size: Largest message in bytes, larger ones raise MessageTooBig
+        """
+        self.max_message_size = max_message_size
+        self.opcode = None  # Opcode of the message in progress, None between messages
+        self.rsv = None
+        self.size = 0
+        self._chunks = []
+
+    def start(self, frame, keep=True):
+        """Starts a message with its first, non final, frame"""
+        if self.opcode is not None:
+            raise FrameError('A new message was started before the previous one was finished')
+        self.opcode = frame.opcode
+        self.rsv = frame.rsv
+        self.size = 0
+        self.add(frame.payload, keep)
+
+    def add(self, payload, keep=True):
+        """
+        :param keep: False to only count the payload towards max_message_size,
+        for fragments that are streamed instead of assembled
+        """
+        if self.opcode is None:
+            raise FrameError('A continuation frame was received without a message to continue')
+        self.size += len(payload)
+        if self.max_message_size is not None and self.size > self.max_message_size:
+            self.reset()
+            raise MessageTooBig('Message exceeds {} bytes'.format(self.max_message_size))
+        if keep:
+            self._chunks.append(payload)
+
+    def finish(self, payload):
+        """Adds the final fragment
+        :return: The whole message payload
+        """
+        self.add(payload)
+        message = b''.join(self._chunks)
+        self.reset()
+        return message
+
+    def reset(self):
+        self.opcode = self.rsv = None
+        self.size = 0
+        self._chunks = []
+
+
 guid = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
 
 
-def pack_handshake(client_handshake):
+def get_header(client_handshake, name):
+    """
+    :return: The value of the header name (bytes, case insensitive) or None
+    """
+    name = name.lower() + b':'
+    for line in client_handshake.splitlines():
+        if line.lower().startswith(name):
+            return line[len(name):].strip()
+    return None
+
+
+def pack_handshake(client_handshake, extensions=None):
+    """
+    :param extensions: Negotiated Sec-WebSocket-Extensions response value
+    """
     key = None
     for line in client_handshake.splitlines():
         if b'Sec-WebSocket-Key:' in line:
@@ -201,6 +459,10 @@ def pack_handshake(client_handshake):
     handshake = b'HTTP/1.1 101 Switching Protocols\r\n'
     handshake += b'Upgrade: websocket\r\n'
     handshake += b'Connection: Upgrade\r\n'
+    if extensions:
+        if type(extensions) == str:
+            extensions = extensions.encode()
+        handshake += b'Sec-WebSocket-Extensions: ' + extensions + b'\r\n'
     handshake += b'Sec-WebSocket-Accept: '
     handshake += base64.b64encode(hashlib.sha1(key+guid).digest())
     handshake += b'\r\n\r\n'
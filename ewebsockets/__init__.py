@@ -1,6 +1,16 @@
 #!/bin/env python3
 from .websocket_server import Websocket
+from .async_server import AsyncWebsocket
 from .RFC6455 import *
+from .permessage_deflate import PerMessageDeflate
+from .executor import OrderedExecutor
+from .ratelimit import RateLimit
+from .websocket_client import connect, WebsocketClient, ClientLoop, ClientPool
+from .capture import Recorder, Replayer
+from .tracing import Tracer
+from .sessions import SessionTable
+from .codecs import Codec, JSONCodec, MsgpackCodec
+from .workers import WorkerPool
 
 with open(__path__[0] + '/version', 'r') as r:
     __version__ = r.read()
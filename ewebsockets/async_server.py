@@ -0,0 +1,385 @@
+#!/bin/env python3
+"""
+asyncio frontend sharing the RFC6455 codec and frame handling with Websocket.
+One event loop serves all connections, no thread is used per client.
+"""
+import asyncio
+import logging
+from collections import deque
+from .RFC6455 import *
+from .ClientSocket import Client, broadcast, broadcast_message, broadcast_file
+from .codecs import JSON
+from .timer_wheel import TimerWheel
+from .heartbeat import Heartbeat
+from .metrics import ServerMetrics, serve
+
+
+class AsyncClient(Client, asyncio.BufferedProtocol):
+    """A connection to AsyncWebsocket. Received text and binary messages are
+    read with async for frame in client (or await client.recv()), the send_*
+    coroutines wait while the transport write buffer is above its high limit.
+    """
+    __slots__ = ('server', 'transport', '_loop', '_handshake_buffer', '_handshake_timer', '_messages',
+                 '_message_waiter', '_drain_waiter', '_paused_reading', '_paused_writing',
+                 '_close_timer', '_closed', '_handler')
+
+    def __init__(self, server):
+        Client.__init__(self, None, None,
+                        on_open=server.on_client_open,
+                        on_close=server.on_client_close,
+                        on_request=server.handle_new_connection,
+                        permessage_deflate=server.permessage_deflate,
+                        max_message_size=server.max_message_size,
+                        max_handshake_size=server.max_handshake_size,
+                        codec=server.codec)
+        self.server = server
+        self.transport = None
+        self._loop = None
+        self._handshake_buffer = None
+        self._handshake_timer = None
+        self._messages = deque()
+        self._message_waiter = None
+        self._drain_waiter = None
+        self._paused_reading = False
+        self._paused_writing = False
+        self._close_timer = None
+        self._closed = None
+        self._handler = None
+
+    def connection_made(self, transport):
+        self.transport = self.socket = transport
+        self.fd = transport.get_extra_info('socket').fileno()
+        self.address = transport.get_extra_info('peername')
+        self._loop = asyncio.get_event_loop()
+        self._closed = self._loop.create_future()
+        self._handshake_buffer = bytearray(4096)
+        self._handshake_timer = self.server.timers.schedule(self.server.handshake_timeout, self._handshake_expired)
+        transport.set_write_buffer_limits(*self.server.write_limits)
+        self.server.clients[self.fd] = self
+
+    def connection_lost(self, exc):
+        if self._close_timer is not None:
+            self._close_timer.cancel()
+        if self._handshake_timer is not None:
+            self._handshake_timer.cancel()
+        if self.server.clients.get(self.fd) is self:
+            del self.server.clients[self.fd]
+            self.server.metrics.client_removed(self)
+        previous_state = self.state
+        self.state = Client.CLOSED
+        if previous_state == Client.CONNECTING:
+            self.server.metrics.handshake(self)
+        else:
+            self.on_close(self)
+        self._closed.set_result(None)
+        self._wake(self._message_waiter)
+        self._wake(self._drain_waiter)
+
+    def get_buffer(self, sizehint):
+        if self.state == Client.CONNECTING:
+            return self._handshake_buffer
+        return self.parser.get_buffer(16384)
+
+    def buffer_updated(self, nbytes):
+        if self.state == Client.CONNECTING:
+            if not self._read_handshake(self._handshake_buffer[:nbytes]):
+                return
+        else:
+            self.parser.buffer_updated(nbytes)
+        self._handle_frames()
+
+    def pause_writing(self):
+        self._paused_writing = True
+
+    def resume_writing(self):
+        self._paused_writing = False
+        self._wake(self._drain_waiter)
+
+    def _read_handshake(self, data):
+        """
+        :return: True once the client is open
+        """
+        try:
+            response = self.feed_handshake(data)
+        except HandshakeError as e:
+            logging.warning('{}: Handshake refused, {}'.format(self.address, e))
+            self.transport.write(e.response)
+            self.transport.close()
+            return False
+        if response is None:
+            return False
+
+        self.transport.write(response)
+        self.state = Client.OPEN
+        self._handshake_timer.cancel()
+        self._handshake_timer = self._handshake_buffer = None
+        self.server.heartbeat.add(self)
+        self.server.metrics.handshake(self)
+        self.on_open(self)
+        logging.debug('{}: Handshake complete, client now in open state'.format(self.address))
+        if self.server.handle_client is not None:
+            self._handler = self._loop.create_task(self._run_handler())
+        return True
+
+    def _handshake_expired(self):
+        logging.info('{}: Handshake not completed within {} seconds'.format(self.address,
+                                                                           self.server.handshake_timeout))
+        self.transport.abort()
+
+    def _handle_frames(self):
+        try:
+            for frame in self.parser:
+                if not OpCode.is_valid(frame.opcode):
+                    raise FrameError('Opcode: {} is not recognized'.format(frame.opcode))
+                self._handle_frame(frame)
+                if frame.fin and (frame.opcode == OpCode.TEXT or frame.opcode == OpCode.BINARY):
+                    self._messages.append(frame)
+                    self._wake(self._message_waiter)
+                elif frame.opcode == OpCode.CLOSE:
+                    return
+        except FrameError as e:
+            logging.info('{}: Closing connection, {}'.format(self.address, e))
+            self.close(StatusCode.PROTOCOL_ERROR, timeout=0)
+        except MessageTooBig as e:
+            logging.info('{}: Closing connection, {}'.format(self.address, e))
+            self.close(StatusCode.MESSAGE_TOO_BIG, timeout=0)
+
+        if len(self._messages) >= self.server.max_queue and not self._paused_reading:
+            self._paused_reading = True
+            self.transport.pause_reading()
+
+    async def _run_handler(self):
+        try:
+            await self.server.handle_client(self)
+        except Exception:
+            logging.exception('{}: Unhandled exception in handle_client'.format(self.address))
+            self.close(StatusCode.UNEXPECTED_CONDITION)
+        else:
+            self.close()
+
+    @staticmethod
+    def _wake(waiter):
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    def _send(self, timeout, buffers=None, frame=None, regions=0, busy=0):
+        if self.transport is None or self.transport.is_closing():
+            raise ClientDisconnect('Transport is closed')
+        if frame is not None:
+            buffers = self._pack(frame)
+        self.transport.writelines(buffers)
+        msg_len = sum(map(len, buffers))
+        self._count_sent(buffers, msg_len)
+        return msg_len
+
+    def abort(self):
+        self.transport.abort()
+
+    def close(self, status_code=StatusCode.NORMAL_CLOSE, reason=b'', timeout=3):
+        """Sends a close frame and closes the transport once the client answers,
+        or after timeout seconds. Never blocks, await wait_closed() to wait for it.
+        """
+        if self.state == Client.CLOSED:
+            return
+        if type(reason) == str:
+            reason = reason.encode()
+        self.state = Client.CLOSING
+        if not self.close_frame_sent and not self.transport.is_closing():
+            self.send_frame(Frame(opcode=OpCode.CLOSE,
+                                  payload=status_code + reason))
+            self.close_frame_sent = True
+            if self.close_code is None and len(status_code) == 2:
+                self.close_code = StatusCode.get_int(status_code)
+
+        if self.close_frame_recd or timeout <= 0:
+            self.transport.close()
+        elif self._close_timer is None:
+            self._close_timer = self._loop.call_later(timeout, self.transport.close)
+
+    async def wait_closed(self):
+        await asyncio.shield(self._closed)
+
+    async def drain(self):
+        """Waits until the transport write buffer is below its low limit"""
+        while self._paused_writing and self.state != Client.CLOSED:
+            self._drain_waiter = self._loop.create_future()
+            await self._drain_waiter
+
+    async def recv(self):
+        """
+        :return: The next text/binary frame or None once the connection is closed
+        """
+        while not self._messages:
+            if self.state != Client.OPEN:
+                return None
+            self._message_waiter = self._loop.create_future()
+            await self._message_waiter
+
+        frame = self._messages.popleft()
+        if self._paused_reading and len(self._messages) <= self.server.max_queue // 2:
+            self._paused_reading = False
+            self.transport.resume_reading()
+        return frame
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        frame = await self.recv()
+        if frame is None:
+            raise StopAsyncIteration
+        return frame
+
+    async def send_text(self, text, mask=0):
+        Client.send_text(self, text, mask=mask)
+        await self.drain()
+
+    async def send_binary(self, bytes, mask=0):
+        Client.send_binary(self, bytes, mask=mask)
+        await self.drain()
+
+    async def send_file(self, file, offset=0, length=None, mask=0):
+        Client.send_file(self, file, offset, length, mask=mask)
+        await self.drain()
+
+    async def send_json(self, json_obj, mask=0):
+        Client.send_text(self, JSON.encode(json_obj), mask=mask)
+        await self.drain()
+
+    async def send_message(self, obj, mask=0):
+        Client.send_message(self, obj, mask=mask)
+        await self.drain()
+
+    async def ping(self, payload=b''):
+        self.send_frame(Frame(opcode=OpCode.PING, payload=payload))
+        await self.drain()
+
+
+class AsyncWebsocket:
+    def __init__(self,
+                 handle_client=None,
+                 handle_new_connection=lambda client: True,
+                 on_client_open=lambda client: True,
+                 on_client_close=lambda client: True,
+                 permessage_deflate=None,
+                 max_message_size=16777216,
+                 max_queue=32,
+                 write_limits=(65536, 16384),
+                 max_handshake_size=8192,
+                 codec=JSON,
+                 handshake_timeout=10,
+                 ping_interval=20,
+                 pong_timeout=10,
+                 idle_timeout=None):
+        """
+        :param handle_client: Coroutine function called with each client once it is
+        open, the connection is closed when it returns
+        :param max_message_size: Largest message in bytes a client may send, the
+        connection is closed with MESSAGE_TOO_BIG when exceeded. None for no limit
+        :param max_queue: Received messages buffered per client before reading from
+        its socket is paused
+        :param write_limits: (high, low) transport write buffer limits used by drain
+        :param codec: codecs.Codec of the clients, used by send_message, broadcast_message
+        and frame.message
+        :param handshake_timeout: Seconds a client has to complete its upgrade request
+        :param ping_interval: Seconds without any frame from a client before the server
+        pings it, None to never ping. client.rtt holds the round trip time of the last ping.
+        :param pong_timeout: Seconds a client has to answer a ping before it is disconnected
+        :param idle_timeout: Seconds without text/binary messages from a client before it
+        is closed, None to never close idle clients
+        """
+        self.handle_client = handle_client
+        self.handle_new_connection = handle_new_connection
+        self.on_client_open = on_client_open
+        self.on_client_close = on_client_close
+        self.permessage_deflate = permessage_deflate
+        self.max_message_size = max_message_size
+        self.max_queue = max_queue
+        self.write_limits = write_limits
+        self.max_handshake_size = max_handshake_size
+        self.codec = codec
+        self.handshake_timeout = handshake_timeout
+
+        self.server = None
+        self.clients = {}  # fd: AsyncClient
+        self.timers = TimerWheel()
+        self.heartbeat = Heartbeat(self.timers, self._expire_client,
+                                   ping_interval, pong_timeout, idle_timeout)
+        self._tick_handle = None
+        self.metrics = ServerMetrics()
+        self._metrics_server = None
+
+    async def start(self, host='127.0.0.1', port=1234, **kwargs):
+        """Starts listening, kwargs are passed to loop.create_server"""
+        loop = asyncio.get_event_loop()
+        self.server = await loop.create_server(lambda: AsyncClient(self), host, port, **kwargs)
+        self._tick_handle = loop.call_later(self.timers.tick, self._tick)
+        return self.server
+
+    def _tick(self):
+        self.timers.advance()
+        self._tick_handle = asyncio.get_event_loop().call_later(self.timers.tick, self._tick)
+
+    @staticmethod
+    def _expire_client(client, status_code):
+        if status_code is None:
+            client.abort()
+        else:
+            client.close(status_code, timeout=0)
+
+    async def stop(self, timeout=3):
+        """Stops listening and closes every client, waiting at most timeout seconds for them"""
+        self.server.close()
+        self._tick_handle.cancel()
+        if self._metrics_server is not None:
+            self._metrics_server.shutdown()
+            self._metrics_server = None
+        clients = self.clients_list()
+        for client in clients:
+            client.close(StatusCode.ENDP_GOING_AWAY, timeout=timeout)
+        if clients:
+            await asyncio.wait([asyncio.ensure_future(client.wait_closed()) for client in clients],
+                               timeout=timeout)
+        await self.server.wait_closed()
+
+    def clients_list(self):
+        return list(self.clients.values())
+
+    def stats(self):
+        """
+        :return: Dictionary of the server metrics, see metrics.ServerMetrics
+        """
+        return self.metrics.collect(self.clients_list())
+
+    def serve_metrics(self, host='127.0.0.1', port=9100):
+        """Serves the metrics in the Prometheus text format at http://host:port/metrics
+        from a separate thread until stop
+        """
+        self._metrics_server = serve(self.stats, host, port)
+
+    def broadcast(self, payload, opcode=OpCode.TEXT, clients=None):
+        """Packs the frame once and writes the same bytes to every recipient
+        :param clients: Recipients, defaults to all clients in open state
+        :return: Dictionary {client: exception} of the recipients that failed
+        """
+        if clients is None:
+            clients = [client for client in self.clients_list() if client.state == Client.OPEN]
+        return broadcast(clients, payload, opcode)
+
+    def broadcast_message(self, obj, clients=None):
+        """Encodes obj once per codec in use and writes it to every recipient
+        :param clients: Recipients, defaults to all clients in open state
+        :return: Dictionary {client: exception} of the recipients that failed
+        """
+        if clients is None:
+            clients = [client for client in self.clients_list() if client.state == Client.OPEN]
+        return broadcast_message(clients, obj)
+
+    def broadcast_file(self, file, offset=0, length=None, clients=None):
+        """Writes part of a file as one binary frame to every recipient from a single memory mapping
+        :param clients: Recipients, defaults to all clients in open state
+        :return: Dictionary {client: exception} of the recipients that failed
+        """
+        if clients is None:
+            clients = [client for client in self.clients_list() if client.state == Client.OPEN]
+        return broadcast_file(clients, file, offset, length)
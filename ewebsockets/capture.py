@@ -0,0 +1,297 @@
+#!/bin/env python3
+"""
+Traffic capture. A Recorder appends the frames clients receive and send to
+a compact binary log, Replayer memory-maps such logs and sends the
+received frames again to a server over new connections, with the recorded
+timing or as fast as possible.
+
+A log file starts with MAGIC and the wall clock time the recording started
+(double). Records follow back to back, a RECORD header of timestamp
+(seconds since the recording started, double), connection id, direction,
+opcode and payload length, then the payload. Received frames are recorded
+once finished, fragmented messages as a whole and decompressed.
+"""
+import logging
+import mmap
+import os
+import struct
+import threading
+from collections import deque
+from functools import partial
+from itertools import count
+from time import monotonic, sleep, time
+from .RFC6455 import *
+from .masking import masking_algorithm
+from .websocket_client import ClientLoop
+
+MAGIC = b'EWSCAP1\n'
+HEADER = struct.Struct('!d')
+RECORD = struct.Struct('!dIBBI')
+
+# Directions
+RECEIVED = 0
+SENT = 1
+
+
+def _frame_payload(data):
+    """
+    :param data: A packed frame
+    :return: (opcode, unmasked payload)
+    """
+    length = data[1] & 0b01111111
+    offset = 2 + (2 if length == 126 else 8 if length == 127 else 0)
+    if data[1] & 0b10000000:
+        return data[0] & 0b00001111, masking_algorithm(data[offset+4:], data[offset:offset+4])
+    return data[0] & 0b00001111, data[offset:]
+
+
+class _Tap:
+    """Records the frames of one connection, client.recorder"""
+    __slots__ = ('record', 'connection')
+
+    def __init__(self, record, connection):
+        self.record = record
+        self.connection = connection
+
+    def received(self, opcode, payload):
+        self.record(self.connection, RECEIVED, opcode, payload)
+
+    def sent(self, opcode, payload):
+        self.record(self.connection, SENT, opcode, payload)
+
+    def sent_packed(self, buffers):
+        """Records a frame sent already packed, e.g. by broadcast"""
+        opcode, payload = _frame_payload(b''.join(buffers))
+        self.record(self.connection, SENT, opcode, payload)
+
+
+class Recorder:
+    """Appends records to a deque, which takes no lock, and a writer thread
+    writes them out in batches. Once a file grows past max_file_size the
+    recording continues in path.1, path.2 and so on.
+    """
+    def __init__(self, path, max_file_size=67108864, max_files=None, sent=True, flush_interval=0.1):
+        """
+        :param path: Path of the first log file
+        :param max_file_size: Bytes after which the next file is started
+        :param max_files: Files kept, the oldest are deleted. None to keep all
+        :param sent: Record the frames sent as well as those received
+        :param flush_interval: Seconds between the batches written
+        """
+        self.path = path
+        self.max_file_size = max_file_size
+        self.max_files = max_files
+        self.sent = sent
+        self.flush_interval = flush_interval
+        self.files = []  # Paths written, oldest first
+        self.records = 0
+        self.bytes = 0
+        self._pending = deque()  # (record header, payload)
+        self._ids = count()
+        self._started = monotonic()
+        self._started_at = time()
+        self._file = None
+        self._file_size = 0
+        self._thread = None
+        self._stopping = threading.Event()
+
+    def start(self):
+        self._open(self.path)
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._write_loop, name='recorder', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Writes what is left and closes the file"""
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def tap(self):
+        """
+        :return: The recorder of a new connection, to set as client.recorder
+        """
+        return _Tap(self.record, next(self._ids))
+
+    def record(self, connection, direction, opcode, payload):
+        if direction == SENT and not self.sent:
+            return
+        if type(payload) != bytes:
+            # A memoryview into a receive buffer is reused before it is written
+            payload = bytes(payload)
+        self._pending.append((RECORD.pack(monotonic() - self._started, connection, direction, opcode,
+                                          len(payload)), payload))
+
+    def _open(self, path):
+        self._file = open(path, 'wb')
+        self._file.write(MAGIC + HEADER.pack(self._started_at))
+        self._file_size = len(MAGIC) + HEADER.size
+        self.files.append(path)
+        if self.max_files is not None:
+            while len(self.files) > self.max_files:
+                try:
+                    os.remove(self.files.pop(0))
+                except OSError as e:
+                    logging.warning('Removing an old capture file failed: {}'.format(e))
+
+    def _write_loop(self):
+        while not self._stopping.wait(self.flush_interval):
+            self._write()
+        self._write()
+
+    def _write(self):
+        pending = self._pending
+        batch = []
+        size = 0
+        while pending:
+            header, payload = pending.popleft()
+            batch += (header, payload)
+            size += len(header) + len(payload)
+            self.records += 1
+            if self._file_size + size >= self.max_file_size:
+                self._file.writelines(batch)
+                self._file.close()
+                self._open('{}.{}'.format(self.path, len(self.files)))
+                batch = []
+                self.bytes += size
+                size = 0
+        self._file.writelines(batch)
+        self._file.flush()
+        self._file_size += size
+        self.bytes += size
+
+
+class Replayer:
+    """Memory-maps capture files, the payloads are read straight from the mapping"""
+    def __init__(self, paths):
+        """
+        :param paths: Path or list of paths of the files of one recording, oldest first
+        """
+        if type(paths) == str:
+            paths = [paths]
+        self.paths = list(paths)
+        self.started_at = None
+        self._maps = []
+        for path in self.paths:
+            with open(path, 'rb') as file:
+                data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            if data[:len(MAGIC)] != MAGIC:
+                data.close()
+                self.close()
+                raise ValueError('Not a capture file: {}'.format(path))
+            if self.started_at is None:
+                self.started_at = HEADER.unpack_from(data, len(MAGIC))[0]
+            self._maps.append(data)
+
+    def close(self):
+        for data in self._maps:
+            try:
+                data.close()
+            except BufferError:
+                # Payloads are still referenced, the mapping goes with them
+                pass
+        self._maps = []
+
+    def records(self):
+        """
+        :return: Iterator of (timestamp, connection, direction, opcode, payload) with
+        the payload a memoryview into the mapping
+        """
+        for data in self._maps:
+            view = memoryview(data)
+            offset = len(MAGIC) + HEADER.size
+            end = len(data)
+            while offset + RECORD.size <= end:
+                timestamp, connection, direction, opcode, length = RECORD.unpack_from(data, offset)
+                offset += RECORD.size
+                if offset + length > end:
+                    # Cut off while the recording was running
+                    break
+                yield timestamp, connection, direction, opcode, view[offset:offset+length]
+                offset += length
+
+    def replay(self, url, speed=1.0, connect_timeout=10, drain_timeout=10):
+        """Sends the received frames of every recorded connection over a new
+        connection to url, opened when its first frame is due
+        :param speed: Multiple of the recorded pace, None for as fast as possible
+        :param drain_timeout: Seconds to wait for the send queues to empty at the end
+        :return: Dictionary of the connections, frames and bytes sent, the seconds it
+        took, the frames received back and the errors
+        """
+        loop = ClientLoop()
+        loop.start()
+        lock = threading.Lock()
+        connections = {}  # Recorded connection id: [client, frames waiting for it to open]
+        stats = {'connections': 0, 'frames': 0, 'bytes': 0, 'responses': 0, 'errors': 0}
+
+        def respond(client, frame):
+            stats['responses'] += 1
+            return True
+
+        def opened(connection, client):
+            # Sent with the lock held so that frames due meanwhile go out behind them
+            with lock:
+                connection[0] = client
+                for frame in connection[1]:
+                    send(client, frame)
+                connection[1] = None
+
+        def failed(connection, url, error):
+            with lock:
+                connection[1] = None
+            stats['errors'] += 1
+
+        def send(client, frame):
+            try:
+                if frame.opcode == OpCode.CLOSE:
+                    payload = bytes(frame.payload)
+                    client.close(payload[:2] or StatusCode.NORMAL_CLOSE, payload[2:])
+                else:
+                    client.send_frame(frame)
+            except (ClientDisconnect, OSError):
+                stats['errors'] += 1
+
+        first = None
+        start = monotonic()
+        for timestamp, connection_id, direction, opcode, payload in self.records():
+            if direction != RECEIVED:
+                continue
+            if first is None:
+                first = timestamp
+            if speed is not None:
+                delay = start + (timestamp - first) / speed - monotonic()
+                if delay > 0:
+                    sleep(delay)
+
+            frame = Frame(payload=payload, opcode=bytes((opcode,)))
+            stats['frames'] += 1
+            stats['bytes'] += len(payload)
+            connection = connections.get(connection_id)
+            if connection is None:
+                connection = connections[connection_id] = [None, [frame]]
+                stats['connections'] += 1
+                loop.connect(url, respond,
+                             on_open=partial(opened, connection),
+                             on_error=partial(failed, connection),
+                             timeout=connect_timeout)
+                continue
+            with lock:
+                client, backlog = connection
+                if client is None:
+                    if backlog is not None:
+                        backlog.append(frame)
+                    continue
+            send(client, frame)
+
+        deadline = monotonic() + drain_timeout
+        while monotonic() < deadline and any(connection[1] is not None or
+                                             (connection[0] is not None and connection[0].send_queue)
+                                             for connection in list(connections.values())):
+            sleep(0.01)
+        stats['seconds'] = monotonic() - start
+        loop.stop()
+        return stats
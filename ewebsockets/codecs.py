@@ -0,0 +1,71 @@
+#!/bin/env python3
+"""
+Message codecs, turning objects into message payloads and received
+payloads back into objects. Each client has a codec, JSON unless the
+server or handle_new_connection picks another one (e.g. by subprotocol),
+which Client.send_message encodes with and frame.message decodes with on
+first access. Encoders and decoders are created once per codec, not per
+message.
+"""
+import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class Codec:
+    """Base class, subclasses implement encode and decode"""
+    # Messages are sent as binary instead of text frames
+    binary = False
+
+    def encode(self, obj):
+        """
+        :return: The payload, bytes
+        """
+        raise NotImplementedError
+
+    def decode(self, payload):
+        """
+        :param payload: bytes or a memoryview (zero_copy)
+        """
+        raise NotImplementedError
+
+
+class JSONCodec(Codec):
+    def __init__(self, **kwargs):
+        """
+        :param kwargs: json.JSONEncoder arguments, e.g. separators=(',', ':') for compact output
+        """
+        self._encoder = json.JSONEncoder(**kwargs)
+        self._decoder = json.JSONDecoder()
+
+    def encode(self, obj):
+        return self._encoder.encode(obj).encode()
+
+    def decode(self, payload):
+        return self._decoder.decode(str(payload, 'utf-8'))
+
+
+class MsgpackCodec(Codec):
+    """MessagePack in binary frames, requires the msgpack package"""
+    binary = True
+
+    def __init__(self, **kwargs):
+        """
+        :param kwargs: msgpack.packb arguments
+        """
+        if msgpack is None:
+            raise ImportError('MsgpackCodec requires the msgpack package')
+        # A Packer is not shared, its buffer would be used by several threads at once
+        self._kwargs = kwargs
+
+    def encode(self, obj):
+        return msgpack.packb(obj, **self._kwargs)
+
+    def decode(self, payload):
+        return msgpack.unpackb(payload, raw=False)
+
+
+JSON = JSONCodec()
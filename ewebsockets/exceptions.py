@@ -11,3 +11,19 @@ class ClientDisconnect(Exception):
 class FrameError(Exception):
     pass
 
+class MessageTooBig(Exception):
+    pass
+
+class MessageDropped(Exception):
+    pass
+
+class HandshakeError(Exception):
+    def __init__(self, message, response):
+        """
+        :param response: The HTTP error response to send before closing the connection
+        """
+        Exception.__init__(self, message)
+        self.response = response
+
+class ConnectError(Exception):
+    pass
@@ -0,0 +1,135 @@
+#!/bin/env python3
+"""
+Runs the frame handlers on a fixed pool of threads instead of the thread
+reading the socket. Calls are queued per client and each client has at
+most one call running, so its messages are handled in the order they
+arrived while different clients are handled in parallel. Clients with
+too many calls queued are paused, the server stops reading from them
+until enough of their calls have run.
+"""
+import logging
+import queue
+import threading
+from collections import deque
+from time import perf_counter
+from .metrics import Histogram
+
+
+class OrderedExecutor:
+    def __init__(self, workers=8, max_pending=64, resume_pending=None):
+        """
+        :param workers: Number of handler threads
+        :param max_pending: Calls queued for one client at which reading from it is paused
+        :param resume_pending: Queued calls at which reading resumes, defaults to max_pending // 2
+        """
+        self.workers = workers
+        self.max_pending = max_pending
+        self.resume_pending = max_pending // 2 if resume_pending is None else resume_pending
+        self.wait_seconds = Histogram()  # From submit until the call starts
+        self.run_seconds = Histogram()
+        self._queues = {}  # key: deque of (submitted, function, args), while calls are queued or running
+        self._paused = {}  # key: resume callback
+        self._ready = queue.Queue()  # Keys with queued calls and none running
+        self._lock = threading.Lock()
+        self._drained = threading.Condition(self._lock)  # Notified when no calls are queued
+        self._threads = []
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name='handler-{}'.format(i), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def shutdown(self, wait=True):
+        """Stops the threads
+        :param wait: Runs the calls still queued and waits for the threads, without it
+        they stop once they finish their current call and queued calls might not run
+        """
+        if wait and self._threads:
+            with self._drained:
+                self._drained.wait_for(lambda: not self._queues)
+        for _ in self._threads:
+            self._ready.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+        self._threads = []
+
+    def submit(self, key, function, *args):
+        """Queues function(*args) behind the calls already queued for key
+        :return: Number of calls queued or running for key
+        """
+        item = (perf_counter(), function, args)
+        with self._lock:
+            calls = self._queues.get(key)
+            if calls is None:
+                calls = self._queues[key] = deque()
+                self._ready.put(key)
+            calls.append(item)
+            return len(calls)
+
+    def pending(self, key):
+        with self._lock:
+            calls = self._queues.get(key)
+            return 0 if calls is None else len(calls)
+
+    def pause(self, key, resume):
+        """Calls resume() from a handler thread once the calls queued for key
+        have dropped to resume_pending
+        :return: False if they already have, resume is then not called
+        """
+        with self._lock:
+            calls = self._queues.get(key)
+            if calls is None or len(calls) <= self.resume_pending:
+                return False
+            self._paused[key] = resume
+            return True
+
+    def resume(self, key):
+        """Resumes a paused key right away, e.g. to notice that it is being closed"""
+        with self._lock:
+            resume = self._paused.pop(key, None)
+        if resume is not None:
+            resume()
+
+    def stats(self):
+        with self._lock:
+            pending = sum(map(len, self._queues.values()))
+            paused = len(self._paused)
+        return {'executor_pending': pending,
+                'executor_paused': paused,
+                'executor_wait_seconds': self.wait_seconds.collect(),
+                'executor_run_seconds': self.run_seconds.collect()}
+
+    def _work(self):
+        while True:
+            key = self._ready.get()
+            if key is None:
+                return
+            with self._lock:
+                # A key is only in the ready queue while it has calls queued
+                submitted, function, args = self._queues[key][0]
+
+            start = perf_counter()
+            self.wait_seconds.observe(start - submitted)
+            try:
+                function(*args)
+            except Exception:
+                logging.exception('Unhandled exception in handler {}'.format(function))
+            self.run_seconds.observe(perf_counter() - start)
+
+            resume = None
+            with self._lock:
+                calls = self._queues[key]
+                calls.popleft()
+                if key in self._paused and len(calls) <= self.resume_pending:
+                    resume = self._paused.pop(key)
+                if calls:
+                    # Back in line behind the other clients
+                    self._ready.put(key)
+                else:
+                    del self._queues[key]
+                    if not self._queues:
+                        self._drained.notify_all()
+            if resume is not None:
+                resume()
@@ -0,0 +1,291 @@
+#!/bin/env python3
+"""
+The opening handshake (RFC 6455 section 4). HandshakeParser reads the HTTP
+upgrade request incrementally as it arrives, however it is split over reads,
+and pack_response builds the answer from a prebuilt template. pack_request
+and parse_response are the client side of it.
+"""
+import base64
+import hashlib
+import os
+import re
+import sys
+from .exceptions import *
+from .RFC6455 import guid
+
+BAD_REQUEST = b'HTTP/1.1 400 Bad Request\r\nConnection: close\r\nContent-Length: 0\r\n\r\n'
+FORBIDDEN = b'HTTP/1.1 403 Forbidden\r\nConnection: close\r\nContent-Length: 0\r\n\r\n'
+UPGRADE_REQUIRED = (b'HTTP/1.1 426 Upgrade Required\r\nSec-WebSocket-Version: 13\r\n'
+                    b'Connection: close\r\nContent-Length: 0\r\n\r\n')
+TOO_LARGE = b'HTTP/1.1 431 Request Header Fields Too Large\r\nConnection: close\r\nContent-Length: 0\r\n\r\n'
+SERVICE_UNAVAILABLE = (b'HTTP/1.1 503 Service Unavailable\r\nRetry-After: 1\r\n'
+                       b'Connection: close\r\nContent-Length: 0\r\n\r\n')
+
+_RESPONSE = (b'HTTP/1.1 101 Switching Protocols\r\n'
+             b'Upgrade: websocket\r\n'
+             b'Connection: Upgrade\r\n'
+             b'Sec-WebSocket-Accept: ')
+
+
+class Request:
+    """A parsed upgrade request, available as client.request. Only the headers
+    of the handshake itself are parsed up front, the headers dictionary is
+    built from the raw head on first use and leaves out invalid lines.
+    """
+    __slots__ = ('method', 'path', 'key', 'host', 'extensions', '_head', '_headers')
+
+    def __init__(self, method, path, head, key=None, host=None, extensions=None):
+        """
+        :param head: The raw request head (bytes) the headers are parsed from
+        """
+        self.method = method
+        self.path = path
+        self.key = key
+        self.host = host
+        self.extensions = extensions
+        self._head = head
+        self._headers = None
+
+    @property
+    def headers(self):
+        """
+        :return: Dictionary of lowercase header name: value (str), repeated
+        headers are joined with ', '
+        """
+        if self._headers is None:
+            self._headers = _parse_headers(self._head.decode('latin-1').split('\r\n')[1:], strict=False)
+        return self._headers
+
+    def get(self, name, default=None):
+        return self.headers.get(name.lower(), default)
+
+    @property
+    def origin(self):
+        return self.headers.get('origin')
+
+    @property
+    def subprotocols(self):
+        """
+        :return: List of the offered subprotocols in order of preference
+        """
+        return _tokens(self.headers.get('sec-websocket-protocol', ''), lower=False)
+
+
+def _tokens(value, lower=True):
+    tokens = [token.strip() for token in value.split(',')]
+    return [token.lower() if lower else token for token in tokens if token]
+
+
+def _has_token(value, token):
+    """
+    :return: True if the comma separated bytes value lists the lowercase token
+    """
+    value = value.lower()
+    return value == token or token in value.translate(None, b' \t').split(b',')
+
+
+class HandshakeParser:
+    """Buffers an upgrade request across reads until the empty line ending
+    it. Whatever follows it belongs to the first frames and is left in
+    remainder.
+    """
+    def __init__(self, max_size=8192):
+        """
+        :param max_size: Largest request in bytes, larger ones raise HandshakeError
+        """
+        self.max_size = max_size
+        self.remainder = b''
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        """
+        :return: The Request once it is complete, None while more data is needed
+        :raise HandshakeError: If the request is too large or not a valid upgrade request
+        """
+        if self._buffer:
+            # Only the new data and the 3 bytes before it can complete the terminator
+            search_from = max(0, len(self._buffer) - 3)
+            self._buffer += data
+            data = self._buffer
+        else:
+            # Usually the whole request arrives in one read and is parsed without copying
+            search_from = 0
+        end = data.find(b'\r\n\r\n', search_from)
+        if end < 0:
+            if len(data) > self.max_size:
+                raise HandshakeError('Handshake larger than {} bytes'.format(self.max_size), TOO_LARGE)
+            if not self._buffer:
+                self._buffer += data
+            return None
+        if end > self.max_size:
+            raise HandshakeError('Handshake larger than {} bytes'.format(self.max_size), TOO_LARGE)
+
+        self.remainder = bytes(data[end+4:])
+        if self._buffer:
+            self._buffer = bytearray()
+        return parse_request(bytes(data[:end]))
+
+
+def _parse_headers(lines, strict=True):
+    """
+    :param strict: Raise on an invalid header line instead of leaving it out
+    :return: Dictionary of lowercase header name: value, repeated headers are joined with ', '
+    :raise ValueError: On an invalid header line
+    """
+    headers = {}
+    for line in lines:
+        name, colon, value = line.partition(':')
+        if not colon or not name or name != name.strip():
+            if not strict:
+                continue
+            raise ValueError('Invalid header line: {}'.format(line))
+        # Interned, every connection keeps its request with the same header names
+        name = sys.intern(name.lower())
+        value = value.strip()
+        if name in headers:
+            headers[name] += ', ' + value
+        else:
+            headers[name] = value
+    return headers
+
+
+# Headers parse_request reads, everything else is left to Request.headers
+_HANDSHAKE_HEADERS = frozenset((b'host', b'upgrade', b'connection', b'sec-websocket-key',
+                                b'sec-websocket-version', b'sec-websocket-extensions'))
+
+# The base64 encoding of 16 bytes
+_KEY = re.compile(rb'[A-Za-z0-9+/]{22}==')
+
+
+def parse_request(data):
+    """Parses and validates the head of an upgrade request, without the final empty line
+    :param data: bytes
+    :return: Request
+    :raise HandshakeError: If it is not a valid websocket upgrade request
+    """
+    lines = data.split(b'\r\n')
+    request_line = lines[0].split(b' ')
+    if len(request_line) != 3 or request_line[0] != b'GET' or not request_line[2].startswith(b'HTTP/1.'):
+        raise HandshakeError('Invalid request line: {}'.format(lines[0].decode('latin-1')), BAD_REQUEST)
+    if request_line[2] == b'HTTP/1.0':
+        raise HandshakeError('HTTP/1.1 or newer is required', BAD_REQUEST)
+
+    headers = {}
+    needed = _HANDSHAKE_HEADERS
+    for line in lines[1:]:
+        name, colon, value = line.partition(b':')
+        # Only these names are looked at, one with whitespace before the colon matches none
+        name = name.lower()
+        if name in needed:
+            value = value.strip()
+            headers[name] = headers[name] + b', ' + value if name in headers else value
+        elif not colon:
+            raise HandshakeError('Invalid header line: {}'.format(line.decode('latin-1')), BAD_REQUEST)
+
+    if not _has_token(headers.get(b'upgrade', b''), b'websocket'):
+        raise HandshakeError('Missing Upgrade: websocket', BAD_REQUEST)
+    if not _has_token(headers.get(b'connection', b''), b'upgrade'):
+        raise HandshakeError('Missing Connection: Upgrade', BAD_REQUEST)
+    version = headers.get(b'sec-websocket-version')
+    if version != b'13':
+        raise HandshakeError('Unsupported Sec-WebSocket-Version: {}'.format(
+            version if version is None else version.decode('latin-1')), UPGRADE_REQUIRED)
+    key = headers.get(b'sec-websocket-key', b'')
+    if _KEY.fullmatch(key) is None:
+        raise HandshakeError('Invalid Sec-WebSocket-Key', BAD_REQUEST)
+
+    host = headers.get(b'host')
+    extensions = headers.get(b'sec-websocket-extensions')
+    return Request('GET', request_line[1].decode('latin-1'), data,
+                   key.decode(),
+                   host if host is None else host.decode('latin-1'),
+                   extensions if extensions is None else extensions.decode('latin-1'))
+
+
+def accept_key(key):
+    """
+    :return: The Sec-WebSocket-Accept value for a Sec-WebSocket-Key
+    """
+    if type(key) == str:
+        key = key.encode()
+    return base64.b64encode(hashlib.sha1(key + guid).digest())
+
+
+def pack_response(key, extensions=None, subprotocol=None, headers=None):
+    """
+    :param extensions: Negotiated Sec-WebSocket-Extensions value
+    :param subprotocol: Selected Sec-WebSocket-Protocol value
+    :param headers: Dictionary of further headers
+    :return: The 101 response accepting the upgrade
+    """
+    parts = [_RESPONSE, accept_key(key)]
+    if extensions:
+        parts += [b'\r\nSec-WebSocket-Extensions: ', extensions.encode() if type(extensions) == str else extensions]
+    if subprotocol:
+        parts += [b'\r\nSec-WebSocket-Protocol: ', subprotocol.encode() if type(subprotocol) == str else subprotocol]
+    if headers:
+        for name, value in headers.items():
+            parts.append('\r\n{}: {}'.format(name, value).encode('latin-1'))
+    parts.append(b'\r\n\r\n')
+    return b''.join(parts)
+
+
+def new_key():
+    """
+    :return: A random Sec-WebSocket-Key
+    """
+    return base64.b64encode(os.urandom(16))
+
+
+def pack_request(host, resource, key, subprotocols=None, origin=None, headers=None):
+    """The upgrade request of a client
+    :param host: Host header value, host or host:port
+    :param resource: Path and query
+    :param subprotocols: Offered subprotocols in order of preference
+    :param headers: Dictionary of further headers
+    """
+    lines = ['GET {} HTTP/1.1'.format(resource),
+             'Host: {}'.format(host),
+             'Upgrade: websocket',
+             'Connection: Upgrade',
+             'Sec-WebSocket-Key: {}'.format(key.decode()),
+             'Sec-WebSocket-Version: 13']
+    if subprotocols:
+        lines.append('Sec-WebSocket-Protocol: {}'.format(', '.join(subprotocols)))
+    if origin is not None:
+        lines.append('Origin: {}'.format(origin))
+    for name, value in (headers or {}).items():
+        lines.append('{}: {}'.format(name, value))
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+
+def parse_response(data, key, subprotocols=None):
+    """Parses and validates the head of the answer to an upgrade request, without the final empty line
+    :param key: The Sec-WebSocket-Key of the request
+    :param subprotocols: The subprotocols offered in the request
+    :return: Dictionary of lowercase header name: value
+    :raise ConnectError: If the server did not accept the upgrade
+    """
+    lines = data.decode('latin-1').split('\r\n')
+    status_line = lines[0].split(' ', 2)
+    if len(status_line) < 2 or not status_line[0].startswith('HTTP/1.'):
+        raise ConnectError('Invalid status line: {}'.format(lines[0]))
+    if status_line[1] != '101':
+        raise ConnectError('Upgrade refused: {}'.format(lines[0]))
+    try:
+        headers = _parse_headers(lines[1:])
+    except ValueError as e:
+        raise ConnectError(str(e))
+
+    if 'websocket' not in _tokens(headers.get('upgrade', '')):
+        raise ConnectError('Missing Upgrade: websocket')
+    if 'upgrade' not in _tokens(headers.get('connection', '')):
+        raise ConnectError('Missing Connection: Upgrade')
+    if headers.get('sec-websocket-accept', '').encode() != accept_key(key):
+        raise ConnectError('Invalid Sec-WebSocket-Accept')
+    if headers.get('sec-websocket-extensions'):
+        raise ConnectError('Extension not offered: {}'.format(headers['sec-websocket-extensions']))
+    subprotocol = headers.get('sec-websocket-protocol')
+    if subprotocol is not None and subprotocol not in (subprotocols or ()):
+        raise ConnectError('Subprotocol not offered: {}'.format(subprotocol))
+    return headers
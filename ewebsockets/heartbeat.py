@@ -0,0 +1,69 @@
+#!/bin/env python3
+"""
+Server driven keepalive. Silent connections are pinged, those that do not
+answer in time are dropped and, optionally, connections without messages
+for too long are closed. One timer per client on a TimerWheel, which is
+only rescheduled when it fires, so receiving frames costs nothing but a
+timestamp.
+"""
+import logging
+from time import monotonic
+from .exceptions import *
+from .RFC6455 import StatusCode
+
+
+class Heartbeat:
+    def __init__(self, timers, expire, ping_interval=20, pong_timeout=10, idle_timeout=None):
+        """
+        :param timers: TimerWheel
+        :param expire: Called as expire(client, status_code) to drop a client, status_code
+        is None when it is unresponsive and no close frame should be sent
+        :param ping_interval: Seconds without any frame from a client before it is pinged
+        (None to disable)
+        :param pong_timeout: Seconds a client has to answer a ping
+        :param idle_timeout: Seconds without text/binary messages from a client before
+        it is closed (None to disable)
+        """
+        self.timers = timers
+        self.expire = expire
+        self.ping_interval = ping_interval
+        self.pong_timeout = pong_timeout
+        self.idle_timeout = idle_timeout
+
+    def add(self, client):
+        """Starts watching a client in open state, it is left once no longer open"""
+        delays = [delay for delay in (self.ping_interval, self.idle_timeout) if delay is not None]
+        if delays:
+            self.timers.schedule(min(delays), self._check, client)
+
+    def _check(self, client):
+        if client.state != client.OPEN:
+            return
+        now = monotonic()
+        if self.idle_timeout is not None and now - client.last_message >= self.idle_timeout:
+            logging.info('{}: Closing idle connection'.format(client.address))
+            self.expire(client, StatusCode.ENDP_GOING_AWAY)
+            return
+
+        if client.ping_sent is not None:
+            if now - client.ping_sent >= self.pong_timeout:
+                logging.info('{}: No pong within {} seconds, dropping connection'.format(client.address,
+                                                                                         self.pong_timeout))
+                self.expire(client, None)
+                return
+            delay = client.ping_sent + self.pong_timeout - now
+        elif self.ping_interval is None:
+            delay = float('inf')
+        elif now - client.last_seen >= self.ping_interval:
+            try:
+                client.send_ping()
+            except (ClientDisconnect, OSError):
+                self.expire(client, None)
+                return
+            delay = self.pong_timeout
+        else:
+            delay = client.last_seen + self.ping_interval - now
+
+        if self.idle_timeout is not None:
+            delay = min(delay, client.last_message + self.idle_timeout - now)
+        self.timers.schedule(delay, self._check, client)
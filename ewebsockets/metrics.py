@@ -0,0 +1,213 @@
+#!/bin/env python3
+"""
+Server metrics. Frame and byte counts are kept per client in lists indexed
+by opcode, where only the threads handling the client write them, and are
+summed when stats are collected. Counters of clients that are gone are folded into the server
+totals when they are removed. exposition renders collected stats in the
+Prometheus text format and serve answers GET /metrics with it.
+"""
+import logging
+import threading
+from bisect import bisect_left
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from time import monotonic
+
+# Seconds, from 50 microseconds to 10 seconds
+DEFAULT_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_opcode_names = {0: 'continuation', 1: 'text', 2: 'binary', 8: 'close', 9: 'ping', 10: 'pong'}
+
+
+class Histogram:
+    """Fixed bucket histogram, cumulative like a Prometheus histogram once collected.
+    Each thread observes into its own counts, so observing takes no lock.
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.bounds = tuple(buckets)
+        self._local = threading.local()
+        self._shards = []  # Counts per bucket followed by the sum, one list per thread
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        try:
+            shard = self._local.shard
+        except AttributeError:
+            shard = self._local.shard = [0] * (len(self.bounds) + 1) + [0.0]
+            with self._lock:
+                self._shards.append(shard)
+        shard[bisect_left(self.bounds, value)] += 1
+        shard[-1] += value
+
+    def collect(self):
+        with self._lock:
+            shards = list(self._shards)
+        totals = [sum(counts) for counts in zip(*shards)] or [0] * (len(self.bounds) + 2)
+        buckets = []
+        cumulative = 0
+        for bound, count in zip(self.bounds + (float('inf'),), totals):
+            cumulative += count
+            buckets.append((bound, cumulative))
+        return {'count': cumulative, 'sum': float(totals[-1]), 'buckets': buckets}
+
+
+def _add(totals, counts):
+    for opcode, value in enumerate(counts):
+        totals[opcode] += value
+
+
+def _by_name(counts):
+    named = {}
+    for opcode, count in enumerate(counts):
+        if count:
+            name = _opcode_names.get(opcode, 'reserved')
+            named[name] = named.get(name, 0) + count
+    return named
+
+
+class ServerMetrics:
+    def __init__(self):
+        self.started = monotonic()
+        self.handshakes = {'ok': 0, 'failed': 0}
+        self.close_codes = {}  # Close code (None if the connection was lost): count
+        self.limits_hit = {}  # Rate or connection limit: count
+        # Totals of the clients that are gone, indexed by opcode
+        self.frames_in = [0] * 16
+        self.bytes_in = [0] * 16
+        self.frames_out = [0] * 16
+        self.bytes_out = [0] * 16
+        self.frame_handler_seconds = Histogram()
+        self.handshake_seconds = Histogram()
+        self._lock = threading.Lock()
+
+    def handshake(self, client):
+        """Counts a handshake, successful if the client is open"""
+        if client.state == client.OPEN:
+            self.handshake_seconds.observe(monotonic() - client.connected_at)
+            result = 'ok'
+        else:
+            result = 'failed'
+        with self._lock:
+            self.handshakes[result] += 1
+
+    def limit_hit(self, limit, count=1):
+        with self._lock:
+            self.limits_hit[limit] = self.limits_hit.get(limit, 0) + count
+
+    def client_removed(self, client):
+        with self._lock:
+            self.close_codes[client.close_code] = self.close_codes.get(client.close_code, 0) + 1
+            _add(self.frames_in, client.frames_in)
+            _add(self.bytes_in, client.bytes_in)
+            _add(self.frames_out, client.frames_out)
+            _add(self.bytes_out, client.bytes_out)
+
+    def collect(self, clients):
+        """
+        :param clients: The clients still connected
+        :return: Dictionary of all metrics
+        """
+        with self._lock:
+            stats = {'uptime': monotonic() - self.started,
+                     'handshakes': dict(self.handshakes),
+                     'close_codes': dict(self.close_codes),
+                     'limits_hit': dict(self.limits_hit),
+                     'frames_in': list(self.frames_in),
+                     'bytes_in': list(self.bytes_in),
+                     'frames_out': list(self.frames_out),
+                     'bytes_out': list(self.bytes_out)}
+
+        connections = {name: 0 for name in ('Connecting', 'Open', 'Closing', 'Closed')}
+        queue_bytes = queue_max = 0
+        for client in clients:
+            connections[client.get_state()] += 1
+            queue_bytes += client.send_queue_bytes
+            queue_max = max(queue_max, client.send_queue_bytes)
+        for key in ('frames_in', 'bytes_in', 'frames_out', 'bytes_out'):
+            # Summed a column (opcode) at a time
+            counts = [getattr(client, key) for client in clients]
+            stats[key] = _by_name(map(sum, zip(stats[key], *counts)))
+
+        stats['connections'] = connections
+        stats['send_queue_bytes'] = queue_bytes
+        stats['send_queue_max_bytes'] = queue_max
+        stats['frame_handler_seconds'] = self.frame_handler_seconds.collect()
+        stats['handshake_seconds'] = self.handshake_seconds.collect()
+        return stats
+
+
+# (stats key, metric name, type, label name, help)
+_exposed = (
+    ('connections', 'connections', 'gauge', 'state', 'Connections by state'),
+    ('handshakes', 'handshakes_total', 'counter', 'result', 'Opening handshakes'),
+    ('frames_in', 'frames_received_total', 'counter', 'opcode', 'Frames received'),
+    ('bytes_in', 'received_bytes_total', 'counter', 'opcode', 'Payload bytes received'),
+    ('frames_out', 'frames_sent_total', 'counter', 'opcode', 'Frames sent'),
+    ('bytes_out', 'sent_bytes_total', 'counter', 'opcode', 'Bytes sent, headers included'),
+    ('close_codes', 'closes_total', 'counter', 'code', 'Closed connections by close code'),
+    ('limits_hit', 'limits_hit_total', 'counter', 'limit', 'Connections refused and frames over a rate limit'),
+    ('send_queue_bytes', 'send_queue_bytes', 'gauge', None, 'Bytes queued for sending'),
+    ('send_queue_max_bytes', 'send_queue_max_bytes', 'gauge', None, 'Largest send queue of a client'),
+    ('uptime', 'uptime_seconds', 'gauge', None, 'Seconds since the server was created'),
+    ('frame_handler_seconds', 'frame_handler_seconds', 'histogram', None, 'Duration of the frame handler calls'),
+    ('handshake_seconds', 'handshake_seconds', 'histogram', None, 'Time from accept to open'),
+    ('executor_pending', 'executor_pending_calls', 'gauge', None, 'Handler calls queued or running'),
+    ('executor_paused', 'executor_paused_clients', 'gauge', None, 'Clients not read from until their calls ran'),
+    ('executor_wait_seconds', 'executor_wait_seconds', 'histogram', None, 'Time handler calls spent queued'),
+    ('executor_run_seconds', 'executor_run_seconds', 'histogram', None, 'Duration of queued handler calls'),
+)
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def exposition(stats, prefix='ewebsockets'):
+    """Renders stats collected by ServerMetrics in the Prometheus text format"""
+    lines = []
+    for key, name, kind, label, help in _exposed:
+        if key not in stats:
+            continue
+        name = '{}_{}'.format(prefix, name)
+        lines.append('# HELP {} {}'.format(name, help))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        value = stats[key]
+        if kind == 'histogram':
+            for bound, count in value['buckets']:
+                lines.append('{}_bucket{{le="{}"}} {}'.format(name, _number(bound), count))
+            lines.append('{}_sum {}'.format(name, _number(value['sum'])))
+            lines.append('{}_count {}'.format(name, value['count']))
+        elif label is None:
+            lines.append('{} {}'.format(name, _number(value)))
+        else:
+            for label_value, count in sorted(value.items(), key=lambda item: str(item[0])):
+                if label_value is None:
+                    label_value = 'none'
+                lines.append('{}{{{}="{}"}} {}'.format(name, label, str(label_value).lower(), _number(count)))
+    return '\n'.join(lines) + '\n'
+
+
+def serve(collect, host='127.0.0.1', port=9100):
+    """Answers GET /metrics with exposition(collect()) from a daemon thread
+    :return: The HTTPServer, shutdown() stops it
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = exposition(collect()).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logging.debug('Metrics request: ' + format % args)
+
+    server = HTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,203 @@
+#!/bin/env python3
+"""
+The permessage-deflate extension (RFC 7692)
+"""
+import zlib
+from .exceptions import *
+
+# Appended by a sync flush, removed from compressed messages (RFC 7692 section 7.2.1)
+_TAIL = b'\x00\x00\xff\xff'
+
+
+def parse_extensions(header):
+    """Parses a Sec-WebSocket-Extensions header value
+    :return: List of (name, [(param, value or None), ...]) in offered order
+    """
+    if isinstance(header, bytes):
+        header = header.decode('latin-1')
+    extensions = []
+    for extension in header.split(','):
+        items = [item.strip() for item in extension.split(';')]
+        if not items[0]:
+            continue
+        params = []
+        for item in items[1:]:
+            if not item:
+                continue
+            name, _, value = item.partition('=')
+            value = value.strip().strip('"') if _ else None
+            params.append((name.strip().lower(), value))
+        extensions.append((items[0].lower(), params))
+    return extensions
+
+
+def _window_bits(value):
+    if value is None or not value.isdigit() or not 8 <= int(value) <= 15:
+        return None
+    return int(value)
+
+
+class PerMessageDeflate:
+    """Server side settings for permessage-deflate, one instance is shared by
+    all clients and negotiate creates the per connection DeflateContext.
+
+    With context takeover each connection keeps its own compressor (around
+    256 KB with the default window and memory level). With
+    server_no_context_takeover every message is compressed on its own, which
+    costs some ratio but lets a broadcast compress a message once for all
+    clients with the same settings.
+    """
+    def __init__(self,
+                 server_no_context_takeover=False,
+                 client_no_context_takeover=False,
+                 server_max_window_bits=15,
+                 client_max_window_bits=15,
+                 compress_level=6,
+                 mem_level=8,
+                 min_size=128,
+                 max_message_size=16777216):
+        """
+        :param min_size: Messages smaller than this are sent uncompressed
+        :param max_message_size: Largest size a received message may inflate to,
+        larger messages raise MessageTooBig
+        """
+        if not 9 <= server_max_window_bits <= 15 or not 8 <= client_max_window_bits <= 15:
+            raise ValueError('Window bits out of range')
+        self.server_no_context_takeover = server_no_context_takeover
+        self.client_no_context_takeover = client_no_context_takeover
+        self.server_max_window_bits = server_max_window_bits
+        self.client_max_window_bits = client_max_window_bits
+        self.compress_level = compress_level
+        self.mem_level = mem_level
+        self.min_size = min_size
+        self.max_message_size = max_message_size
+
+    def negotiate(self, header):
+        """Accepts the first acceptable permessage-deflate offer in a
+        Sec-WebSocket-Extensions request header
+        :return: (response header value, DeflateContext) or None if nothing was accepted
+        """
+        for name, params in parse_extensions(header):
+            if name == 'permessage-deflate':
+                accepted = self._accept(params)
+                if accepted is not None:
+                    return accepted
+        return None
+
+    def _accept(self, params):
+        server_no_context_takeover = self.server_no_context_takeover
+        server_bits = self.server_max_window_bits
+        server_bits_offered = False
+        client_bits = None
+
+        seen = set()
+        for name, value in params:
+            if name in seen:
+                return None
+            seen.add(name)
+
+            if name == 'server_no_context_takeover':
+                if value is not None:
+                    return None
+                server_no_context_takeover = True
+            elif name == 'client_no_context_takeover':
+                if value is not None:
+                    return None
+            elif name == 'server_max_window_bits':
+                bits = _window_bits(value)
+                if bits is None or bits == 8:
+                    # zlib can not compress with a 256 byte window
+                    return None
+                server_bits = min(server_bits, bits)
+                server_bits_offered = True
+            elif name == 'client_max_window_bits':
+                if value is None:
+                    client_bits = 15
+                else:
+                    client_bits = _window_bits(value)
+                    if client_bits is None:
+                        return None
+            else:
+                return None
+
+        response = ['permessage-deflate']
+        if server_no_context_takeover:
+            response.append('server_no_context_takeover')
+        if self.client_no_context_takeover:
+            response.append('client_no_context_takeover')
+        if server_bits_offered or server_bits < 15:
+            response.append('server_max_window_bits={}'.format(server_bits))
+        if client_bits is not None and self.client_max_window_bits < client_bits:
+            response.append('client_max_window_bits={}'.format(self.client_max_window_bits))
+
+        context = DeflateContext(server_no_context_takeover, server_bits,
+                                 self.compress_level, self.mem_level,
+                                 self.min_size, self.max_message_size)
+        return '; '.join(response), context
+
+
+class DeflateContext:
+    """Negotiated permessage-deflate state of one connection"""
+    def __init__(self, no_context_takeover, window_bits, compress_level, mem_level,
+                 min_size, max_message_size):
+        self.no_context_takeover = no_context_takeover
+        self.window_bits = window_bits
+        self.compress_level = compress_level
+        self.mem_level = mem_level
+        self.min_size = min_size
+        self.max_message_size = max_message_size
+
+        # Messages compressed without context takeover only depend on these
+        # settings so they can be shared between connections
+        if no_context_takeover:
+            self.shared_key = (window_bits, compress_level, mem_level)
+        else:
+            self.shared_key = None
+
+        self._compressor = None
+        self._decompressor = None
+        self._inflated = 0  # Bytes inflated so far of a message decompressed in fragments
+
+    def should_compress(self, payload):
+        return len(payload) >= self.min_size
+
+    def compress(self, payload):
+        """Not thread safe, the caller keeps the messages in wire order"""
+        if self._compressor is None:
+            self._compressor = zlib.compressobj(self.compress_level, zlib.DEFLATED,
+                                                -self.window_bits, self.mem_level)
+        # A full flush also resets the compressor, the next message starts without context
+        mode = zlib.Z_FULL_FLUSH if self.no_context_takeover else zlib.Z_SYNC_FLUSH
+        data = self._compressor.compress(payload) + self._compressor.flush(mode)
+        return data[:-4] if data.endswith(_TAIL) else data
+
+    def decompress(self, payload, fin=True):
+        """
+        :param fin: False when payload is a fragment and the rest of the message follows
+        :raise MessageTooBig: If the message inflates to more than max_message_size bytes
+        """
+        if self._decompressor is None:
+            # A 32 KB window can inflate anything the client compressed
+            self._decompressor = zlib.decompressobj(-15)
+        limit = self.max_message_size - self._inflated
+        try:
+            # Fed separately so a memoryview payload (zero_copy) is not copied to append the tail
+            data = self._decompressor.decompress(payload, limit + 1)
+            if fin and len(data) <= limit:
+                data += self._decompressor.decompress(_TAIL, limit + 1 - len(data))
+        except zlib.error as e:
+            raise FrameError('Invalid compressed payload: {}'.format(e))
+        if len(data) > limit:
+            self._decompressor = None
+            self._inflated = 0
+            raise MessageTooBig('Message inflates to more than {} bytes'.format(self.max_message_size))
+        self._inflated = 0 if fin else self._inflated + len(data)
+        return data
+
+
+def compress_shared(payload, shared_key):
+    """Compresses a message once for every connection with the given DeflateContext.shared_key"""
+    window_bits, compress_level, mem_level = shared_key
+    compressor = zlib.compressobj(compress_level, zlib.DEFLATED, -window_bits, mem_level)
+    data = compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    return data[:-4] if data.endswith(_TAIL) else data
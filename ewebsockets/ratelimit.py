@@ -0,0 +1,110 @@
+#!/bin/env python3
+"""
+Token bucket rate limits. RateLimit holds the per-client limits on messages
+and bytes per second a server applies to what its clients send, every
+client gets its own buckets. TokenBucket is also used for the rate at
+which a server accepts connections.
+"""
+import threading
+from time import monotonic
+
+
+class TokenBucket:
+    """Holds up to burst tokens and gains rate tokens per second. Not thread safe,
+    use a lock when the bucket is shared.
+    """
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst=None):
+        """
+        :param rate: Tokens per second
+        :param burst: Most tokens held, defaults to rate
+        """
+        self.rate = rate
+        self.burst = rate if burst is None else burst
+        self.tokens = self.burst
+        self.updated = monotonic()
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def take(self, amount=1, now=None):
+        """Takes amount tokens if there are as many. Amounts larger than burst are
+        taken from a full bucket, which then goes into debt for the rest.
+        :return: True if taken
+        """
+        self._refill(monotonic() if now is None else now)
+        if self.tokens < min(amount, self.burst):
+            return False
+        self.tokens -= amount
+        return True
+
+    def charge(self, amount, now=None):
+        """Takes amount tokens whether there are any or not
+        :return: Seconds until the bucket is out of debt, 0 if it is not in debt
+        """
+        self._refill(monotonic() if now is None else now)
+        self.tokens -= amount
+        return -self.tokens / self.rate if self.tokens < 0 else 0
+
+
+class RateLimit:
+    """Limits on what each client may send, only text and binary frames count.
+    Control frames always pass.
+    """
+    # What happens to a client over its limit
+    PAUSE = 'pause'  # Reading from it stops until its buckets are out of debt
+    DROP = 'drop'  # Frames over the limit are discarded
+    CLOSE = 'close'  # It is closed with POLICY_VIOLATION
+
+    def __init__(self, messages_per_second=None, bytes_per_second=None, burst=1, policy=PAUSE):
+        """
+        :param messages_per_second: None for no limit
+        :param bytes_per_second: Payload bytes, None for no limit
+        :param burst: Seconds worth of messages and bytes a client may send at once,
+        with CLOSE a single message larger than burst * bytes_per_second closes the client
+        :param policy: RateLimit.PAUSE, RateLimit.DROP or RateLimit.CLOSE. Pauses are
+        accurate to the server's timer tick. With handle_message_chunk DROP drops
+        fragments, leaving the message incomplete.
+        """
+        if policy not in (RateLimit.PAUSE, RateLimit.DROP, RateLimit.CLOSE):
+            raise ValueError('Unknown rate limit policy: {}'.format(policy))
+        self.messages_per_second = messages_per_second
+        self.bytes_per_second = bytes_per_second
+        self.burst = burst
+        self.policy = policy
+
+    def buckets(self):
+        """
+        :return: (messages, bytes) TokenBuckets for a new client, None where there is no limit
+        """
+        return tuple(None if rate is None else TokenBucket(rate, rate * self.burst)
+                     for rate in (self.messages_per_second, self.bytes_per_second))
+
+
+class AcceptLimit:
+    """Connection limits of a server, thread safe"""
+    def __init__(self, max_connections=None, accept_rate=None, accept_burst=None):
+        """
+        :param max_connections: Most clients connected at once, None for no limit
+        :param accept_rate: Connections accepted per second, None for no limit
+        :param accept_burst: Connections accepted at once, defaults to accept_rate
+        """
+        self.max_connections = max_connections
+        self.bucket = None if accept_rate is None else TokenBucket(accept_rate, accept_burst)
+        self._lock = threading.Lock()
+
+    def admit(self, connections):
+        """
+        :param connections: Clients connected now
+        :return: None if a new connection is admitted, otherwise the name of the limit it hit
+        """
+        if self.max_connections is not None and connections >= self.max_connections:
+            return 'max_connections'
+        if self.bucket is not None:
+            with self._lock:
+                if not self.bucket.take(1):
+                    return 'accept_rate'
+        return None
@@ -0,0 +1,319 @@
+#!/bin/env python3
+"""
+Session resumption. With a SessionTable every client of a server gets a
+session, whose token is sent in the X-Session-Token header of the response
+to the upgrade request. The text and binary messages sent to the client are
+numbered 1, 2, ... and the latest are kept in a bounded buffer of the session.
+
+When a client disconnects without a normal close its session is kept for
+grace_period seconds in a table of at most max_detached sessions, the least
+recently detached are evicted first. Messages broadcast to all clients
+meanwhile are added to it.
+
+A client resumes by connecting with ?session=<token>&seq=<n> in the URL, n
+being the number of messages it received in the session. If all messages
+after n are still kept they are sent ahead of anything else, before
+on_open, and session.resumed is set. Otherwise the client gets a new
+session with a new token, and the application sends it its full state.
+Sessions live in the memory of one process, the clients of a restarted
+server all get new ones.
+"""
+import base64
+import os
+import threading
+from collections import OrderedDict, deque
+from itertools import islice
+from time import monotonic
+from urllib.parse import parse_qs, urlsplit
+from .RFC6455 import *
+from .ClientSocket import Client
+
+
+class Session:
+    """The messages sent to one client, numbered in order"""
+    __slots__ = ('token', 'codec', 'seq', 'max_messages', 'max_bytes', 'bytes', 'client',
+                 'resumed', 'resume_seq', 'detached_at', 'lock', '_messages')
+
+    def __init__(self, token, codec, max_messages, max_bytes):
+        self.token = token
+        self.codec = codec  # Of the client, messages broadcast while detached are encoded with it
+        self.seq = 0  # Sequence number of the last message
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.bytes = 0  # Payload bytes kept
+        self.client = None  # Client the session belongs to, None while detached
+        self.resumed = False  # True once a client resumed it and was sent what it missed
+        self.resume_seq = None  # Last message the resuming client received, until it is open
+        self.detached_at = None
+        self.lock = threading.Lock()
+        self._messages = deque()  # (seq, opcode, payload), payload None if it was not kept
+
+    def sent(self, frame):
+        """Adds a frame sent to the client, control frames and fragments are skipped"""
+        opcode = frame.opcode[0]
+        if opcode > 7 or not frame.fin:
+            return
+        # A fragmented message ends with a continuation frame, it is not kept
+        self.add(opcode, frame.payload if opcode else None)
+
+    def sent_packed(self, buffers):
+        """Adds a frame sent already packed, e.g. by broadcast"""
+        header = buffers[0]
+        opcode = header[0] & 0b00001111
+        if opcode > 7 or not header[0] & 0b10000000:
+            return
+        payload = None
+        if opcode and not header[0] & 0b01110000 and not header[1] & 0b10000000:
+            # Neither compressed nor masked
+            length = header[1] & 0b01111111
+            offset = 2 + (2 if length == 126 else 8 if length == 127 else 0)
+            if len(buffers) == 1:
+                payload = memoryview(header)[offset:]
+            elif len(buffers) == 2 and len(header) == offset and \
+                    isinstance(buffers[1], (bytes, bytearray, memoryview)):
+                payload = buffers[1]
+        self.add(opcode, payload)
+
+    def add(self, opcode, payload):
+        """Numbers a message and keeps it
+        :param opcode: int
+        :param payload: None for a message that is not kept, e.g. a file, a client that
+        received the messages before it can then no longer resume the session
+        """
+        with self.lock:
+            self._add(opcode, payload)
+
+    def _add(self, opcode, payload):
+        if payload is not None:
+            if len(payload) > self.max_bytes:
+                payload = None
+            elif type(payload) != bytes:
+                # Views into buffers that are reused
+                payload = bytes(payload)
+        self.seq += 1
+        self._messages.append((self.seq, opcode, payload))
+        if payload is not None:
+            self.bytes += len(payload)
+        if self.resume_seq is None:
+            # Kept whole until a resuming client is sent what it missed
+            self._trim()
+
+    def _trim(self):
+        messages = self._messages
+        while len(messages) > self.max_messages or self.bytes > self.max_bytes:
+            payload = messages.popleft()[2]
+            if payload is not None:
+                self.bytes -= len(payload)
+
+    def _missed(self, last_seq):
+        """
+        :param last_seq: Last message the client received
+        :return: List of the messages after last_seq, None if not all of them are kept
+        """
+        if last_seq < 0 or last_seq > self.seq:
+            return None
+        messages = self._messages
+        first = messages[0][0] if messages else self.seq + 1
+        if last_seq + 1 < first:
+            return None
+        missed = list(islice(messages, last_seq + 1 - first, None))
+        for seq, opcode, payload in missed:
+            if payload is None:
+                return None
+        return missed
+
+
+class SessionTable:
+    """Sessions of the clients of a server, thread safe. The lock of a session may be
+    taken with the table lock or the send lock of its client held, never the other
+    way around.
+    """
+    token_param = 'session'
+    seq_param = 'seq'
+    token_header = 'X-Session-Token'
+
+    def __init__(self, grace_period=60, max_detached=10000, max_messages=256, max_bytes=1048576):
+        """
+        :param grace_period: Seconds a session is kept after its client disconnected
+        :param max_detached: Sessions kept for disconnected clients, the least recently
+        detached are dropped first
+        :param max_messages: Messages kept per session
+        :param max_bytes: Payload bytes kept per session, larger messages are never kept.
+        The table holds at most about (max_detached + clients) * max_bytes
+        """
+        self.grace_period = grace_period
+        self.max_detached = max_detached
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.resumed = 0  # Sessions resumed
+        self.resynced = 0  # Resumptions refused because messages were no longer kept
+        self.expired = 0  # Sessions dropped before they were resumed
+        self._lock = threading.Lock()
+        self._detached = OrderedDict()  # token: Session, least recently detached first
+        self._claimed = set()  # Resumed sessions of clients that are not open yet
+        self._live = {}  # token: Session of a connected client
+
+    def __len__(self):
+        return len(self._detached)
+
+    def claim(self, client, request):
+        """Resumes the session named in the upgrade request if all messages the client
+        missed are kept, otherwise starts a new one
+        :return: Session of the client
+        """
+        query = parse_qs(urlsplit(request.path).query)
+        token = query.get(self.token_param, (None,))[0]
+        try:
+            last_seq = int(query[self.seq_param][0])
+        except (KeyError, ValueError):
+            last_seq = None
+
+        with self._lock:
+            self._expire(monotonic())
+            session = self._detached.pop(token, None) if token else None
+            if session is None and token in self._live:
+                # The client reconnected before its old connection was found to be gone
+                session = self._take_over(self._live.pop(token))
+            if session is not None:
+                with session.lock:
+                    resumable = last_seq is not None and session._missed(last_seq) is not None
+                    if resumable:
+                        session.client = client
+                        session.codec = client.codec
+                        session.resume_seq = last_seq
+                if resumable:
+                    self.resumed += 1
+                    self._claimed.add(session)
+                    self._live[token] = session
+                    return session
+                self.resynced += 1
+
+            session = Session(base64.urlsafe_b64encode(os.urandom(18)).decode(), client.codec,
+                              self.max_messages, self.max_bytes)
+            session.client = client
+            self._live[session.token] = session
+            return session
+
+    def _take_over(self, session):
+        """Takes a session from its old connection, which is aborted. Must be called with the lock held.
+        :return: The session, detached
+        """
+        old = session.client
+        with old.send_lock:
+            # Whatever is still sent to the old connection is not added to the session
+            old.session = None
+        old.abort()
+        with session.lock:
+            session.client = None
+            session.resume_seq = None
+        self._claimed.discard(session)
+        return session
+
+    def open(self, client):
+        """Sets a client open once its upgrade response is sent, after sending it the
+        messages it missed. The send lock is held throughout, nothing sent meanwhile
+        goes out ahead of them.
+        :return: False if the client should be disconnected
+        """
+        session = client.session
+        if session is None:
+            # Taken over by a newer connection
+            return False
+        pending_write = False
+        event = None
+        with client.send_lock:
+            with session.lock:
+                if session.client is not client:
+                    return False
+                missed = []
+                if session.resume_seq is not None:
+                    # None if something that is not kept was broadcast in the meantime
+                    missed = session._missed(session.resume_seq)
+                    session.resumed = True
+                    session.resume_seq = None
+                session._trim()
+                client.state = Client.OPEN
+            if missed is None:
+                return False
+            try:
+                for seq, opcode, payload in missed:
+                    queued = client._queue(frame=Frame(payload=payload, opcode=bytes((opcode,))),
+                                           record=False)
+                    if queued is None:
+                        return False
+                    pending_write = pending_write or queued[1]
+                    event = queued[2] or event
+            except (ClientDisconnect, OSError):
+                return False
+        with self._lock:
+            self._claimed.discard(session)
+        client._notify(pending_write, event)
+        return True
+
+    def detach(self, client):
+        """Keeps the session of a disconnected client for grace_period seconds,
+        unless the connection was closed normally
+        """
+        session = client.session
+        now = monotonic()
+        with self._lock:
+            self._claimed.discard(session)
+            with session.lock:
+                if session.client is not client:
+                    return
+                session.client = None
+                session.resume_seq = None
+                session._trim()
+            del self._live[session.token]
+            if client.close_code != 1000:
+                session.detached_at = now
+                self._detached[session.token] = session
+            self._expire(now)
+
+    def publish(self, opcode, payload):
+        """Adds a message broadcast to the open clients to the sessions of the clients
+        that are not open
+        :param payload: None for a message that is not kept
+        :return: Set of those sessions, their clients get the message once they resume
+        """
+        if type(payload) == str:
+            payload = payload.encode()
+        return self._publish(lambda codec: (opcode[0], payload))
+
+    def publish_message(self, obj):
+        """publish for a message encoded by the codec of each session"""
+        encoded = {}
+
+        def encode(codec):
+            if codec not in encoded:
+                encoded[codec] = ((OpCode.BINARY if codec.binary else OpCode.TEXT)[0], codec.encode(obj))
+            return encoded[codec]
+        return self._publish(encode)
+
+    def _publish(self, encode):
+        with self._lock:
+            self._expire(monotonic())
+            if not self._detached and not self._claimed:
+                return set()
+            sessions = list(self._detached.values())
+            sessions.extend(self._claimed)
+
+        # Added outside the table lock, connecting clients do not wait for the whole pass
+        published = set()
+        for session in sessions:
+            with session.lock:
+                # Clients set open in the meantime are sent the message instead
+                if session.client is None or session.client.state == Client.CONNECTING:
+                    session._add(*encode(session.codec))
+                    published.add(session)
+        return published
+
+    def _expire(self, now):
+        """Must be called with the lock held"""
+        detached = self._detached
+        while detached:
+            session = next(iter(detached.values()))
+            if len(detached) <= self.max_detached and now - session.detached_at < self.grace_period:
+                break
+            detached.popitem(last=False)
+            self.expired += 1
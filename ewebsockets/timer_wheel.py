@@ -0,0 +1,78 @@
+#!/bin/env python3
+"""
+Hashed timing wheel (Varghese and Lauck). Timers are hashed into a fixed
+ring of slots by their expiry tick, scheduling and cancelling are O(1) and
+each tick only looks at the timers in one slot, however many are scheduled.
+"""
+import logging
+from math import ceil
+from threading import Lock
+from time import monotonic
+
+
+class Timer:
+    def __init__(self, wheel, expires, callback, args):
+        self.wheel = wheel
+        self.expires = expires  # Tick number
+        self.callback = callback
+        self.args = args
+
+    def cancel(self):
+        self.wheel.cancel(self)
+
+
+class TimerWheel:
+    """Timers are accurate to one tick. Thread safe, callbacks run in the
+    thread calling advance, which should be done about every tick seconds.
+    """
+    def __init__(self, tick=0.5, slots=512):
+        """
+        :param tick: Seconds per slot
+        :param slots: Number of slots, timers further away than slots * tick
+        seconds share a slot with nearer ones and are skipped until they expire
+        """
+        self.tick = tick
+        self._slots = [set() for _ in range(slots)]
+        self._current = int(monotonic() / tick)
+        self._lock = Lock()
+
+    def __len__(self):
+        return sum(map(len, self._slots))
+
+    def schedule(self, delay, callback, *args):
+        """Calls callback(*args) after delay seconds
+        :return: Timer, which can be cancelled
+        """
+        with self._lock:
+            expires = max(self._current + 1, ceil((monotonic() + delay) / self.tick))
+            timer = Timer(self, expires, callback, args)
+            self._slots[expires % len(self._slots)].add(timer)
+        return timer
+
+    def cancel(self, timer):
+        with self._lock:
+            self._slots[timer.expires % len(self._slots)].discard(timer)
+
+    def advance(self, now=None):
+        """Runs the callbacks of the timers that expired since the last call
+        :return: Number of callbacks run
+        """
+        target = int((monotonic() if now is None else now) / self.tick)
+        expired = []
+        with self._lock:
+            slots = self._slots
+            # After a long pause every slot is visited once, not once per missed tick
+            for tick in range(self._current + 1, min(target, self._current + len(slots)) + 1):
+                slot = slots[tick % len(slots)]
+                if slot:
+                    due = [timer for timer in slot if timer.expires <= target]
+                    slot.difference_update(due)
+                    expired += due
+            self._current = max(self._current, target)
+
+        for timer in expired:
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                logging.exception('Unhandled exception in timer callback {}'.format(timer.callback))
+        return len(expired)
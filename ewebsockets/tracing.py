@@ -0,0 +1,139 @@
+#!/bin/env python3
+"""
+Opt-in tracing of the connection lifecycle and of the per-frame hot path.
+While a Tracer is started, the server records spans for accepting a
+connection (handle_incoming), do_handshake, and for 1 in sample frames
+the header parse, payload receive, unmask, handle_websocket_frame,
+Frame.pack and send_raw steps. Spans are (name, start, end, thread, args)
+tuples with monotonic nanosecond times, appended to a ring buffer and
+exported as Chrome trace event JSON (chrome://tracing, ui.perfetto.dev),
+where spans of one thread nest by time.
+
+Only one tracer is active at a time. Without one, every instrumented step
+costs a check of tracer for None, nothing is formatted or allocated.
+"""
+import json
+import os
+import threading
+from collections import deque
+from time import monotonic
+
+try:
+    from time import monotonic_ns
+except ImportError:
+    # Python < 3.7
+    def monotonic_ns():
+        return int(monotonic() * 1000000000)
+
+tracer = None  # The started Tracer, None while tracing is off
+
+
+class Tracer:
+    """Ring buffer of the latest spans. Subclasses may override add to send the
+    spans elsewhere as well.
+    """
+    def __init__(self, capacity=65536, sample=1):
+        """
+        :param capacity: Spans kept, the oldest are dropped
+        :param sample: Frames traced, 1 in sample received and 1 in sample sent.
+        Counted without a lock, so with several threads the rate is approximate.
+        Frames sent by the handler of a traced frame are always traced.
+        """
+        if sample < 1:
+            raise ValueError('sample must be at least 1, got {}'.format(sample))
+        self.sample = sample
+        self.spans = deque(maxlen=capacity)
+        self._received = 0
+        self._sent = 0
+        self._local = threading.local()
+
+    def start(self):
+        """Makes this the active tracer, replacing any other"""
+        global tracer
+        tracer = self
+
+    def stop(self):
+        global tracer
+        if tracer is self:
+            tracer = None
+
+    def sample_received(self):
+        """Counts a received frame
+        :return: True if the frame should be traced
+        """
+        self._received += 1
+        return self._received % self.sample == 0
+
+    def sample_sent(self):
+        """Counts a frame sent
+        :return: True if the frame should be traced
+        """
+        if getattr(self._local, 'handling', False):
+            return True
+        self._sent += 1
+        return self._sent % self.sample == 0
+
+    def handling(self, traced):
+        """Marks the calling thread as running the handler of a traced frame, or no longer"""
+        self._local.handling = traced
+
+    def add(self, name, start, end, args=None):
+        """
+        :param start: monotonic_ns() at the start of the span
+        :param end: monotonic_ns() at its end
+        :param args: Dictionary shown with the span, e.g. sizes
+        """
+        self.spans.append((name, start, end, threading.get_ident(), args))
+
+    def clear(self):
+        self.spans.clear()
+
+    def chrome_trace(self):
+        """
+        :return: The spans as a Chrome trace event format dictionary, times in microseconds
+        """
+        pid = os.getpid()
+        events = []
+        for name, start, end, thread, args in list(self.spans):
+            event = {'name': name, 'cat': 'ewebsockets', 'ph': 'X', 'pid': pid, 'tid': thread,
+                     'ts': start / 1000, 'dur': (end - start) / 1000}
+            if args:
+                event['args'] = args
+            events.append(event)
+        return {'traceEvents': events, 'displayTimeUnit': 'ns'}
+
+    def export(self, path):
+        """Writes chrome_trace() to path as JSON"""
+        with open(path, 'w') as file:
+            json.dump(self.chrome_trace(), file)
+
+
+def add(name, start, end=None, args=None):
+    """Adds a span to the active tracer, if there still is one
+    :param end: Defaults to now
+    """
+    active = tracer
+    if active is not None:
+        active.add(name, start, monotonic_ns() if end is None else end, args)
+
+
+def sampled(frames):
+    """
+    :param frames: A received frame or a list of them
+    :return: True if the frame or any of the list is traced
+    """
+    if type(frames) == list:
+        for frame in frames:
+            if frame.trace is not None:
+                return True
+        return False
+    return frames.trace is not None
+
+
+def frame_args(frames):
+    """
+    :return: args of the span of a handler call
+    """
+    if type(frames) == list:
+        return {'frames': len(frames)}
+    return {'opcode': frames.opcode[0], 'bytes': len(frames.payload)}
@@ -0,0 +1,540 @@
+#!/bin/env python3
+"""
+Client side of the protocol, for service to service connections. connect
+opens a single connection with a blocking opening handshake, ClientLoop
+runs many connections in one thread over one selector and ClientPool keeps
+connections to a set of URLs open on a ClientLoop, reconnecting with
+exponential backoff when they are lost. Frames are packed and parsed by
+the same Client, Frame and FrameParser code as on the server, everything
+sent is masked with keys from masking.new_masking_key.
+"""
+import errno
+import logging
+import random
+import selectors
+import socket
+import threading
+from collections import deque
+from time import monotonic, sleep
+from urllib.parse import urlsplit
+from .RFC6455 import *
+from .ClientSocket import Client
+from .handshake import new_key, pack_request, parse_response
+from .timer_wheel import TimerWheel
+
+# Largest handshake response in bytes
+MAX_RESPONSE_SIZE = 16384
+
+
+def parse_url(url):
+    """
+    :return: (host, port, resource) of a ws:// URL, resource is the path and query
+    """
+    parts = urlsplit(url)
+    if parts.scheme != 'ws':
+        raise ValueError('Only ws:// URLs are supported: {}'.format(url))
+    if not parts.hostname:
+        raise ValueError('No host in URL: {}'.format(url))
+    resource = parts.path or '/'
+    if parts.query:
+        resource += '?' + parts.query
+    return parts.hostname, parts.port or 80, resource
+
+
+class _Handshake:
+    """The opening handshake of one connection attempt"""
+    def __init__(self, url, subprotocols=None, origin=None, headers=None):
+        self.url = url
+        host, port, resource = parse_url(url)
+        self.address = (host, port)
+        self.subprotocols = subprotocols
+        self.key = new_key()
+        if ':' in host:
+            # An IPv6 address is bracketed in the Host header as in the URL
+            host = '[{}]'.format(host)
+        self.request = pack_request(host if port == 80 else '{}:{}'.format(host, port),
+                                    resource, self.key, subprotocols, origin, headers)
+        self._buffer = b''
+
+    def feed(self, data):
+        """
+        :return: (response headers, the data that followed the response) once the
+        response is complete, None while more data is needed
+        :raise ConnectError: If the server did not accept the upgrade
+        """
+        if not data:
+            raise ConnectError('Connection closed during the handshake')
+        self._buffer += data
+        end = self._buffer.find(b'\r\n\r\n')
+        if end < 0:
+            if len(self._buffer) > MAX_RESPONSE_SIZE:
+                raise ConnectError('Handshake response larger than {} bytes'.format(MAX_RESPONSE_SIZE))
+            return None
+        return parse_response(self._buffer[:end], self.key, self.subprotocols), self._buffer[end+4:]
+
+
+class WebsocketClient(Client):
+    """A connection to a server, in open state once created. Everything it sends
+    is masked. Without a ClientLoop frames are read with recv, sends that do
+    not fit in the socket buffer block until they are sent.
+    """
+    __slots__ = ('url', 'response', 'loop', 'handle_websocket_frame', '_received', '_selector', '_flushing')
+
+    def __init__(self, sock, address, url, response, loop=None,
+                 handle_websocket_frame=lambda client, frame: True, **kwargs):
+        """
+        :param response: Headers of the handshake response
+        :param loop: The ClientLoop reading from the connection, None to read with recv
+        :param handle_websocket_frame: Called by the loop with every finished frame,
+        return False to close the connection
+        :param kwargs: Client arguments, e.g. codec, max_message_size or on_close
+        """
+        kwargs.setdefault('on_pending_write', self._send_pending)
+        Client.__init__(self, sock, address, state=Client.OPEN, **kwargs)
+        self.handshake_parser = None
+        self.url = url
+        self.response = response
+        self.subprotocol = response.get('sec-websocket-protocol')
+        self.loop = loop
+        self.handle_websocket_frame = handle_websocket_frame
+        self._received = deque()
+        self._selector = None  # Waits for the socket without a loop
+        self._flushing = False
+
+    def _pack(self, frame):
+        # A client masks every frame it sends (RFC 6455 section 5.3), the masked copy
+        # leaves the caller's frame as it was
+        if not frame.mask:
+            frame = Frame(fin=frame.fin,
+                          rsv=frame.rsv,
+                          opcode=frame.opcode,
+                          mask=1,
+                          payload=frame.payload)
+        return Client._pack(self, frame)
+
+    def _can_sendfile(self, length):
+        # Masked frames are never streamed from the file
+        return False
+
+    def _wait(self, events, timeout):
+        """
+        :return: False if the socket did not become ready within timeout seconds
+        """
+        if self._selector is None:
+            self._selector = selectors.DefaultSelector()
+            self._selector.register(self.socket, events)
+        else:
+            self._selector.modify(self.socket, events)
+        return bool(self._selector.select(timeout))
+
+    def _send_pending(self, client):
+        """on_pending_write without a loop, sends the rest of the send queue before returning"""
+        if self._flushing:
+            # The loop below sends it
+            return
+        self._flushing = True
+        try:
+            while self.send_queue:
+                self._wait(selectors.EVENT_WRITE, None)
+                self.flush()
+        finally:
+            self._flushing = False
+
+    def recv(self, timeout=None):
+        """Waits for the next finished text or binary frame, pings and close frames
+        are answered on the way. Not for connections on a ClientLoop.
+        :return: Frame, None if none arrived within timeout seconds
+        :raise ClientDisconnect: Once the connection is closed
+        """
+        deadline = None if timeout is None else monotonic() + timeout
+        while True:
+            while self._received:
+                frame = self._received.popleft()
+                if frame.fin and (frame.opcode == OpCode.TEXT or frame.opcode == OpCode.BINARY):
+                    return frame
+                if frame.opcode == OpCode.CLOSE:
+                    self.disconnect()
+                    raise ClientDisconnect('Closed by the server')
+            if self.state == Client.CLOSED:
+                raise ClientDisconnect('Connection closed')
+            self._received.extend(self.recv_frames())
+            if self._received:
+                continue
+            remaining = None if deadline is None else deadline - monotonic()
+            if remaining is not None and remaining <= 0:
+                return None
+            self._wait(selectors.EVENT_READ, remaining)
+
+    def close(self, status_code=StatusCode.NORMAL_CLOSE, reason=b'', timeout=3):
+        """Sends a close frame. On a ClientLoop the connection is closed once the
+        server answers or after timeout seconds, without a loop this waits for the answer.
+        """
+        Client.close(self, status_code, reason, timeout)
+        if self.loop is not None:
+            return
+        deadline = monotonic() + timeout
+        try:
+            while self.state != Client.CLOSED and self._wait(selectors.EVENT_READ, deadline - monotonic()):
+                # The close frame of the server closes the client while it is read
+                self.recv_frames()
+        except (ClientDisconnect, FrameError, MessageTooBig, OSError):
+            pass
+        self.disconnect()
+
+    def disconnect(self):
+        """Closes the socket, without a closing handshake if the client is still open"""
+        if self.state != Client.CLOSED:
+            self.state = Client.CLOSED
+            self.on_close(self)
+        if self._selector is not None:
+            self._selector.close()
+            self._selector = None
+        self.socket.close()
+
+
+def connect(url, timeout=10, subprotocols=None, origin=None, headers=None, **kwargs):
+    """Opens a connection to a ws:// URL and performs the opening handshake
+    :param timeout: Seconds to connect and complete the handshake
+    :param subprotocols: Subprotocols to offer, client.subprotocol is the one accepted
+    :param headers: Dictionary of further request headers
+    :param kwargs: WebsocketClient arguments, e.g. codec or max_message_size
+    :return: WebsocketClient
+    :raise ConnectError: If the server did not accept the upgrade
+    """
+    handshake = _Handshake(url, subprotocols, origin, headers)
+    sock = socket.create_connection(handshake.address, timeout)
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.sendall(handshake.request)
+        result = None
+        while result is None:
+            result = handshake.feed(sock.recv(4096))
+        sock.setblocking(False)
+        client = WebsocketClient(sock, sock.getpeername(), url, result[0], **kwargs)
+    except:
+        sock.close()
+        raise
+    # Frames sent right behind the response
+    client.parser.feed(result[1])
+    return client
+
+
+class _Connecting:
+    """A connection of a ClientLoop until its handshake is complete"""
+    __slots__ = ('handshake', 'sock', 'kwargs', 'on_open', 'on_error', 'sent', 'timer')
+
+    def __init__(self, handshake, sock, kwargs, on_open, on_error):
+        self.handshake = handshake
+        self.sock = sock
+        self.kwargs = kwargs
+        self.on_open = on_open
+        self.on_error = on_error
+        self.sent = 0
+        self.timer = None
+
+
+class ClientLoop:
+    """Runs connections in a single thread, connecting, reading and writing on
+    one selector, so thousands of connections take a socket each but no thread.
+    Frames are handed to the handle_websocket_frame of their connection from
+    the loop thread, which should not block in it.
+    """
+    def __init__(self, max_frames_per_pass=256, close_timeout=3, selector=selectors.DefaultSelector):
+        """
+        :param max_frames_per_pass: Frames read from one connection before the others get their turn
+        :param close_timeout: Seconds the server has to answer a close frame
+        """
+        self.max_frames_per_pass = max_frames_per_pass
+        self.close_timeout = close_timeout
+        self.clients = set()  # Open connections
+        self.timers = TimerWheel(tick=0.1)  # Handshake and close deadlines, reconnects
+        self._selector = selector()
+        self._connecting = set()
+        self._thread = None
+        self._stopping = threading.Event()
+
+    def start(self):
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name='client-loop', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Closes every connection at once, waits at most timeout seconds
+        (close_timeout by default) for the answers and stops the thread
+        """
+        if timeout is None:
+            timeout = self.close_timeout
+        for client in list(self.clients):
+            try:
+                client.close(StatusCode.ENDP_GOING_AWAY, timeout=timeout)
+            except (ClientDisconnect, OSError):
+                self._remove(client)
+        deadline = monotonic() + timeout
+        while self.clients and monotonic() < deadline:
+            sleep(0.01)
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        for client in list(self.clients):
+            self._remove(client)
+        for connecting in list(self._connecting):
+            self._failed(connecting, ConnectError('Client loop stopped'))
+
+    def connect(self, url, handle_websocket_frame=lambda client, frame: True,
+                on_open=lambda client: True, on_error=lambda url, error: True,
+                timeout=10, subprotocols=None, origin=None, headers=None, **kwargs):
+        """Starts connecting to a ws:// URL without waiting for it, the loop
+        thread performs the handshake
+        :param on_open: Called with the WebsocketClient once it is open
+        :param on_error: Called as on_error(url, exception) if the connection or
+        the handshake failed or did not complete within timeout seconds
+        :param kwargs: WebsocketClient arguments, e.g. codec or on_close
+        """
+        handshake = _Handshake(url, subprotocols, origin, headers)
+        kwargs['handle_websocket_frame'] = handle_websocket_frame
+        sock = None
+        try:
+            # Resolved in the calling thread, the connection goes to the first address
+            family, kind, proto, _, address = socket.getaddrinfo(*handshake.address, type=socket.SOCK_STREAM)[0]
+            sock = socket.socket(family, kind, proto)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setblocking(False)
+            error = sock.connect_ex(address)
+            if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                raise OSError(error, 'Connecting to {} failed'.format(url))
+        except OSError as e:
+            if sock is not None:
+                sock.close()
+            on_error(url, e)
+            return
+        connecting = _Connecting(handshake, sock, kwargs, on_open, on_error)
+        self._connecting.add(connecting)
+        connecting.timer = self.timers.schedule(timeout, self._failed, connecting,
+                                                ConnectError('Handshake not completed within {} seconds'.format(timeout)))
+        self._selector.register(sock, selectors.EVENT_WRITE, connecting)
+
+    def _run(self):
+        while not self._stopping.is_set():
+            for key, events in self._selector.select(self.timers.tick):
+                if type(key.data) == _Connecting:
+                    self._handshake(key.data, events)
+                    continue
+                client = key.data
+                if events & selectors.EVENT_WRITE:
+                    self._flush(client)
+                if events & selectors.EVENT_READ:
+                    self._read(client)
+            self.timers.advance()
+
+    def _handshake(self, connecting, events):
+        handshake = connecting.handshake
+        try:
+            if events & selectors.EVENT_WRITE:
+                connecting.sent += connecting.sock.send(handshake.request[connecting.sent:])
+                if connecting.sent == len(handshake.request):
+                    self._selector.modify(connecting.sock, selectors.EVENT_READ, connecting)
+                return
+            result = handshake.feed(connecting.sock.recv(4096))
+        except BlockingIOError:
+            return
+        except (ConnectError, OSError) as e:
+            self._failed(connecting, e)
+            return
+        if result is None:
+            return
+
+        self._connecting.discard(connecting)
+        connecting.timer.cancel()
+        sock = connecting.sock
+        client = WebsocketClient(sock, sock.getpeername(), handshake.url, result[0], loop=self,
+                                 on_pending_write=self._wait_writable,
+                                 on_closing=self._closing,
+                                 **connecting.kwargs)
+        client.parser.feed(result[1])
+        self.clients.add(client)
+        self._selector.modify(sock, selectors.EVENT_READ, client)
+        logging.debug('{}: Connected to {}'.format(client.address, handshake.url))
+        connecting.on_open(client)
+        if len(client.parser):
+            self._read(client)
+
+    def _failed(self, connecting, error):
+        if connecting not in self._connecting:
+            return
+        self._connecting.discard(connecting)
+        connecting.timer.cancel()
+        try:
+            self._selector.unregister(connecting.sock)
+        except (KeyError, ValueError):
+            pass
+        connecting.sock.close()
+        logging.info('Connecting to {} failed, {}'.format(connecting.handshake.url, error))
+        connecting.on_error(connecting.handshake.url, error)
+
+    def _read(self, client):
+        try:
+            for frames in client.drain_frames(self.max_frames_per_pass):
+                for frame in frames:
+                    if frame.opcode == OpCode.CLOSE:
+                        # Answered and closed by the client while it was read
+                        self._remove(client)
+                        return
+                    if frame.fin and not client.handle_websocket_frame(client, frame):
+                        logging.info('{}: Closing connection because handle_websocket_frame '
+                                     'returned false'.format(client.address))
+                        client.close(timeout=self.close_timeout)
+                        return
+        except (FrameError, MessageTooBig) as e:
+            logging.info('{}: Closing connection, {}'.format(client.address, e))
+            try:
+                client.close(StatusCode.PROTOCOL_ERROR, timeout=0)
+            except (ClientDisconnect, OSError):
+                pass
+            self._remove(client)
+        except (ClientDisconnect, OSError):
+            logging.debug('{}: Connection lost'.format(client.address))
+            self._remove(client)
+
+    def _wait_writable(self, client):
+        try:
+            self._selector.modify(client.socket, selectors.EVENT_READ | selectors.EVENT_WRITE, client)
+        except (KeyError, ValueError, OSError):
+            # Removed in the meantime
+            pass
+
+    def _flush(self, client):
+        try:
+            # Watched for writability again if flush leaves data in the send queue
+            self._selector.modify(client.socket, selectors.EVENT_READ, client)
+            client.flush()
+        except (KeyError, ValueError):
+            pass
+        except (ClientDisconnect, OSError):
+            logging.debug('{}: Connection lost while flushing'.format(client.address))
+            self._remove(client)
+
+    def _closing(self, client, timeout):
+        self.timers.schedule(timeout, self._close_expired, client)
+
+    def _close_expired(self, client):
+        if client in self.clients:
+            logging.info('{}: Close frame not answered in time'.format(client.address))
+            self._remove(client)
+
+    def _remove(self, client):
+        if client not in self.clients:
+            return
+        self.clients.discard(client)
+        try:
+            self._selector.unregister(client.socket)
+        except (KeyError, ValueError):
+            pass
+        client.disconnect()
+
+
+class ClientPool:
+    """Keeps size connections open to every URL it is asked for, on a ClientLoop.
+    Lost connections are reconnected after a delay doubling from min_delay up to
+    max_delay with every failed attempt, randomized so that clients do not
+    reconnect in lockstep after a server restart.
+    """
+    def __init__(self, loop, size=1,
+                 handle_websocket_frame=lambda client, frame: True,
+                 on_open=lambda client: True,
+                 on_close=lambda client: True,
+                 min_delay=0.5,
+                 max_delay=30,
+                 **connect_kwargs):
+        """
+        :param loop: A started ClientLoop
+        :param size: Connections per URL
+        :param connect_kwargs: ClientLoop.connect arguments, e.g. timeout, subprotocols or codec
+        """
+        self.loop = loop
+        self.size = size
+        self.handle_websocket_frame = handle_websocket_frame
+        self.on_open = on_open
+        self.on_close = on_close
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.connect_kwargs = connect_kwargs
+        self._connections = {}  # url: list of size clients, None where not connected
+        self._delays = {}  # (url, index): delay of the next reconnect
+        self._next = {}  # url: index get tries first
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def get(self, url, timeout=10):
+        """Returns an open connection to url, round robin over the pool, and
+        connects the pool to url on first use
+        :raise ConnectError: If no connection is open within timeout seconds
+        """
+        deadline = monotonic() + timeout
+        with self._condition:
+            if url not in self._connections:
+                self._connections[url] = [None] * self.size
+                self._next[url] = 0
+                for index in range(self.size):
+                    self._delays[url, index] = self.min_delay
+                    self._connect(url, index)
+            connections = self._connections[url]
+            while not self._closed:
+                for _ in range(self.size):
+                    index = self._next[url]
+                    self._next[url] = (index + 1) % self.size
+                    client = connections[index]
+                    if client is not None and client.state == Client.OPEN:
+                        return client
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+        raise ConnectError('No open connection to {}'.format(url))
+
+    def close(self):
+        """Closes the connections and stops reconnecting"""
+        with self._condition:
+            self._closed = True
+            clients = [client for connections in self._connections.values()
+                       for client in connections if client is not None]
+            self._condition.notify_all()
+        for client in clients:
+            try:
+                client.close(StatusCode.ENDP_GOING_AWAY)
+            except (ClientDisconnect, OSError):
+                pass
+
+    def _connect(self, url, index):
+        if self._closed:
+            return
+        self.loop.connect(url, self.handle_websocket_frame,
+                          on_open=lambda client: self._opened(url, index, client),
+                          on_error=lambda url, error: self._reconnect(url, index),
+                          on_close=lambda client: self._lost(url, index, client),
+                          **self.connect_kwargs)
+
+    def _opened(self, url, index, client):
+        with self._condition:
+            self._connections[url][index] = client
+            self._delays[url, index] = self.min_delay
+            self._condition.notify_all()
+        self.on_open(client)
+
+    def _lost(self, url, index, client):
+        with self._condition:
+            if self._connections[url][index] is not client:
+                return
+            self._connections[url][index] = None
+        self.on_close(client)
+        self._reconnect(url, index)
+
+    def _reconnect(self, url, index):
+        with self._condition:
+            if self._closed:
+                return
+            delay = self._delays[url, index]
+            self._delays[url, index] = min(self.max_delay, delay * 2)
+        delay = random.uniform(delay / 2, delay)
+        logging.debug('Reconnecting to {} in {:.2f} seconds'.format(url, delay))
+        self.loop.timers.schedule(delay, self._connect, url, index)
@@ -2,8 +2,48 @@
 
 import esockets
 import logging
+import selectors
+import socket
+import threading
+from time import monotonic, perf_counter, sleep
 from .RFC6455 import *
-from .ClientSocket import Client
+from .ClientSocket import Client, broadcast, broadcast_message, broadcast_file
+from .codecs import JSON
+from .timer_wheel import TimerWheel
+from .heartbeat import Heartbeat
+from .handshake import SERVICE_UNAVAILABLE
+from .ratelimit import RateLimit, AcceptLimit
+from .metrics import ServerMetrics, serve
+from . import tracing
+from .tracing import monotonic_ns
+
+
+class _SocketServer(esockets.SocketServer):
+    """Leaves a socket out of the selector when handle_readable returns PAUSE,
+    whoever resumes reading registers it again
+    """
+    PAUSE = 'pause'
+
+    def reuse_port(self):
+        """Lets other processes listen on the same port through SO_REUSEPORT, to be
+        called before start. esockets creates its listening socket itself and takes
+        none from outside, so this sets the option on its private _server_socket.
+        """
+        self._server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+    @esockets.socket_server.Log('errors')
+    def _subthread_handle_readable(self, conn):
+        keep = self.handle_readable(conn)
+        if keep is self.PAUSE:
+            return
+        if keep:
+            try:
+                self.register(conn)
+            except (ValueError, OSError):
+                # Closed by another thread meanwhile, e.g. by close_connection
+                pass
+        else:
+            self.disconnect(conn)
 
 
 class Websocket:
@@ -12,85 +52,626 @@ class Websocket:
                  handle_websocket_frame=lambda client, frame: True,
                  on_client_open=lambda client: True,
                  on_client_close=lambda client: True,
+                 handle_message_chunk=None,
+                 handle_websocket_frames=None,
+                 max_frames_per_pass=256,
+                 executor=None,
+                 zero_copy=False,
+                 permessage_deflate=None,
+                 max_message_size=16777216,
+                 max_handshake_size=8192,
+                 codec=JSON,
+                 handshake_timeout=10,
+                 ping_interval=20,
+                 pong_timeout=10,
+                 idle_timeout=None,
+                 close_timeout=3,
+                 rate_limit=None,
+                 max_connections=None,
+                 accept_rate=None,
+                 accept_burst=None,
+                 recorder=None,
+                 sessions=None,
+                 metrics=False,
+                 client_kwargs={},
                  esockets_kwargs={}):
+        """
+        :param handle_new_connection: Called once the upgrade request of a client is
+        parsed, with its headers in client.request (path, origin, subprotocols, ...).
+        Return False to refuse the connection with 403 Forbidden. Set client.subprotocol
+        to accept one of the offered subprotocols.
+        :param handle_message_chunk: Opt-in streaming of messages, called as
+        handle_message_chunk(client, frame) with every fragment of a text/binary
+        message as it arrives (an unfragmented message is a single fragment).
+        frame.opcode is the opcode of the message and frame.fin is set on its
+        last fragment. Messages are then never assembled in memory and
+        handle_websocket_frame only receives control frames. Return False to
+        close the connection.
+        :param handle_websocket_frames: Batch alternative to handle_websocket_frame, called
+        as handle_websocket_frames(client, frames) with the list of finished frames that
+        arrived together, in order, so the work per batch can be shared (e.g. one database
+        write). Return False to close the connection.
+        :param max_frames_per_pass: Frames read from one client per readable event, the
+        socket is drained until then. Whatever is left waits for the next event, after
+        the other readable clients had their turn.
+        :param executor: executor.OrderedExecutor to run the frame handlers on, in order per
+        client, instead of the thread that read the frames. Reading from a client stops
+        while it has executor.max_pending handler calls queued. A handler returning False
+        then closes the connection once it has run. None runs the handlers right away.
+        :param zero_copy: Deliver text/binary frames with a memoryview payload into the
+        clients receive buffer instead of a bytes copy. The memoryview is only valid
+        during the handle_websocket_frame call, copy it with bytes() to keep it or to
+        send it, sends are queued and may happen after the buffer is reused.
+        :param permessage_deflate: PerMessageDeflate settings to enable compression
+        :param max_message_size: Largest message in bytes a client may send, the
+        connection is closed with MESSAGE_TOO_BIG when exceeded. None for no limit
+        :param max_handshake_size: Largest upgrade request in bytes
+        :param codec: codecs.Codec of the clients, used by send_message, broadcast_message
+        and frame.message. handle_new_connection may set client.codec to pick another,
+        e.g. by subprotocol
+        :param handshake_timeout: Seconds a client has to complete its upgrade request
+        before it is disconnected
+        :param ping_interval: Seconds without any frame from a client before the server
+        pings it, None to never ping. client.rtt holds the round trip time of the last ping.
+        :param pong_timeout: Seconds a client has to answer a ping before it is disconnected
+        :param idle_timeout: Seconds without text/binary messages from a client before it
+        is closed, None to never close idle clients
+        :param close_timeout: Seconds a client has to answer a close frame before it is
+        disconnected, the default of close_connection and stop
+        :param rate_limit: ratelimit.RateLimit on the messages and bytes per second of each
+        client, and whether a client over it is paused, has frames dropped or is closed
+        :param max_connections: Most clients connected at once, more are refused with
+        503 Service Unavailable. None for no limit
+        :param accept_rate: Connections accepted per second, more are refused like above.
+        None for no limit
+        :param accept_burst: Connections accepted at once, defaults to accept_rate
+        :param recorder: Started capture.Recorder logging the frames of every client, for
+        capture.Replayer to send them again
+        :param sessions: sessions.SessionTable to let clients that reconnect resume their
+        session and be sent the messages they missed, client.session.resumed tells on_client_open
+        whether they were. Messages broadcast to all clients are kept for the disconnected ones.
+        :param metrics: Time the handle_websocket_frame(s)/handle_message_chunk calls for the
+        frame_handler_seconds histogram of stats(), which costs around 10% of the frames per
+        second of a trivial handler (benchmarks/metrics.py). The counters are always kept.
+        :param client_kwargs: Keyword arguments for each Client, e.g. the send queue
+        watermarks, limits and callbacks (high_watermark, low_watermark, max_send_queue,
+        overflow_timeout, overflow_policy, on_backpressure, on_drain)
+        """
 
         self.handle_new_connection = handle_new_connection
         self.handle_websocket_frame = handle_websocket_frame
         self.on_client_open = on_client_open
         self.on_client_close = on_client_close
+        self.handle_message_chunk = handle_message_chunk
+        self.handle_websocket_frames = handle_websocket_frames
+        self.max_frames_per_pass = max_frames_per_pass
+        self.executor = executor
+        self.zero_copy = zero_copy
+        self.permessage_deflate = permessage_deflate
+        self.max_message_size = max_message_size
+        self.max_handshake_size = max_handshake_size
+        self.codec = codec
+        self.handshake_timeout = handshake_timeout
+        self.close_timeout = close_timeout
+        self.rate_limit = rate_limit
+        self._rate_paused = {}  # Client: Timer resuming it
+        self.recorder = recorder
+        self.sessions = sessions
+        self.accept_limit = None
+        if max_connections is not None or accept_rate is not None:
+            self.accept_limit = AcceptLimit(max_connections, accept_rate, accept_burst)
+        self.client_kwargs = dict(client_kwargs)
 
         kwargs = dict(esockets_kwargs)
         kwargs.update({'handle_incoming': self._handle_incoming})
         kwargs.update({'handle_readable': self._handle_readable})
-        self.server = esockets.SocketServer(**kwargs)
+        self.server = _SocketServer(**kwargs)
+
+        self.clients = {}  # fd: Client, the socket objects are only referenced by the clients
+
+        # Clients with data left in their send queue wait here for the socket to become writable
+        self._write_selector = self.server.selector()
+        self._flush_thread = None
+        self._stop_flushing = threading.Event()
+        self._stopping = False
+
+        # Handshake deadlines and heartbeats, advanced by the flush thread
+        self.timers = TimerWheel()
+        self.heartbeat = Heartbeat(self.timers, self._expire_client,
+                                   ping_interval, pong_timeout, idle_timeout)
 
-        self.clients = {}
+        self.metrics = ServerMetrics()
+        self.time_handlers = metrics
+        self._metrics_server = None
 
     def _handle_incoming(self, sock, address):
         """The esockets required function for handling incoming client connections
         """
+        if tracing.tracer is None:
+            return self._accept(sock, address)
+        accepting = monotonic_ns()
+        accepted = self._accept(sock, address)
+        tracing.add('handle_incoming', accepting, None, {'fd': sock.fileno(), 'accepted': accepted})
+        return accepted
+
+    def _accept(self, sock, address):
+        """
+        :return: False if the connection is refused
+        """
+        if self._stopping:
+            return False
+        if self.accept_limit is not None:
+            limit = self.accept_limit.admit(len(self.clients))
+            if limit is not None:
+                logging.debug('{}: Connection refused, {} reached'.format(address, limit))
+                self.metrics.limit_hit(limit)
+                try:
+                    sock.send(SERVICE_UNAVAILABLE)
+                except OSError:
+                    pass
+                return False
         client = Client(sock, address,
                         on_open=self.on_client_open,
-                        on_close=self.on_client_close)
-        if self.handle_new_connection(client):
-            self.clients[sock] = client
-            return True
-        return False
+                        on_close=self.on_client_close,
+                        on_request=self.handle_new_connection,
+                        zero_copy=self.zero_copy,
+                        permessage_deflate=self.permessage_deflate,
+                        max_message_size=self.max_message_size,
+                        stream_messages=self.handle_message_chunk is not None,
+                        max_handshake_size=self.max_handshake_size,
+                        codec=self.codec,
+                        on_pending_write=self._wait_writable,
+                        on_closing=self._closing,
+                        sessions=self.sessions,
+                        **self.client_kwargs)
+        if self.recorder is not None:
+            client.recorder = self.recorder.tap()
+        self.clients[client.fd] = client
+        self.timers.schedule(self.handshake_timeout, self._handshake_expired, client)
+        return True
 
     def _handle_readable(self, sock):
         """The esockets required function for handling incoming data from clients
         """
-        client_obj = self.clients[sock]
+        client_obj = self.clients.get(sock.fileno())
+        if client_obj is None:
+            # Removed by another thread since the socket was found readable, e.g. by close_connection
+            return False
         if client_obj.state == Client.CONNECTING:
-            # handshake_success = client_obj.do_handshake()
-            # if handshake_success:
-            #     self.on_client_open(client_obj)
-            # return handshake_success
-            return client_obj.do_handshake()
-        elif client_obj.state == Client.OPEN or client_obj.state == Client.CLOSING:
-            frame = client_obj.recv_frame()
+            handshaking = None if tracing.tracer is None else monotonic_ns()
+            shaken = client_obj.do_handshake()
+            if handshaking is not None:
+                tracing.add('do_handshake', handshaking, None, {'fd': client_obj.fd, 'state': client_obj.state})
+            if not shaken:
+                self.metrics.handshake(client_obj)
+                self._remove_client(client_obj)
+                return False
+            if client_obj.state == Client.CONNECTING:
+                return True
+            self.metrics.handshake(client_obj)
+            self.heartbeat.add(client_obj)
+            if self.rate_limit is not None:
+                client_obj.rate_buckets = self.rate_limit.buckets()
+            if not len(client_obj.parser):
+                return True
+            # Frames arrived together with the handshake
+
+        if client_obj.state == Client.OPEN or client_obj.state == Client.CLOSING:
+            try:
+                for frames in client_obj.drain_frames(self.max_frames_per_pass):
+                    delay = 0
+                    if frames and client_obj.rate_buckets is not None:
+                        frames, delay = self._rate_limit(client_obj, frames)
+                        if frames is None:
+                            logging.info('{}: Closing connection, rate limit exceeded'.format(client_obj.address))
+                            return self._close_readable(client_obj, StatusCode.POLICY_VIOLATION)
+                    if frames and not self._dispatch(client_obj, frames):
+                        return False
+                    if delay:
+                        return self._pause_rate_limited(client_obj, delay)
+                    if self.executor is not None and \
+                            self.executor.pending(client_obj) >= self.executor.max_pending:
+                        return self._pause_reading(client_obj)
+            except FrameError as e:
+                logging.info('{}: Closing connection, {}'.format(client_obj.address, e))
+                return self._close_readable(client_obj)
+            except MessageTooBig as e:
+                logging.info('{}: Closing connection, {}'.format(client_obj.address, e))
+                return self._close_readable(client_obj, StatusCode.MESSAGE_TOO_BIG)
+            except (ClientDisconnect, ConnectionError):
+                logging.debug('{}: Connection lost'.format(client_obj.address))
+                self._remove_client(client_obj)
+                return False
+            except Exception:
+                # Otherwise esockets only logs it, the socket and the client would be left behind
+                logging.exception('{}: Closing connection, unexpected error'.format(client_obj.address))
+                return self._close_readable(client_obj, StatusCode.UNEXPECTED_CONDITION)
+            return True
+
+        # Closed without the closing handshake, e.g. by the heartbeat
+        self._remove_client(client_obj)
+        return False
+
+    def _dispatch(self, client_obj, frames):
+        """Hands the frames of one read to the handlers
+        :return: False once the connection is closed
+        """
+        batch = []
+        closed = False
+        for frame in frames:
             if not OpCode.is_valid(frame.opcode):
-                self.close_connection(sock)
                 logging.info('{}: Closing connection, invalid opcode: {}'.format(client_obj.address, frame.opcode))
-                return False
+                return self._close_readable(client_obj)
+
+            if self.handle_message_chunk is not None and \
+                    (frame.opcode == OpCode.TEXT or frame.opcode == OpCode.BINARY):
+                if not self._handle(self.handle_message_chunk, client_obj, frame):
+                    logging.info('{}: Closing connection because handle_message_chunk returned false'.format(client_obj.address))
+                    return self._close_readable(client_obj)
 
-            if frame.fin == 1:
+            elif frame.fin == 1:
+                if self.handle_websocket_frames is not None:
+                    batch.append(frame)
                 # Let the user handle a finished frame
-                if not self.handle_websocket_frame(client_obj, frame):
+                elif not self._handle(self.handle_websocket_frame, client_obj, frame):
                     # if handle_websocket_frame returns false send close frame and emedietely disconnect user
                     logging.info('{}: Closing connection because handle_websocket_frame returned false'.format(client_obj.address))
-                    self.close_connection(sock)
-                    return False
+                    return self._close_readable(client_obj)
 
             if frame.opcode == OpCode.CLOSE:
-                del self.clients[sock]
-                return False
-            else:
+                closed = True
+                break
+
+        if batch and not self._handle(self.handle_websocket_frames, client_obj, batch):
+            logging.info('{}: Closing connection because handle_websocket_frames returned false'.format(client_obj.address))
+            return self._close_readable(client_obj)
+        if closed:
+            self._remove_client(client_obj)
+            return False
+        return True
+
+    def _rate_limit(self, client, frames):
+        """Charges the text and binary frames of one read to the client's token buckets
+        :return: (frames to dispatch, seconds to stop reading for), frames is None if
+        the client should be closed
+        """
+        messages, data = client.rate_buckets
+        policy = self.rate_limit.policy
+        now = monotonic()
+        kept = []
+        delay = 0
+        hit = None
+        for frame in frames:
+            if frame.opcode[0] > 7:
+                kept.append(frame)
+                continue
+            size = len(frame.payload)
+            if policy == RateLimit.DROP:
+                # fin counts a message once, not per fragment
+                if messages is not None and not messages.take(frame.fin, now):
+                    self.metrics.limit_hit('messages')
+                elif data is not None and not data.take(size, now):
+                    self.metrics.limit_hit('bytes')
+                else:
+                    kept.append(frame)
+                continue
+            kept.append(frame)
+            if messages is not None:
+                wait = messages.charge(frame.fin, now)
+                if wait > delay:
+                    delay, hit = wait, 'messages'
+            if data is not None:
+                wait = data.charge(size, now)
+                if wait > delay:
+                    delay, hit = wait, 'bytes'
+
+        if hit is not None:
+            self.metrics.limit_hit(hit)
+            if policy == RateLimit.CLOSE:
+                return None, 0
+        return kept, delay
+
+    def _pause_rate_limited(self, client, delay):
+        """Stops reading from a client over its rate limit for delay seconds"""
+        logging.debug('{}: Reading paused for {:.3f} seconds, rate limit exceeded'.format(client.address, delay))
+        self._rate_paused[client] = self.timers.schedule(delay, self._resume_rate_limited, client)
+        return _SocketServer.PAUSE
+
+    def _resume_rate_limited(self, client):
+        # Popped by whoever resumes it first, the timer or _expire_client
+        if self._rate_paused.pop(client, None) is not None:
+            self._resume_reading(client)
+
+    def _handle(self, handler, client, frames):
+        """Calls handler(client, frames) or queues the call on the executor
+        :return: False if the connection should be closed
+        """
+        if self.executor is None:
+            try:
+                return self._call_handler(handler, client, frames)
+            except (ClientDisconnect, OSError) as e:
+                target = getattr(e, 'client', client)
+                if target is client:
+                    # Its own connection failed or the handler did, handled by _handle_readable
+                    raise
+                # The recipient is removed once its own read fails, this client is not
+                # disconnected for it
+                logging.warning('{}: Send from the handler to {} failed: {}'.format(client.address,
+                                                                                   target.address, e))
                 return True
+        if self.zero_copy:
+            # The receive buffer is reused before the handler runs
+            for frame in frames if type(frames) == list else (frames,):
+                if type(frame.payload) == memoryview:
+                    frame.payload = bytes(frame.payload)
+        self.executor.submit(client, self._call_queued, handler, client, frames)
+        return True
+
+    def _call_queued(self, handler, client, frames):
+        if not self._call_handler(handler, client, frames) and client.state == Client.OPEN:
+            logging.info('{}: Closing connection because {} returned false'.format(client.address,
+                                                                                   handler.__name__))
+            self._expire_client(client, StatusCode.PROTOCOL_ERROR)
+
+    def _pause_reading(self, client):
+        """Stops reading from a client until the executor has caught up with it"""
+        if self.executor.pause(client, lambda: self._resume_reading(client)):
+            logging.debug('{}: Reading paused, {} handler calls queued'.format(client.address,
+                                                                             self.executor.max_pending))
+            return _SocketServer.PAUSE
+        return True
+
+    def _resume_reading(self, client):
+        if self.clients.get(client.fd) is client:
+            try:
+                self.server.register(client.socket, silent=True)
+            except (ValueError, OSError):
+                # Closed in the meantime
+                pass
+
+    def _call_handler(self, handler, client, frame):
+        active = tracing.tracer
+        if active is not None and tracing.sampled(frame):
+            return self._trace_handler(active, handler, client, frame)
+        if not self.time_handlers:
+            return handler(client, frame)
+        start = perf_counter()
+        keep_open = handler(client, frame)
+        self.metrics.frame_handler_seconds.observe(perf_counter() - start)
+        return keep_open
+
+    def _trace_handler(self, active, handler, client, frame):
+        """_call_handler of a traced frame, the frames the handler sends are traced too"""
+        start = monotonic_ns()
+        active.handling(True)
+        try:
+            keep_open = handler(client, frame)
+        finally:
+            active.handling(False)
+        end = monotonic_ns()
+        if self.time_handlers:
+            self.metrics.frame_handler_seconds.observe((end - start) / 1000000000)
+        active.add('handle_websocket_frame', start, end, tracing.frame_args(frame))
+        return keep_open
+
+    def _close_readable(self, client, status_code=StatusCode.PROTOCOL_ERROR):
+        """close_connection for use within _handle_readable, esockets disconnects
+        the socket once _handle_readable returns False
+        """
+        try:
+            client.close(status_code=status_code, timeout=0)
+        except (ClientDisconnect, OSError):
+            pass
+        finally:
+            self._remove_client(client)
+        return False
+
+    def _wait_writable(self, client):
+        """Called by clients that have data left in their send queue"""
+        try:
+            self._write_selector.register(client.socket, selectors.EVENT_WRITE, client)
+        except (KeyError, ValueError, OSError):
+            # Already registered or the socket is closed
+            pass
+
+    def _flush_writable(self):
+        while not self._stop_flushing.is_set():
+            for key, mask in self._write_selector.select(min(self.server.block_time, self.timers.tick)):
+                client = key.data
+                try:
+                    self._write_selector.unregister(key.fileobj)
+                    client.flush()
+                except (KeyError, ValueError):
+                    pass
+                except (ClientDisconnect, OSError):
+                    logging.debug('{}: Connection lost while flushing'.format(client.address))
+                    client.abort()
+            self.timers.advance()
+
+    def _handshake_expired(self, client):
+        """Disconnects clients that did not complete the handshake in time, e.g.
+        slowloris style clients sending their request a byte at a time
+        """
+        if client.state == Client.CONNECTING:
+            logging.info('{}: Handshake not completed within {} seconds'.format(client.address,
+                                                                               self.handshake_timeout))
+            # The server finds the socket readable and disconnects it
+            client.abort()
+
+    def _closing(self, client, timeout):
+        """Called by clients that sent a close frame and wait for the answer. It
+        arrives as a readable event, after which the client is removed, so no
+        thread waits for it.
+        """
+        self.timers.schedule(timeout, self._close_expired, client)
+
+    def _close_expired(self, client):
+        if self.clients.get(client.fd) is client and client.state == Client.CLOSING:
+            logging.info('{}: Close frame not answered in time'.format(client.address))
+            client.close(timeout=0)
+            self._expire_client(client, None)
+
+    def _expire_client(self, client, status_code):
+        """Drops a client without blocking on the closing handshake, for the heartbeat and queued handlers"""
+        if status_code is not None:
+            try:
+                client.close(status_code=status_code, timeout=0)
+            except (ClientDisconnect, OSError):
+                pass
+        client.abort()
+        # Reported closed right away, it is removed once the server reads from it again
+        client.set_closed()
+        if self.executor is not None:
+            self.executor.resume(client)
+        timer = self._rate_paused.get(client)
+        if timer is not None:
+            timer.cancel()
+            self._resume_rate_limited(client)
+
+    def _remove_client(self, client):
+        """Must be called before the socket is closed, its fd may be reused right after"""
+        if self.clients.get(client.fd) is client:
+            del self.clients[client.fd]
+            self.metrics.client_removed(client)
+            # Gone without a complete closing handshake, e.g. reset or expired
+            client.set_closed()
+        timer = self._rate_paused.pop(client, None)
+        if timer is not None:
+            timer.cancel()
+        if client.session is not None:
+            self.sessions.detach(client)
+        try:
+            self._write_selector.unregister(client.socket)
+        except (KeyError, ValueError):
+            pass
 
     def start(self):
+        if self.executor is not None:
+            self.executor.start()
         self.server.start()
+        self._stop_flushing.clear()
+        self._flush_thread = threading.Thread(target=self._flush_writable, daemon=True)
+        self._flush_thread.start()
 
-    def stop(self):
+    def stop(self, timeout=None):
+        """Sends a close frame to every client at once and waits at most timeout
+        seconds (close_timeout by default) for the answers, then disconnects
+        whoever is left. New connections are refused meanwhile.
+        """
+        if timeout is None:
+            timeout = self.close_timeout
+        self._stopping = True
+        for client in self.clients_list():
+            if client.state == Client.OPEN:
+                self.close_connection(client, StatusCode.ENDP_GOING_AWAY, timeout=timeout)
+            elif client.state == Client.CONNECTING:
+                client.abort()
+
+        # The reader threads and the flush thread keep running until the clients are gone
+        deadline = monotonic() + timeout
+        while self.clients and monotonic() < deadline:
+            sleep(0.01)
+        # Their deadline timers are only accurate to a tick
         for client in self.clients_list():
-            self.close_connection(client)
+            self._close_expired(client)
 
+        if self.executor is not None:
+            self.executor.shutdown()
+        self._stop_flushing.set()
+        if self._flush_thread is not None:
+            self._flush_thread.join()
+        if self._metrics_server is not None:
+            self._metrics_server.shutdown()
+            self._metrics_server = None
         self.server.stop()
+        self._stopping = False
 
     def clients_list(self):
         return list(self.clients.values())
 
-    def close_connection(self, client, status_code=StatusCode.PROTOCOL_ERROR, reason=b''):
+    def stats(self):
+        """
+        :return: Dictionary of the server metrics, see metrics.ServerMetrics
+        """
+        stats = self.metrics.collect(self.clients_list())
+        if self.executor is not None:
+            stats.update(self.executor.stats())
+        return stats
+
+    def serve_metrics(self, host='127.0.0.1', port=9100):
+        """Serves the metrics in the Prometheus text format at http://host:port/metrics
+        from a separate thread until stop
+        """
+        self._metrics_server = serve(self.stats, host, port)
+
+    def close_connection(self, client, status_code=StatusCode.PROTOCOL_ERROR, reason=b'', timeout=None):
+        """Sends a close frame without waiting for the answer, the client is
+        disconnected once it answers or after timeout seconds (close_timeout by
+        default). A timeout of 0 disconnects it right away.
+        """
+        if timeout is None:
+            timeout = self.close_timeout
         try:
-            client.close(status_code=status_code, timeout=0, reason=reason)
-        finally:
-            self.server.disconnect(client.socket)
-            del self.clients[client.socket]
+            client.close(status_code=status_code, timeout=timeout, reason=reason)
+        except (ClientDisconnect, OSError):
+            # Already disconnected, e.g. by its reader thread
+            timeout = 0
+        if timeout > 0:
+            return
+        self._remove_client(client)
+        if client.socket.fileno() != -1:
+            try:
+                self.server.disconnect(client.socket)
+            except (ValueError, OSError):
+                # Closed by esockets in the meantime
+                pass
+
+    def broadcast(self, payload, opcode=OpCode.TEXT, clients=None, timeout=-1):
+        """Packs the frame once and sends the same bytes to every recipient, see
+        ClientSocket.broadcast
+        :param clients: Recipients, defaults to all clients in open state and the sessions
+        of disconnected ones
+        :return: Dictionary {client: exception} of the recipients that failed
+        """
+        if clients is None:
+            published = () if self.sessions is None else self.sessions.publish(opcode, payload)
+            clients = self._open_clients(published)
+        return broadcast(clients, payload, opcode, timeout)
+
+    def broadcast_message(self, obj, clients=None, timeout=-1):
+        """Encodes obj once per codec in use and broadcasts it, see ClientSocket.broadcast_message
+        :param clients: Recipients, defaults to all clients in open state and the sessions
+        of disconnected ones
+        :return: Dictionary {client: exception} of the recipients that failed
+        """
+        if clients is None:
+            published = () if self.sessions is None else self.sessions.publish_message(obj)
+            clients = self._open_clients(published)
+        return broadcast_message(clients, obj, timeout)
+
+    def broadcast_file(self, file, offset=0, length=None, clients=None, timeout=-1):
+        """Sends part of a file as one binary frame to every recipient, see ClientSocket.broadcast_file
+        :param clients: Recipients, defaults to all clients in open state. Files are not
+        kept in sessions, the disconnected clients can then no longer resume theirs.
+        :return: Dictionary {client: exception} of the recipients that failed
+        """
+        if clients is None:
+            published = () if self.sessions is None else self.sessions.publish(OpCode.BINARY, None)
+            clients = self._open_clients(published)
+        return broadcast_file(clients, file, offset, length, timeout)
+
+    def _open_clients(self, published=()):
+        """
+        :param published: Sessions a message was added to, their clients are left out
+        :return: List of the clients in open state
+        """
+        return [client for client in self.clients_list()
+                if client.state == Client.OPEN and client.session not in published]
 
     def send_text(self, client, text, timeout=-1, mask=0):
         try:
             client.send_text(text, timeout, mask)
         except (OSError, BrokenPipeError, ClientDisconnect):
-            self.close_connection(client, StatusCode.ENDP_GOING_AWAY, b'Broken pipe')
+            self.close_connection(client, StatusCode.ENDP_GOING_AWAY, b'Broken pipe', timeout=0)
             logging.error('{}: Broken pipe'.format(client.address))
 
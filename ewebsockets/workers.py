@@ -0,0 +1,402 @@
+#!/bin/env python3
+"""
+Multi-process mode. A WorkerPool forks workers that each run their own
+Websocket accepting on the same port through SO_REUSEPORT, so framing and
+masking use every core. Workers are connected to the master with Unix
+socket pairs and the master relays messages between them, which lets
+WorkerBus.broadcast and WorkerBus.send_text reach clients owned by any
+worker.
+"""
+import itertools
+import os
+import pickle
+import selectors
+import signal
+import socket
+import struct
+import threading
+import time
+import logging
+import weakref
+from .RFC6455 import *
+
+_length = struct.Struct('!I')
+
+
+def _pack_message(message):
+    data = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+    return _length.pack(len(data)) + data
+
+
+def _send_message(sock, message):
+    sock.sendall(_pack_message(message))
+
+
+class _MessageReader:
+    """Splits the byte stream of a bus socket into messages"""
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        self.buffer += data
+        messages = []
+        while len(self.buffer) >= 4:
+            length = _length.unpack_from(self.buffer)[0]
+            if len(self.buffer) < 4 + length:
+                break
+            messages.append(pickle.loads(bytes(self.buffer[4:4+length])))
+            del self.buffer[:4+length]
+        return messages
+
+
+class WorkerBus:
+    """The connection of a worker to the rest of the pool, passed to the
+    websocket factory of WorkerPool.
+    """
+    def __init__(self, worker_id, sock):
+        self.worker_id = worker_id
+        self.websocket = None
+        self._socket = sock
+        self._send_lock = threading.Lock()
+        self._clients_lock = threading.Lock()  # Ids are handed out by every handler thread
+        self._clients = weakref.WeakValueDictionary()  # client_id: client
+        self._client_ids = weakref.WeakKeyDictionary()  # client: client_id
+        self._next_client = 0
+        self.messages_relayed = 0
+
+    def client_id(self, client):
+        """
+        :return: An id of client that send_text/send_binary accept in every worker
+        """
+        with self._clients_lock:
+            key = self._client_ids.get(client)
+            if key is None:
+                self._next_client += 1
+                key = '{}:{}'.format(self.worker_id, self._next_client)
+                self._client_ids[client] = key
+                self._clients[key] = client
+            return key
+
+    def broadcast(self, payload, opcode=OpCode.TEXT):
+        """Sends to every open client of every worker"""
+        if type(payload) == str:
+            payload = payload.encode()
+        self._publish(('broadcast', payload, opcode))
+        return self.websocket.broadcast(payload, opcode)
+
+    def send_text(self, client_id, text):
+        self.send(client_id, text.encode() if type(text) == str else text, OpCode.TEXT)
+
+    def send_binary(self, client_id, data):
+        self.send(client_id, data, OpCode.BINARY)
+
+    def send(self, client_id, payload, opcode):
+        if client_id.split(':')[0] == str(self.worker_id):
+            self._send_local(client_id, payload, opcode)
+        else:
+            self._publish(('send', client_id, payload, opcode))
+
+    def _send_local(self, client_id, payload, opcode):
+        with self._clients_lock:
+            client = self._clients.get(client_id)
+        if client is not None:
+            self.websocket.broadcast(payload, opcode, clients=[client])
+
+    def _publish(self, message):
+        with self._send_lock:
+            _send_message(self._socket, message)
+
+    def stats(self):
+        clients = self.websocket.clients_list()
+        states = {}
+        for client in clients:
+            states[client.get_state()] = states.get(client.get_state(), 0) + 1
+        return {'pid': os.getpid(),
+                'worker_id': self.worker_id,
+                'clients': len(clients),
+                'states': states,
+                'messages_relayed': self.messages_relayed}
+
+    def close(self):
+        try:
+            self._socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def run(self):
+        """Handles messages from the master until it stops this worker or goes away"""
+        reader = _MessageReader()
+        while True:
+            data = self._socket.recv(65536)
+            if not data:
+                return
+            for message in reader.feed(data):
+                kind = message[0]
+                if kind == 'stop':
+                    return
+                elif kind == 'broadcast':
+                    self.messages_relayed += 1
+                    self.websocket.broadcast(message[1], message[2])
+                elif kind == 'send':
+                    self.messages_relayed += 1
+                    self._send_local(*message[1:])
+                elif kind == 'stats':
+                    self._publish(('stats', message[1], self.stats()))
+
+
+class _Worker:
+    def __init__(self, worker_id, pid, sock):
+        self.worker_id = worker_id
+        self.pid = pid
+        self.socket = sock
+        self.reader = _MessageReader()
+        self.outbox = bytearray()  # Messages the socket did not accept yet
+        self.ready = False
+        self.stopping = False
+
+
+class WorkerPool:
+    """Runs a Websocket per worker process. The master only relays bus messages,
+    collects stats and supervises the workers, respawning those that die. It is
+    single threaded so forking stays safe, messages are relayed while
+    serve_forever, stats or restart run.
+
+    Signals to the master: SIGHUP rolling restart, SIGUSR1 log stats,
+    SIGTERM/SIGINT stop.
+    """
+    def __init__(self, websocket_factory, workers=None, stop_timeout=10):
+        """
+        :param websocket_factory: Called in each worker with its WorkerBus, returns
+        a Websocket that is not started yet
+        :param workers: Number of worker processes, defaults to the number of cpus
+        :param stop_timeout: Seconds a worker gets to close its clients when stopped
+        """
+        self.websocket_factory = websocket_factory
+        self.worker_count = workers or os.cpu_count() or 1
+        self.stop_timeout = stop_timeout
+        self.workers = {}  # worker_id: _Worker
+        self._next_worker_id = 0
+        self._selector = selectors.DefaultSelector()
+        self._stats_replies = {}
+        self._request_ids = itertools.count()
+        self._running = False
+        self._restart_requested = False
+        self._stats_requested = False
+
+    def start(self):
+        self._running = True
+        for _ in range(self.worker_count):
+            self._spawn()
+        self._wait_ready(list(self.workers.values()))
+
+    def serve_forever(self):
+        """Starts the workers if needed and supervises them until SIGTERM/SIGINT"""
+        signal.signal(signal.SIGHUP, self._request_restart)
+        signal.signal(signal.SIGUSR1, self._request_stats)
+        signal.signal(signal.SIGTERM, self._request_stop)
+        signal.signal(signal.SIGINT, self._request_stop)
+        if not self._running:
+            self.start()
+        while self._running:
+            self._poll(1)
+            if self._restart_requested:
+                self._restart_requested = False
+                self.restart()
+            if self._stats_requested:
+                self._stats_requested = False
+                logging.info('Worker stats: {}'.format(self.stats()))
+        self.stop()
+
+    def restart(self):
+        """Rolling restart, each worker is replaced by a new one that is ready before
+        the old one stops so the port keeps accepting throughout
+        """
+        for worker in list(self.workers.values()):
+            if worker.stopping:
+                continue
+            new_worker = self._spawn()
+            self._wait_ready([new_worker])
+            self._stop_worker(worker)
+
+    def stop(self):
+        self._running = False
+        for worker in list(self.workers.values()):
+            worker.stopping = True
+            self._write(worker, ('stop',))
+        deadline = time.monotonic() + self.stop_timeout
+        while self.workers and time.monotonic() < deadline:
+            self._poll(0.1)
+        for worker in list(self.workers.values()):
+            self._kill(worker)
+
+    def stats(self, timeout=2):
+        """
+        :return: Stats summed over all workers plus the stats of each worker
+        """
+        request_id = next(self._request_ids)
+        self._stats_replies[request_id] = []
+        workers = [worker for worker in self.workers.values() if worker.ready]
+        for worker in workers:
+            self._write(worker, ('stats', request_id))
+        deadline = time.monotonic() + timeout
+        while len(self._stats_replies[request_id]) < len(workers) and time.monotonic() < deadline:
+            self._poll(0.05)
+
+        per_worker = self._stats_replies.pop(request_id)
+        total = {'workers': len(per_worker), 'clients': 0, 'messages_relayed': 0, 'states': {}}
+        for stats in per_worker:
+            total['clients'] += stats['clients']
+            total['messages_relayed'] += stats['messages_relayed']
+            for state, count in stats['states'].items():
+                total['states'][state] = total['states'].get(state, 0) + count
+        total['per_worker'] = per_worker
+        return total
+
+    def _spawn(self):
+        worker_id = self._next_worker_id
+        self._next_worker_id += 1
+        master_socket, worker_socket = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            master_socket.close()
+            self._run_worker(worker_id, worker_socket)
+        worker_socket.close()
+        # Never blocks on a worker that is busy sending to the master itself
+        master_socket.setblocking(False)
+        worker = _Worker(worker_id, pid, master_socket)
+        self.workers[worker_id] = worker
+        self._selector.register(master_socket, selectors.EVENT_READ, worker)
+        logging.info('Worker {} started (pid {})'.format(worker_id, pid))
+        return worker
+
+    def _run_worker(self, worker_id, sock):
+        """Entry point of the forked worker, never returns"""
+        status = 0
+        try:
+            for sig in (signal.SIGHUP, signal.SIGUSR1, signal.SIGINT):
+                signal.signal(sig, signal.SIG_DFL)
+            bus = WorkerBus(worker_id, sock)
+            signal.signal(signal.SIGTERM, lambda signum, frame: bus.close())
+            websocket = self.websocket_factory(bus)
+            bus.websocket = websocket
+            # Shares the port, before start binds it
+            websocket.server.reuse_port()
+            websocket.start()
+            bus._publish(('ready',))
+            bus.run()
+            websocket.stop()
+        except BaseException:
+            logging.exception('Worker {} failed'.format(worker_id))
+            status = 1
+        finally:
+            # esockets threads are not daemonic, leave without waiting for them
+            os._exit(status)
+
+    def _wait_ready(self, workers, timeout=10):
+        deadline = time.monotonic() + timeout
+        while not all(worker.ready for worker in workers) and time.monotonic() < deadline:
+            self._poll(0.05)
+
+    def _stop_worker(self, worker):
+        worker.stopping = True
+        self._write(worker, ('stop',))
+        deadline = time.monotonic() + self.stop_timeout
+        while worker.worker_id in self.workers and time.monotonic() < deadline:
+            self._poll(0.1)
+        if worker.worker_id in self.workers:
+            self._kill(worker)
+
+    def _kill(self, worker):
+        try:
+            os.kill(worker.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        self._remove(worker)
+
+    def _remove(self, worker):
+        if self.workers.pop(worker.worker_id, None) is None:
+            return
+        self._selector.unregister(worker.socket)
+        worker.socket.close()
+        try:
+            os.waitpid(worker.pid, 0)
+        except ChildProcessError:
+            pass
+        logging.info('Worker {} stopped (pid {})'.format(worker.worker_id, worker.pid))
+
+    def _write(self, worker, message):
+        """Queues a message to a worker, what the socket does not accept right
+        away is sent by _poll once it is writable
+        """
+        pending = bool(worker.outbox)
+        worker.outbox += _pack_message(message)
+        if not pending:
+            self._flush(worker)
+
+    def _flush(self, worker):
+        try:
+            sent = worker.socket.send(worker.outbox)
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            # The worker is gone, _poll removes it once the socket reads as closed
+            sent = len(worker.outbox)
+        del worker.outbox[:sent]
+        events = selectors.EVENT_READ | selectors.EVENT_WRITE if worker.outbox else selectors.EVENT_READ
+        if self._selector.get_key(worker.socket).events != events:
+            self._selector.modify(worker.socket, events, worker)
+
+    def _poll(self, timeout):
+        try:
+            events = self._selector.select(timeout)
+        except InterruptedError:
+            return
+        for key, mask in events:
+            worker = key.data
+            if worker.worker_id not in self.workers:
+                # Removed while handling an earlier event
+                continue
+            if mask & selectors.EVENT_WRITE:
+                self._flush(worker)
+            if not mask & selectors.EVENT_READ:
+                continue
+            try:
+                data = worker.socket.recv(65536)
+            except BlockingIOError:
+                continue
+            except OSError:
+                data = b''
+            if not data:
+                self._remove(worker)
+                if self._running and not worker.stopping:
+                    logging.warning('Worker {} died, starting a new one'.format(worker.worker_id))
+                    self._spawn()
+                continue
+            for message in worker.reader.feed(data):
+                self._handle_message(worker, message)
+
+    def _handle_message(self, worker, message):
+        kind = message[0]
+        if kind == 'ready':
+            worker.ready = True
+        elif kind == 'broadcast':
+            for other in list(self.workers.values()):
+                if other is not worker and other.ready:
+                    self._write(other, message)
+        elif kind == 'send':
+            target = self.workers.get(int(message[1].split(':')[0]))
+            if target is not None:
+                self._write(target, message)
+        elif kind == 'stats':
+            replies = self._stats_replies.get(message[1])
+            if replies is not None:
+                replies.append(message[2])
+
+    def _request_restart(self, signum, frame):
+        self._restart_requested = True
+
+    def _request_stats(self, signum, frame):
+        self._stats_requested = True
+
+    def _request_stop(self, signum, frame):
+        self._running = False
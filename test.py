@@ -1,7 +1,6 @@
 #!/bin/env python3
 import ewebsockets
 import logging, sys
-from websocket import create_connection
 
 root = logging.getLogger()
 root.setLevel(logging.DEBUG)
@@ -31,6 +30,6 @@ server = ewebsockets.Websocket(
 
 server.start()
 print(server.server.host + ':' + str(server.server.port))
-client = create_connection('ws://' + server.server.host + ':' + str(server.server.port))
-client.send('hello\n', 1)
+client = ewebsockets.connect('ws://' + server.server.host + ':' + str(server.server.port))
+client.send_text('hello\n')
 
@@ -0,0 +1,99 @@
+#!/bin/env python3
+"""
+Helpers shared by the tests, a server on a free port and a raw socket client
+"""
+import base64
+import os
+import socket
+import struct
+import time
+import ewebsockets
+
+
+def start_server(**kwargs):
+    """Starts a Websocket on a free port of 127.0.0.1
+    :param kwargs: Websocket arguments
+    """
+    esockets_kwargs = {'host': '127.0.0.1', 'port': 0, 'block_time': 0.1}
+    esockets_kwargs.update(kwargs.pop('esockets_kwargs', {}))
+    server = ewebsockets.Websocket(esockets_kwargs=esockets_kwargs, **kwargs)
+    server.start()
+    return server
+
+
+def stop_server(server, timeout=None):
+    server.stop(timeout)
+    # esockets leaves its handler threads waiting for work
+    server.server._threads_limiter.stop()
+
+
+def address(server):
+    return server.server._server_socket.getsockname()
+
+
+def url(server, path='/'):
+    return 'ws://{}:{}{}'.format(address(server)[0], address(server)[1], path)
+
+
+def handshake(server, path='/', headers=b''):
+    """Connects a raw socket and completes the opening handshake
+    :return: (socket, response head)
+    """
+    sock = socket.create_connection(address(server), timeout=5)
+    sock.sendall(b'GET ' + path.encode() + b' HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\n'
+                 b'Connection: Upgrade\r\nSec-WebSocket-Key: ' + base64.b64encode(os.urandom(16)) +
+                 b'\r\nSec-WebSocket-Version: 13\r\n' + headers + b'\r\n')
+    response = b''
+    while b'\r\n\r\n' not in response:
+        data = sock.recv(4096)
+        if not data:
+            break
+        response += data
+    return sock, response
+
+
+def masked_frame(payload, opcode=0x1, fin=1, rsv1=0):
+    key = os.urandom(4)
+    header = bytes(((fin << 7) | (rsv1 << 6) | opcode,))
+    if len(payload) < 126:
+        header += bytes((0x80 | len(payload),))
+    elif len(payload) < 65536:
+        header += bytes((0x80 | 126,)) + struct.pack('!H', len(payload))
+    else:
+        header += bytes((0x80 | 127,)) + struct.pack('!Q', len(payload))
+    return header + key + bytes(b ^ key[i % 4] for i, b in enumerate(payload))
+
+
+def _recv_exactly(sock, length):
+    data = b''
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+        if not chunk:
+            raise EOFError('Connection closed')
+        data += chunk
+    return data
+
+
+def read_frame(sock):
+    """
+    :return: (opcode, payload) of the next unmasked frame from the server
+    """
+    header = _recv_exactly(sock, 2)
+    length = header[1] & 0x7f
+    if length == 126:
+        length = struct.unpack('!H', _recv_exactly(sock, 2))[0]
+    elif length == 127:
+        length = struct.unpack('!Q', _recv_exactly(sock, 8))[0]
+    return header[0] & 0x0f, _recv_exactly(sock, length)
+
+
+def wait_for(condition, timeout=5):
+    """
+    :return: True once condition() is true, False after timeout seconds
+    """
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
@@ -0,0 +1,70 @@
+#!/bin/env python3
+import os
+import tempfile
+import unittest
+from ewebsockets.ClientSocket import Client
+from ewebsockets.capture import Recorder, Replayer, RECEIVED, SENT
+from support import start_server, stop_server, url, handshake, masked_frame, read_frame, wait_for
+
+
+class TestCapture(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'capture.log')
+        self.recorder = Recorder(self.path, flush_interval=0.01)
+        self.recorder.start()
+
+        def echo(client, frame):
+            if frame.opcode[0] == 0x1:
+                # Larger than the send queue allows, dropped and not recorded
+                client.send_binary(b'x' * 2048)
+                client.send_text(b'echo ' + bytes(frame.payload))
+            return True
+
+        self.server = start_server(handle_websocket_frame=echo, recorder=self.recorder,
+                                   client_kwargs={'max_send_queue': 1024, 'overflow_policy': Client.DROP})
+        self.replayed = []
+
+        def collect(client, frame):
+            self.replayed.append((frame.opcode[0], bytes(frame.payload)))
+            return True
+
+        self.target = start_server(handle_websocket_frame=collect)
+
+    def tearDown(self):
+        stop_server(self.server)
+        stop_server(self.target)
+        self.recorder.stop()
+        self.directory.cleanup()
+
+    def test_record_replay(self):
+        sock, _ = handshake(self.server)
+        for message in (b'one', b'two', b'three'):
+            sock.sendall(masked_frame(message))
+            self.assertEqual(read_frame(sock), (0x1, b'echo ' + message))
+        sock.sendall(masked_frame(b'', opcode=0x8))
+        self.assertEqual(read_frame(sock)[0], 0x8)
+        sock.close()
+        self.assertTrue(wait_for(lambda: not self.server.clients))
+        self.recorder.stop()
+
+        replayer = Replayer(self.path)
+        records = [(connection, direction, opcode, bytes(payload))
+                   for timestamp, connection, direction, opcode, payload in replayer.records()]
+        self.assertEqual([record[1:] for record in records if record[1] == RECEIVED],
+                         [(RECEIVED, 0x1, b'one'), (RECEIVED, 0x1, b'two'), (RECEIVED, 0x1, b'three'),
+                          (RECEIVED, 0x8, b'')])
+        self.assertEqual([record[1:] for record in records if record[1] == SENT],
+                         [(SENT, 0x1, b'echo one'), (SENT, 0x1, b'echo two'), (SENT, 0x1, b'echo three'),
+                          (SENT, 0x8, b'')])
+        self.assertEqual({record[0] for record in records}, {0})
+
+        stats = replayer.replay(url(self.target), speed=None)
+        replayer.close()
+        self.assertEqual((stats['connections'], stats['frames'], stats['errors']), (1, 4, 0))
+        self.assertTrue(wait_for(lambda: len(self.replayed) == 4))
+        self.assertEqual(self.replayed, [(0x1, b'one'), (0x1, b'two'), (0x1, b'three'), (0x8, b'\x03\xe8')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+#!/bin/env python3
+import queue
+import socket
+import unittest
+import ewebsockets
+from ewebsockets import Frame, OpCode
+from ewebsockets.websocket_client import ClientLoop
+from support import start_server, stop_server, address, url, wait_for
+
+
+class TestClient(unittest.TestCase):
+    def setUp(self):
+        self.received = []
+
+        def echo(client, frame):
+            if frame.opcode[0] in (0x1, 0x2):
+                self.received.append(bytes(frame.payload))
+                client.send_frame(Frame(payload=bytes(frame.payload), opcode=frame.opcode))
+            return True
+
+        self.server = start_server(handle_websocket_frame=echo)
+        # connect tries every address localhost resolves to, the server listens on 127.0.0.1
+        self.url = 'ws://localhost:{}/echo'.format(address(self.server)[1])
+
+    def tearDown(self):
+        stop_server(self.server)
+
+    def test_echo(self):
+        client = ewebsockets.connect(self.url)
+        try:
+            client.send_text('hello')
+            self.assertEqual(bytes(client.recv(5).payload), b'hello')
+
+            # The frame is masked on the wire, the caller's frame is left as it was
+            frame = Frame(payload=b'\x00\x01\x02\x03\x04', opcode=OpCode.BINARY)
+            client.send_frame(frame)
+            client.send_frame(frame)
+            self.assertEqual((frame.mask, frame.payload), (0, b'\x00\x01\x02\x03\x04'))
+            for _ in range(2):
+                echoed = client.recv(5)
+                self.assertEqual((echoed.opcode, bytes(echoed.payload)), (OpCode.BINARY, b'\x00\x01\x02\x03\x04'))
+            self.assertEqual(self.received, [b'hello'] + [b'\x00\x01\x02\x03\x04'] * 2)
+        finally:
+            client.close()
+        self.assertTrue(wait_for(lambda: not self.server.clients))
+        self.assertEqual(self.server.stats()['close_codes'], {1000: 1})
+
+    def test_loop(self):
+        loop = ClientLoop()
+        loop.start()
+        responses = queue.Queue()
+        opened = []
+        try:
+            for i in range(3):
+                loop.connect(url(self.server), lambda client, frame: responses.put(bytes(frame.payload)) or True,
+                             on_open=opened.append)
+            self.assertTrue(wait_for(lambda: len(opened) == 3))
+            for i, client in enumerate(opened):
+                client.send_text('message {}'.format(i))
+            echoed = sorted(responses.get(timeout=5) for _ in opened)
+            self.assertEqual(echoed, [b'message 0', b'message 1', b'message 2'])
+        finally:
+            loop.stop()
+        self.assertTrue(wait_for(lambda: not self.server.clients))
+
+    def test_loop_connect_failed(self):
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        loop = ClientLoop()
+        loop.start()
+        errors = queue.Queue()
+        try:
+            loop.connect('ws://127.0.0.1:{}/'.format(port), on_error=lambda url, error: errors.put(error))
+            loop.connect('ws://no-such-host.invalid/', on_error=lambda url, error: errors.put(error))
+            self.assertIsInstance(errors.get(timeout=5), OSError)
+            self.assertIsInstance(errors.get(timeout=5), OSError)
+        finally:
+            loop.stop()
+
+    @unittest.skipUnless(socket.has_ipv6, 'No IPv6 support')
+    def test_loop_ipv6(self):
+        try:
+            listener = socket.socket(socket.AF_INET6)
+            listener.bind(('::1', 0))
+        except OSError:
+            self.skipTest('No IPv6 loopback')
+        with listener:
+            listener.listen(1)
+            listener.settimeout(5)
+            port = listener.getsockname()[1]
+            loop = ClientLoop()
+            loop.start()
+            try:
+                loop.connect('ws://[::1]:{}/'.format(port))
+                conn, _ = listener.accept()
+                with conn:
+                    conn.settimeout(5)
+                    request = conn.recv(4096)
+            finally:
+                loop.stop()
+        self.assertIn('Host: [::1]:{}\r\n'.format(port).encode(), request)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+#!/bin/env python3
+import socket
+import struct
+import unittest
+import ewebsockets
+from ewebsockets.ClientSocket import Client
+from support import start_server, stop_server, handshake, masked_frame, read_frame, wait_for
+
+
+class TestClose(unittest.TestCase):
+    def setUp(self):
+        self.opened = []
+        self.closed = []
+
+        def on_open(client):
+            self.opened.append(client)
+            return True
+
+        def on_close(client):
+            self.closed.append(client)
+            return True
+
+        self.server = start_server(on_client_open=on_open, on_client_close=on_close)
+        self.sockets = []
+
+    def tearDown(self):
+        for sock in self.sockets:
+            sock.close()
+        stop_server(self.server)
+
+    def connect(self):
+        sock, response = handshake(self.server)
+        self.assertTrue(response.startswith(b'HTTP/1.1 101'))
+        self.sockets.append(sock)
+        return sock
+
+    def test_closing_handshake(self):
+        sock = self.connect()
+        self.assertTrue(wait_for(lambda: len(self.opened) == 1))
+        sock.sendall(masked_frame(ewebsockets.StatusCode.NORMAL_CLOSE, opcode=0x8))
+        self.assertEqual(read_frame(sock), (0x8, ewebsockets.StatusCode.NORMAL_CLOSE))
+        self.assertTrue(wait_for(lambda: not self.server.clients))
+        self.assertEqual(self.closed, self.opened)
+        self.assertEqual(self.opened[0].state, Client.CLOSED)
+        self.assertEqual(self.server.stats()['close_codes'], {1000: 1})
+
+    def test_abrupt_disconnect(self):
+        reset = self.connect()
+        ended = self.connect()
+        self.assertTrue(wait_for(lambda: len(self.opened) == 2))
+        # A TCP reset and a plain EOF, neither sends a close frame
+        reset.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        reset.close()
+        ended.close()
+        self.assertTrue(wait_for(lambda: not self.server.clients))
+        self.assertEqual(sorted(map(id, self.closed)), sorted(map(id, self.opened)))
+        for client in self.opened:
+            self.assertEqual(client.state, Client.CLOSED)
+        self.assertEqual(self.server.stats()['close_codes'], {None: 2})
+
+    def test_close_timeout(self):
+        sock = self.connect()
+        self.assertTrue(wait_for(lambda: len(self.opened) == 1))
+        client = self.opened[0]
+        self.server.close_connection(client, ewebsockets.StatusCode.ENDP_GOING_AWAY, timeout=0.2)
+        # The close frame is never answered
+        self.assertEqual(read_frame(sock)[0], 0x8)
+        self.assertTrue(wait_for(lambda: not self.server.clients))
+        self.assertEqual(self.closed, [client])
+        self.assertEqual(client.state, Client.CLOSED)
+
+    def test_handler_send_to_lost_client(self):
+        def handle(client, frame):
+            if frame.opcode[0] == 0x1:
+                for other in self.server.clients_list():
+                    if other is not client:
+                        other.abort()
+                        other.send_text('lost')
+            return True
+
+        self.server.handle_websocket_frame = handle
+        sender = self.connect()
+        lost = self.connect()
+        self.assertTrue(wait_for(lambda: len(self.opened) == 2))
+        sender.sendall(masked_frame(b'relay'))
+        self.assertEqual(lost.recv(4096), b'')
+        self.assertTrue(wait_for(lambda: len(self.server.clients) == 1))
+        # The failed send to the other client does not close the sender
+        sender.sendall(masked_frame(b'still open', opcode=0x9))
+        self.assertEqual(read_frame(sender), (0xA, b'still open'))
+        self.assertEqual(self.server.clients_list()[0].state, Client.OPEN)
+
+    def test_handler_error(self):
+        def handle(client, frame):
+            raise FileNotFoundError('missing.txt')
+
+        self.server.handle_websocket_frame = handle
+        sock = self.connect()
+        sock.sendall(masked_frame(b'open'))
+        self.assertEqual(read_frame(sock), (0x8, ewebsockets.StatusCode.UNEXPECTED_CONDITION))
+        self.assertTrue(wait_for(lambda: not self.server.clients))
+
+    def test_handshake_timeout(self):
+        self.server.handshake_timeout = 0.2
+        sock = socket.create_connection(self.server.server._server_socket.getsockname(), timeout=5)
+        self.sockets.append(sock)
+        sock.sendall(b'GET / HTTP/1.1\r\n')
+        self.assertEqual(sock.recv(4096), b'')
+        self.assertTrue(wait_for(lambda: not self.server.clients))
+        # Never opened, so never reported closed
+        self.assertEqual(self.closed, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
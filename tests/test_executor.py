@@ -0,0 +1,57 @@
+#!/bin/env python3
+import threading
+import time
+import unittest
+from ewebsockets import OrderedExecutor
+
+
+class TestOrderedExecutor(unittest.TestCase):
+    def setUp(self):
+        self.executor = OrderedExecutor(workers=4)
+        self.handled = {'a': [], 'b': []}
+        self.running = set()
+        self.overlapped = []
+        self.lock = threading.Lock()
+
+    def handle(self, key, i):
+        with self.lock:
+            if key in self.running:
+                self.overlapped.append((key, i))
+            self.running.add(key)
+        # Long enough for the other workers to pick up the next calls if they could
+        time.sleep(0.001)
+        with self.lock:
+            self.running.discard(key)
+            self.handled[key].append(i)
+
+    def test_order(self):
+        self.executor.start()
+        for i in range(200):
+            for key in ('a', 'b'):
+                self.executor.submit(key, self.handle, key, i)
+        # Queued faster than they run, shutdown waits for all of them
+        self.assertGreater(self.executor.pending('a') + self.executor.pending('b'), 0)
+        self.executor.shutdown()
+        self.assertEqual(self.handled, {'a': list(range(200)), 'b': list(range(200))})
+        self.assertEqual(self.overlapped, [])
+        self.assertEqual(self.executor.stats()['executor_pending'], 0)
+
+    def test_pause(self):
+        resumed = threading.Event()
+        release = threading.Event()
+        self.executor.max_pending, self.executor.resume_pending = 4, 2
+        self.executor.start()
+        self.executor.submit('a', release.wait)
+        for i in range(4):
+            self.executor.submit('a', self.handle, 'a', i)
+        self.assertTrue(self.executor.pause('a', resumed.set))
+        self.assertEqual(self.executor.stats()['executor_paused'], 1)
+        release.set()
+        self.assertTrue(resumed.wait(5))
+        self.executor.shutdown()
+        self.assertEqual(self.handled['a'], list(range(4)))
+        self.assertFalse(self.executor.pause('a', resumed.set))
+
+
+if __name__ == '__main__':
+    unittest.main()
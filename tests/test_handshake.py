@@ -0,0 +1,69 @@
+#!/bin/env python3
+import unittest
+from ewebsockets.exceptions import HandshakeError
+from ewebsockets.handshake import HandshakeParser, parse_request, BAD_REQUEST, UPGRADE_REQUIRED
+
+KEY = b'dGhlIHNhbXBsZSBub25jZQ=='
+
+
+def request(*headers, request_line=b'GET /chat?room=1 HTTP/1.1'):
+    return b'\r\n'.join((request_line,) + headers)
+
+
+VALID = (b'Host: example.com:8080',
+         b'upgrade: WebSocket',
+         b'Connection: keep-alive',
+         b'CONNECTION: Upgrade',
+         b'Sec-WebSocket-Key: ' + KEY,
+         b'Sec-Websocket-Version: 13',
+         b'Sec-WebSocket-Extensions: permessage-deflate',
+         b'Origin: http://example.com',
+         b'Sec-WebSocket-Protocol: chat, superchat',
+         b'X-Bad : ignored')
+
+
+class TestParseRequest(unittest.TestCase):
+    def test_valid(self):
+        parsed = parse_request(request(*VALID))
+        self.assertEqual(parsed.method, 'GET')
+        self.assertEqual(parsed.path, '/chat?room=1')
+        self.assertEqual(parsed.key, KEY.decode())
+        self.assertEqual(parsed.host, 'example.com:8080')
+        self.assertEqual(parsed.extensions, 'permessage-deflate')
+        self.assertEqual(parsed.origin, 'http://example.com')
+        self.assertEqual(parsed.subprotocols, ['chat', 'superchat'])
+        # Repeated headers are joined, invalid lines the handshake does not need are left out
+        self.assertEqual(parsed.get('Connection'), 'keep-alive, Upgrade')
+        self.assertNotIn('x-bad', parsed.headers)
+
+    def test_incremental(self):
+        data = request(*VALID) + b'\r\n\r\n\x81\x00'
+        parser = HandshakeParser()
+        for i in range(len(data) - 3):
+            self.assertIsNone(parser.feed(data[i:i+1]))
+        self.assertEqual(parser.feed(data[-3:]).key, KEY.decode())
+        self.assertEqual(parser.remainder, b'\x81\x00')
+
+    def assertRefused(self, data, response=BAD_REQUEST):
+        with self.assertRaises(HandshakeError) as context:
+            parse_request(data)
+        self.assertEqual(context.exception.response, response)
+
+    def test_invalid(self):
+        def without(name):
+            return [header for header in VALID if not header.lower().startswith(name)]
+
+        self.assertRefused(request(*VALID, request_line=b'POST /chat HTTP/1.1'))
+        self.assertRefused(request(*VALID, request_line=b'GET /chat HTTP/1.0'))
+        self.assertRefused(request(*VALID + (b'no colon',)))
+        self.assertRefused(request(*without(b'upgrade')))
+        self.assertRefused(request(*without(b'upgrade') + [b'Upgrade : websocket']))
+        self.assertRefused(request(*without(b'connection') + [b'Connection: keep-alive']))
+        self.assertRefused(request(*without(b'sec-websocket-key') + [b'Sec-WebSocket-Key: c2hvcnQ=']))
+        self.assertRefused(request(*without(b'sec-websocket-key') + [b'Sec-WebSocket-Key: ' + KEY[:-3] + b'!==']))
+        self.assertRefused(request(*without(b'sec-websocket-version') + [b'Sec-WebSocket-Version: 8']),
+                           UPGRADE_REQUIRED)
+
+
+if __name__ == '__main__':
+    unittest.main()
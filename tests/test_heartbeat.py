@@ -0,0 +1,44 @@
+#!/bin/env python3
+import time
+import unittest
+from ewebsockets.ClientSocket import Client
+from support import start_server, stop_server, handshake, read_frame, wait_for
+
+
+class TestHeartbeat(unittest.TestCase):
+    def setUp(self):
+        self.opened = []
+        self.closed = []
+        self.server = start_server(on_client_open=lambda client: self.opened.append(client) or True,
+                                   on_client_close=lambda client: self.closed.append(client) or True,
+                                   ping_interval=0.5,
+                                   pong_timeout=0.5)
+        self.sockets = []
+
+    def tearDown(self):
+        for sock in self.sockets:
+            sock.close()
+        stop_server(self.server)
+
+    def test_silent_client_dropped(self):
+        sock, response = handshake(self.server)
+        self.sockets.append(sock)
+        self.assertTrue(wait_for(lambda: self.opened))
+        start = time.monotonic()
+        # Pinged but never answers
+        self.assertEqual(read_frame(sock)[0], 0x9)
+        pinged = time.monotonic()
+        self.assertTrue(wait_for(lambda: self.closed))
+        # Timers never fire early, and late by at most a tick of the timer wheel (0.5 s) each
+        self.assertGreaterEqual(time.monotonic() - pinged, 0.45)
+        self.assertGreaterEqual(time.monotonic() - start, 0.95)
+        self.assertLess(time.monotonic() - start, 2.5)
+        self.assertEqual(self.closed, self.opened)
+        self.assertEqual(self.opened[0].state, Client.CLOSED)
+        self.assertEqual(sock.recv(4096), b'')
+        self.assertTrue(wait_for(lambda: not self.server.clients))
+        self.assertEqual(self.closed, self.opened)
+
+
+if __name__ == '__main__':
+    unittest.main()
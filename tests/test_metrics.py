@@ -0,0 +1,60 @@
+#!/bin/env python3
+import threading
+import unittest
+from ewebsockets import OpCode
+from ewebsockets.metrics import exposition
+from support import start_server, stop_server, handshake, masked_frame, read_frame, wait_for
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        def echo(client, frame):
+            if frame.opcode == OpCode.TEXT:
+                client.send_text(bytes(frame.payload))
+            return True
+
+        self.server = start_server(handle_websocket_frame=echo, metrics=True)
+        self.sock, response = handshake(self.server)
+
+    def tearDown(self):
+        self.sock.close()
+        stop_server(self.server)
+
+    def test_counts(self):
+        for i in range(10):
+            self.sock.sendall(masked_frame(b'0123456789'))
+        self.sock.sendall(masked_frame(b'ping', opcode=0x9))
+        for i in range(11):
+            read_frame(self.sock)
+        stats = self.server.stats()
+        self.assertEqual(stats['frames_in'], {'text': 10, 'ping': 1})
+        self.assertEqual(stats['bytes_in'], {'text': 100, 'ping': 4})
+        self.assertEqual(stats['frames_out'], {'text': 10, 'pong': 1})
+        self.assertEqual(stats['frame_handler_seconds']['count'], 11)
+        self.assertIn('ewebsockets_frames_received_total{opcode="text"} 10', exposition(stats))
+
+    def test_collect_while_receiving(self):
+        errors = []
+        done = threading.Event()
+
+        def collect():
+            while not done.is_set():
+                try:
+                    self.server.stats()
+                except Exception as e:
+                    errors.append(e)
+                    return
+
+        collector = threading.Thread(target=collect)
+        collector.start()
+        # Every opcode a client may send, first seen while stats are being collected
+        for opcode in (0x1, 0x2, 0x9, 0xA):
+            self.sock.sendall(masked_frame(b'x', opcode=opcode) * 100)
+        self.assertTrue(wait_for(lambda: sum(self.server.stats()['frames_in'].values()) == 400))
+        done.set()
+        collector.join()
+        self.assertEqual(errors, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+#!/bin/env python3
+import base64
+import os
+import queue
+import socket
+import struct
+import unittest
+import zlib
+import ewebsockets
+from ewebsockets.permessage_deflate import DeflateContext
+
+
+def compress(payload):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    data = compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    return data[:-4]
+
+
+def masked_frame(payload, opcode=0x1, rsv1=0):
+    key = os.urandom(4)
+    header = bytes(((1 << 7) | (rsv1 << 6) | opcode,))
+    if len(payload) < 126:
+        header += bytes((0x80 | len(payload),))
+    else:
+        header += bytes((0x80 | 126,)) + struct.pack('!H', len(payload))
+    return header + key + bytes(b ^ key[i % 4] for i, b in enumerate(payload))
+
+
+class TestDeflateContext(unittest.TestCase):
+    def context(self, max_message_size=16777216):
+        return DeflateContext(False, 15, 6, 8, 0, max_message_size)
+
+    def test_decompress_memoryview(self):
+        payload = b'hello world ' * 100
+        data = self.context().decompress(memoryview(bytearray(compress(payload))))
+        self.assertEqual(data, payload)
+
+    def test_decompress_fragments(self):
+        payload = b'part ' * 200
+        compressed = memoryview(compress(payload))
+        context = self.context()
+        data = context.decompress(compressed[:10], fin=False) + context.decompress(compressed[10:])
+        self.assertEqual(data, payload)
+
+    def test_decompress_too_big(self):
+        with self.assertRaises(ewebsockets.MessageTooBig):
+            self.context(1000).decompress(memoryview(compress(b'\x00' * 1001)))
+        self.assertEqual(self.context(1000).decompress(compress(b'\x00' * 1000)), b'\x00' * 1000)
+
+
+class TestZeroCopyDeflate(unittest.TestCase):
+    def setUp(self):
+        self.received = queue.Queue()
+
+        def handle(client, frame):
+            if frame.opcode == ewebsockets.OpCode.TEXT:
+                self.received.put((type(frame.payload), bytes(frame.payload)))
+            return True
+
+        self.server = ewebsockets.Websocket(handle_websocket_frame=handle,
+                                            zero_copy=True,
+                                            permessage_deflate=ewebsockets.PerMessageDeflate(),
+                                            esockets_kwargs={'host': '127.0.0.1', 'port': 0})
+        self.server.start()
+        self.sockets = []
+
+    def tearDown(self):
+        for sock in self.sockets:
+            sock.close()
+        self.server.stop()
+        # esockets leaves its handler threads waiting for work
+        self.server.server._threads_limiter.stop()
+
+    def connect(self):
+        sock = socket.create_connection(self.server.server._server_socket.getsockname(), timeout=5)
+        self.sockets.append(sock)
+        sock.sendall(b'GET / HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\n'
+                     b'Connection: Upgrade\r\nSec-WebSocket-Key: ' + base64.b64encode(os.urandom(16)) +
+                     b'\r\nSec-WebSocket-Version: 13\r\n'
+                     b'Sec-WebSocket-Extensions: permessage-deflate\r\n\r\n')
+        response = b''
+        while b'\r\n\r\n' not in response:
+            data = sock.recv(4096)
+            self.assertTrue(data)
+            response += data
+        self.assertIn(b'101', response.split(b'\r\n')[0])
+        self.assertIn(b'permessage-deflate', response)
+        return sock
+
+    def test_compressed_message(self):
+        sock = self.connect()
+        payload = b'hello world ' * 100
+        sock.sendall(masked_frame(compress(payload), rsv1=1))
+        payload_type, data = self.received.get(timeout=5)
+        self.assertEqual(data, payload)
+        self.assertEqual(payload_type, bytes)
+
+    def test_uncompressed_message(self):
+        sock = self.connect()
+        sock.sendall(masked_frame(b'plain'))
+        payload_type, data = self.received.get(timeout=5)
+        self.assertEqual(data, b'plain')
+        self.assertEqual(payload_type, memoryview)
+
+
+if __name__ == '__main__':
+    unittest.main()
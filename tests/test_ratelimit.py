@@ -0,0 +1,112 @@
+#!/bin/env python3
+import socket
+import time
+import unittest
+from ewebsockets.ClientSocket import Client
+from ewebsockets.handshake import SERVICE_UNAVAILABLE
+from ewebsockets.ratelimit import RateLimit, AcceptLimit, TokenBucket
+from support import start_server, stop_server, address, handshake, masked_frame, read_frame, wait_for
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_take(self):
+        bucket = TokenBucket(10, 2)
+        now = bucket.updated
+        self.assertTrue(bucket.take(now=now))
+        self.assertTrue(bucket.take(now=now))
+        self.assertFalse(bucket.take(now=now))
+        self.assertTrue(bucket.take(now=now + 0.1))
+        # Larger than burst, taken from a full bucket
+        self.assertTrue(bucket.take(5, now=now + 1))
+        self.assertEqual(bucket.tokens, -3)
+
+    def test_charge(self):
+        bucket = TokenBucket(10, 10)
+        now = bucket.updated
+        self.assertEqual(bucket.charge(10, now), 0)
+        self.assertAlmostEqual(bucket.charge(5, now), 0.5)
+        self.assertAlmostEqual(bucket.charge(0, now + 0.5), 0)
+
+    def test_accept_limit(self):
+        limit = AcceptLimit(max_connections=2, accept_rate=1, accept_burst=1)
+        self.assertIsNone(limit.admit(0))
+        self.assertEqual(limit.admit(1), 'accept_rate')
+        self.assertEqual(limit.admit(2), 'max_connections')
+
+
+class TestServerLimits(unittest.TestCase):
+    def setUp(self):
+        self.handled = []
+        self.sockets = []
+        self.server = None
+
+    def tearDown(self):
+        for sock in self.sockets:
+            sock.close()
+        if self.server is not None:
+            stop_server(self.server)
+
+    def start(self, **kwargs):
+        def handle(client, frame):
+            if frame.opcode[0] == 0x1:
+                self.handled.append((time.monotonic(), bytes(frame.payload)))
+            return True
+
+        self.server = start_server(handle_websocket_frame=handle, **kwargs)
+
+    def connect(self):
+        sock, response = handshake(self.server)
+        self.sockets.append(sock)
+        return sock, response
+
+    def test_pause(self):
+        self.start(rate_limit=RateLimit(messages_per_second=10))
+        sock, response = self.connect()
+        self.assertTrue(response.startswith(b'HTTP/1.1 101'))
+        # Read at once, all are handled and the client owes 5 messages, half a second
+        sock.sendall(b''.join(masked_frame(str(i).encode()) for i in range(15)))
+        self.assertTrue(wait_for(lambda: len(self.handled) == 15))
+        paused_at = self.handled[-1][0]
+        sock.sendall(masked_frame(b'late'))
+        self.assertTrue(wait_for(lambda: len(self.handled) == 16))
+        self.assertGreaterEqual(self.handled[-1][0] - paused_at, 0.45)
+        self.assertEqual([payload for _, payload in self.handled[:15]], [str(i).encode() for i in range(15)])
+
+        # Reading resumed, the client is still open and answered
+        sock.sendall(masked_frame(b'ping', opcode=0x9))
+        self.assertEqual(read_frame(sock), (0xA, b'ping'))
+        self.assertEqual(self.server.clients_list()[0].state, Client.OPEN)
+        # The late message may have put it in debt again
+        self.assertGreaterEqual(self.server.stats()['limits_hit']['messages'], 1)
+
+    def test_drop(self):
+        self.start(rate_limit=RateLimit(messages_per_second=10, policy=RateLimit.DROP))
+        sock, _ = self.connect()
+        sock.sendall(b''.join(masked_frame(str(i).encode()) for i in range(15)))
+        sock.sendall(masked_frame(b'ping', opcode=0x9))
+        self.assertEqual(read_frame(sock), (0xA, b'ping'))
+        self.assertTrue(wait_for(lambda: len(self.handled) == 10))
+        self.assertEqual(self.server.stats()['limits_hit'], {'messages': 5})
+
+    def test_max_connections(self):
+        self.start(max_connections=1)
+        _, response = self.connect()
+        self.assertTrue(response.startswith(b'HTTP/1.1 101'))
+        # Refused before the handshake is read
+        sock = socket.create_connection(address(self.server), timeout=5)
+        self.sockets.append(sock)
+        self.assertEqual(sock.recv(4096), SERVICE_UNAVAILABLE)
+        self.assertEqual(sock.recv(4096), b'')
+        self.assertEqual(len(self.server.clients), 1)
+        self.assertEqual(self.server.stats()['limits_hit'], {'max_connections': 1})
+
+    def test_accept_rate(self):
+        self.start(accept_rate=0.1, accept_burst=2)
+        responses = [self.connect()[1] for _ in range(3)]
+        self.assertEqual([response.split(b'\r\n')[0] for response in responses],
+                         [b'HTTP/1.1 101 Switching Protocols'] * 2 + [b'HTTP/1.1 503 Service Unavailable'])
+        self.assertEqual(self.server.stats()['limits_hit'], {'accept_rate': 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
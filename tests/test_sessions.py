@@ -0,0 +1,130 @@
+#!/bin/env python3
+import unittest
+import ewebsockets
+from ewebsockets import SessionTable
+from ewebsockets.exceptions import ClientDisconnect
+from support import start_server, stop_server, url, wait_for
+
+
+class TestSessions(unittest.TestCase):
+    def setUp(self):
+        self.table = SessionTable(grace_period=5, max_messages=50)
+        self.opened = []
+
+        def on_open(client):
+            self.opened.append(client)
+            if not client.session.resumed:
+                client.send_text('snapshot')
+            return True
+
+        self.server = start_server(on_client_open=on_open, sessions=self.table)
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.disconnect()
+        stop_server(self.server)
+
+    def connect(self, token=None, seq=None):
+        query = '' if token is None else '?session={}&seq={}'.format(token, seq)
+        client = ewebsockets.connect(url(self.server, '/' + query))
+        self.clients.append(client)
+        return client
+
+    def received(self, client, count):
+        messages = []
+        for _ in range(count):
+            frame = client.recv(5)
+            self.assertIsNotNone(frame)
+            messages.append(bytes(frame.payload).decode())
+        return messages
+
+    def drop(self, client):
+        """Disconnects without a closing handshake, so the session is kept"""
+        client.disconnect()
+        self.assertTrue(wait_for(lambda: not self.server.clients))
+
+    def test_resume(self):
+        client = self.connect()
+        token = client.response.get('x-session-token')
+        self.assertEqual(self.received(client, 1), ['snapshot'])
+        for i in range(1, 4):
+            self.server.broadcast('m{}'.format(i))
+        self.assertEqual(self.received(client, 3), ['m1', 'm2', 'm3'])
+        self.drop(client)
+        self.assertEqual(len(self.table), 1)
+
+        # Broadcast while detached, published to the session only
+        self.server.broadcast('m4')
+        self.server.broadcast_message({'m': 5})
+        self.server.broadcast('m6')
+        # As if m3 was lost with the connection
+        client = self.connect(token, 3)
+        self.assertEqual(client.response.get('x-session-token'), token)
+        # Missed messages come in order before anything sent once open
+        self.server.broadcast('m7')
+        self.assertEqual(self.received(client, 5), ['m3', 'm4', '{"m": 5}', 'm6', 'm7'])
+        self.assertTrue(self.opened[-1].session.resumed)
+        self.assertEqual((self.table.resumed, self.table.resynced, len(self.table)), (1, 0, 0))
+
+    def test_resume_not_kept(self):
+        client = self.connect()
+        token = client.response.get('x-session-token')
+        self.received(client, 1)
+        self.drop(client)
+        for i in range(60):
+            self.server.broadcast('m{}'.format(i))
+        # The first of the missed messages is no longer kept
+        client = self.connect(token, 1)
+        self.assertNotEqual(client.response.get('x-session-token'), token)
+        self.assertEqual(self.received(client, 1), ['snapshot'])
+        self.assertEqual((self.table.resumed, self.table.resynced), (0, 1))
+
+    def test_evicted(self):
+        self.table.max_detached = 1
+        first = self.connect()
+        token = first.response.get('x-session-token')
+        self.received(first, 1)
+        self.drop(first)
+        second = self.connect()
+        self.received(second, 1)
+        self.drop(second)
+        # Detaching the second dropped the first
+        self.assertEqual((len(self.table), self.table.expired), (1, 1))
+
+        client = self.connect(token, 1)
+        self.assertNotEqual(client.response.get('x-session-token'), token)
+        self.assertEqual(self.received(client, 1), ['snapshot'])
+        self.assertEqual(self.table.resumed, 0)
+
+    def test_expired(self):
+        self.table.grace_period = 0.3
+        client = self.connect()
+        token = client.response.get('x-session-token')
+        self.received(client, 1)
+        self.drop(client)
+        self.assertEqual(len(self.table), 1)
+        self.assertTrue(wait_for(lambda: not self.table.publish(ewebsockets.OpCode.TEXT, 'late')))
+        self.assertEqual((len(self.table), self.table.expired), (0, 1))
+
+        client = self.connect(token, 1)
+        self.assertNotEqual(client.response.get('x-session-token'), token)
+        self.assertEqual(self.received(client, 1), ['snapshot'])
+
+    def test_take_over(self):
+        old = self.connect()
+        token = old.response.get('x-session-token')
+        self.received(old, 1)
+        # Reconnects before the server noticed the old connection is gone
+        client = self.connect(token, 1)
+        self.assertEqual(client.response.get('x-session-token'), token)
+        with self.assertRaises(ClientDisconnect):
+            old.recv(5)
+        self.assertTrue(wait_for(lambda: len(self.server.clients) == 1))
+        self.server.broadcast('m1')
+        self.assertEqual(self.received(client, 1), ['m1'])
+        self.assertEqual(self.table.resumed, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
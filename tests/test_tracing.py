@@ -0,0 +1,66 @@
+#!/bin/env python3
+import json
+import os
+import tempfile
+import unittest
+from ewebsockets import Frame
+from ewebsockets.tracing import Tracer
+from support import start_server, stop_server, handshake, masked_frame, read_frame, wait_for
+
+
+class TestTracing(unittest.TestCase):
+    def setUp(self):
+        def echo(client, frame):
+            if frame.opcode[0] == 0x1:
+                client.send_frame(Frame(payload=bytes(frame.payload), opcode=frame.opcode))
+            return True
+
+        self.server = start_server(handle_websocket_frame=echo)
+        self.tracer = Tracer()
+        self.tracer.start()
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tracer.stop()
+        stop_server(self.server)
+        self.directory.cleanup()
+
+    def test_export(self):
+        sock, _ = handshake(self.server)
+        with sock:
+            sock.sendall(masked_frame(b'hello'))
+            self.assertEqual(read_frame(sock), (0x1, b'hello'))
+        # The handler span is added once the handler returned, after the echo was sent
+        self.assertTrue(wait_for(lambda: any(span[0] == 'handle_websocket_frame'
+                                             for span in list(self.tracer.spans))))
+        path = os.path.join(self.directory.name, 'trace.json')
+        self.tracer.export(path)
+
+        with open(path) as file:
+            trace = json.load(file)
+        events = trace['traceEvents']
+        self.assertIsInstance(events, list)
+        for event in events:
+            self.assertEqual(event['ph'], 'X')
+            self.assertIsInstance(event['ts'], (int, float))
+            self.assertGreaterEqual(event['dur'], 0)
+            self.assertEqual(event['pid'], os.getpid())
+            self.assertIsInstance(event['tid'], int)
+        names = {event['name'] for event in events}
+        for name in ('handle_incoming', 'do_handshake', 'header parse', 'payload receive', 'unmask',
+                     'handle_websocket_frame', 'Frame.pack', 'send_raw'):
+            self.assertIn(name, names)
+        handler = [event for event in events if event['name'] == 'handle_websocket_frame'][0]
+        self.assertEqual(handler['args'], {'opcode': 0x1, 'bytes': 5})
+
+    def test_stopped(self):
+        self.tracer.stop()
+        sock, _ = handshake(self.server)
+        with sock:
+            sock.sendall(masked_frame(b'hello'))
+            self.assertEqual(read_frame(sock), (0x1, b'hello'))
+        self.assertEqual(self.tracer.chrome_trace()['traceEvents'], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
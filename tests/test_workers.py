@@ -0,0 +1,92 @@
+#!/bin/env python3
+import socket
+import threading
+import unittest
+import ewebsockets
+from ewebsockets.workers import WorkerPool
+from support import masked_frame, read_frame, wait_for
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class TestWorkerPool(unittest.TestCase):
+    def setUp(self):
+        self.port = port = free_port()
+
+        def factory(bus):
+            def handle(client, frame):
+                message = bytes(frame.payload)
+                if message == b'id':
+                    client.send_text(bus.client_id(client))
+                else:
+                    bus.broadcast(message)
+                return True
+
+            return ewebsockets.Websocket(handle_websocket_frame=handle,
+                                         esockets_kwargs={'host': '127.0.0.1', 'port': port, 'block_time': 0.1})
+
+        self.pool = WorkerPool(factory, workers=2, stop_timeout=3)
+        self.pool.start()
+        self.sockets = []
+        self.relaying = None
+
+    def tearDown(self):
+        if self.relaying is not None:
+            self.relaying.set()
+            self.relay.join()
+        for sock in self.sockets:
+            sock.close()
+        self.pool.stop()
+
+    def connect(self, count):
+        for _ in range(count):
+            sock = socket.create_connection(('127.0.0.1', self.port), timeout=5)
+            sock.sendall(b'GET / HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                         b'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\nSec-WebSocket-Version: 13\r\n\r\n')
+            response = b''
+            while b'\r\n\r\n' not in response:
+                response += sock.recv(4096)
+            self.assertTrue(response.startswith(b'HTTP/1.1 101'))
+            self.sockets.append(sock)
+
+    def start_relaying(self):
+        """The master relays bus messages while it polls, which the test thread
+        does not do once it waits for the clients
+        """
+        self.relaying = threading.Event()
+        self.relay = threading.Thread(target=self._relay)
+        self.relay.start()
+
+    def _relay(self):
+        while not self.relaying.is_set():
+            self.pool._poll(0.05)
+
+    def test_broadcast(self):
+        self.connect(16)
+        self.assertEqual(len(self.pool.workers), 2)
+        # SO_REUSEPORT spreads the connections over both workers
+        self.assertTrue(wait_for(lambda: self.pool.stats()['clients'] == 16))
+        per_worker = [stats['clients'] for stats in self.pool.stats()['per_worker']]
+        self.assertEqual(len(per_worker), 2)
+        self.assertNotIn(0, per_worker)
+
+        self.start_relaying()
+        self.sockets[0].sendall(masked_frame(b'hello'))
+        for sock in self.sockets:
+            self.assertEqual(read_frame(sock), (0x1, b'hello'))
+
+    def test_client_id(self):
+        self.connect(4)
+        ids = set()
+        for sock in self.sockets:
+            sock.sendall(masked_frame(b'id'))
+            ids.add(read_frame(sock)[1])
+        self.assertEqual(len(ids), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()